@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' Measures the throughput of opencce along payload size, file count and recipient count. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+
+import M2Crypto.ASN1
+import M2Crypto.EVP
+import M2Crypto.RSA
+import M2Crypto.X509
+
+# Benchmark the working tree, not an installed version.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from opencce import pkcs7
+from opencce import x509
+from opencce.utils import Utils
+from opencce.containers.CCEContainer import CCEContainer
+
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# The values of each axis that are measured. The quick profile is meant for every change,
+# the full profile for releases.
+PROFILES = {
+	"quick": {
+		"payload":    [1 * KB, 1 * MB, 16 * MB],
+		"files":      [1, 100, 1000],
+		"recipients": [1, 10, 100]
+	},
+	"full": {
+		"payload":    [1 * KB, 1 * MB, 64 * MB, 1 * GB],
+		"files":      [1, 100, 5000, 50000],
+		"recipients": [1, 10, 100, 1000]
+	}
+}
+
+# Payloads of the files and recipients axes, and files per container on the payload axis.
+SMALL_FILE_SIZE = 1 * KB
+
+# Results format, stored with the results so old baselines can be detected.
+VERSION = 1
+
+# A benchmark is a regression if it is this much slower than the baseline.
+DEFAULT_TOLERANCE = 0.25
+
+KEY_SIZE = 2048
+
+
+def generate_certificates(directory, count):
+	'''
+		Creates a private key and count self-signed certificates for it in directory. All
+		certificates share the key, since RSA key generation would dominate the setup time,
+		but have distinct subjects and serial numbers. Returns the key and certificate paths.
+	'''
+
+	rsa = M2Crypto.RSA.gen_key(KEY_SIZE, 65537, callback = lambda *args: None)
+	key_path = os.path.join(directory, "key.pem")
+	rsa.save_key(key_path, cipher = None)
+
+	key = M2Crypto.EVP.PKey()
+	key.assign_rsa(rsa)
+
+	now = int(time.time())
+	paths = []
+
+	for serial in range(1, count + 1):
+		name = M2Crypto.X509.X509_Name()
+		name.CN = "opencce benchmark {0}".format(serial)
+
+		not_before = M2Crypto.ASN1.ASN1_UTCTIME()
+		not_before.set_time(now)
+		not_after = M2Crypto.ASN1.ASN1_UTCTIME()
+		not_after.set_time(now + 86400)
+
+		certificate = M2Crypto.X509.X509()
+		certificate.set_version(2)
+		certificate.set_serial_number(serial)
+		certificate.set_subject(name)
+		certificate.set_issuer(name)
+		certificate.set_pubkey(key)
+		certificate.set_not_before(not_before)
+		certificate.set_not_after(not_after)
+		certificate.sign(key, "sha256")
+
+		path = os.path.join(directory, "certificate{0}.pem".format(serial))
+		certificate.save_pem(path)
+		paths.append(path)
+
+	return key_path, paths
+
+
+def generate_files(directory, count, size):
+	''' Creates count files of size random bytes in directory and returns their paths. '''
+
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	block = os.urandom(min(size, MB))
+	paths = []
+
+	for index in range(count):
+		# Files without an extension make get_mimetype sniff their contents.
+		path = os.path.join(directory, "file{0}".format(index))
+
+		with open(path, "wb") as handle:
+			remaining = size
+			while remaining > 0:
+				handle.write(block[:remaining])
+				remaining -= len(block)
+
+		paths.append(path)
+
+	return paths
+
+
+def measure(function, setup = None, repeat = 3):
+	''' Returns the best time of repeat calls of function with the result of setup. '''
+
+	best = None
+
+	for _ in range(repeat):
+		argument = setup() if setup else None
+		gc.collect()
+
+		start = time.time()
+		function(argument)
+		elapsed = time.time() - start
+
+		best = elapsed if best is None else min(best, elapsed)
+
+	return best
+
+
+class Benchmark(object):
+	''' Runs the benchmarks of a profile in a temporary directory and collects the results. '''
+
+	def __init__(self, profile, repeat, only = None):
+		self.profile = PROFILES[profile]
+		self.repeat = repeat
+		self.only = only
+		self.results = []
+		self.directory = tempfile.mkdtemp(prefix = "opencce-benchmark-")
+
+		self.key, self.certificates = generate_certificates(
+			self.directory, max(self.profile["recipients"])
+		)
+
+
+	def close(self):
+		''' Removes all generated files. '''
+
+		shutil.rmtree(self.directory)
+
+
+	def run(self):
+		''' Runs all benchmarks and returns the results. '''
+
+		for size in self.profile["payload"]:
+			files = generate_files(os.path.join(self.directory, "payload"), 1, size)
+			self.run_container("payload", size, files, self.certificates[:1], size)
+			shutil.rmtree(os.path.join(self.directory, "payload"))
+
+		for count in self.profile["files"]:
+			files = generate_files(os.path.join(self.directory, "files"), count, SMALL_FILE_SIZE)
+			self.run_container("files", count, files, self.certificates[:1], count * SMALL_FILE_SIZE)
+			# Drop the cached types, otherwise only the first run would sniff.
+			self.record(
+				"get_mimetype", "files", count, count * SMALL_FILE_SIZE,
+				lambda argument: [Utils.get_mimetype(path) for path in files], setup = Utils._mimetype_cache.entries.clear
+			)
+			shutil.rmtree(os.path.join(self.directory, "files"))
+
+		files = generate_files(os.path.join(self.directory, "recipients"), 1, SMALL_FILE_SIZE)
+
+		for count in self.profile["recipients"]:
+			certificates = self.certificates[:count]
+			self.run_container("recipients", count, files, certificates, SMALL_FILE_SIZE)
+
+			def new_store():
+				store = x509.CertificateStore()
+				for path in certificates:
+					store.add_from_file(path)
+				return store
+
+			self.record(
+				"get_archive", "recipients", count, None, lambda store: store.get_archive(), setup = new_store
+			)
+
+			self.run_key_wrap(count, [M2Crypto.X509.load_cert(path) for path in certificates])
+
+		return self.results
+
+
+	def run_key_wrap(self, count, certificates):
+		'''
+			Measures wrapping a content key for certificates in this process and in a pool of
+			one process per CPU (but at least two), including the start of the pool, which is
+			what pkcs7.get_recipient_infos() does when it is given a number of processes.
+		'''
+
+		key = os.urandom(32)
+		processes = max(multiprocessing.cpu_count(), 2)
+
+		self.record(
+			"key_wrap", "recipients", count, None,
+			lambda argument: pkcs7.get_recipient_infos(certificates, key)
+		)
+
+		self.record(
+			"key_wrap_pool", "recipients", count, None,
+			lambda argument: pkcs7.get_recipient_infos(certificates, key, processes = processes)
+		)
+
+
+	def run_container(self, axis, value, files, certificates, size):
+		''' Measures encryption and decryption of a container with files for certificates. '''
+
+		output = os.path.join(self.directory, "container.cce")
+
+		container = CCEContainer()
+		for path in files:
+			container.add(path)
+		for path in certificates:
+			container.add_recipient_certificate(path)
+
+		def encrypt(argument):
+			with open(output, "wb") as handle:
+				container.encrypt_to(handle)
+
+		def load(argument):
+			with open(output, "rb") as handle:
+				CCEContainer.load_stream(handle, self.key).close()
+
+		# The container is written once even if only load is measured.
+		encrypt(None)
+
+		self.record("encrypt", axis, value, size, encrypt)
+		self.record("load", axis, value, size, load)
+
+		os.remove(output)
+
+
+	def record(self, name, axis, value, size, function, setup = None):
+		''' Measures function unless the benchmark was deselected, then stores and prints the result. '''
+
+		if self.only and name not in self.only:
+			return
+
+		seconds = measure(function, setup, self.repeat)
+
+		result = {"benchmark": name, "axis": axis, "value": value, "seconds": seconds}
+		if size:
+			result["bytes_per_second"] = size / seconds if seconds else None
+
+		self.results.append(result)
+		print("{0:<14} {1:<12} {2:>12} {3:>10.4f}s".format(name, axis, value, seconds), file = sys.stderr)
+
+
+def compare(results, baseline, tolerance = DEFAULT_TOLERANCE):
+	'''
+		Compares results with the results of a baseline and returns a list of messages for all
+		benchmarks that became more than tolerance slower.
+	'''
+
+	previous = dict(
+		((result["benchmark"], result["axis"], result["value"]), result["seconds"])
+		for result in baseline["results"]
+	)
+
+	regressions = []
+
+	for result in results:
+		key = (result["benchmark"], result["axis"], result["value"])
+		if key not in previous:
+			continue
+
+		if result["seconds"] > previous[key] * (1 + tolerance):
+			regressions.append("{0} ({1} = {2}): {3:.4f}s, baseline {4:.4f}s".format(
+				result["benchmark"], result["axis"], result["value"], result["seconds"], previous[key]
+			))
+
+	return regressions
+
+
+def main():
+	''' Runs the benchmarks from the command line. '''
+
+	parser = argparse.ArgumentParser(description = "Measure the throughput of opencce.")
+
+	parser.add_argument(
+		"-p", "--profile",
+		choices = sorted(PROFILES),
+		help    = "the values that are measured on each axis (default: %(default)s)",
+		default = "quick"
+	)
+
+	parser.add_argument(
+		"-n", "--repeat",
+		type    = int,
+		help    = "number of runs of which the best is reported (default: %(default)s)",
+		default = 3
+	)
+
+	parser.add_argument(
+		"--only",
+		action  = "append",
+		choices = ["encrypt", "load", "get_archive", "get_mimetype", "key_wrap", "key_wrap_pool"],
+		help    = "only report this benchmark (may be given more than once)"
+	)
+
+	parser.add_argument(
+		"-O", "--output",
+		help    = "write the results as JSON to this file (use - for standard output)"
+	)
+
+	parser.add_argument(
+		"-b", "--baseline",
+		help    = "compare the results with a file written by --output and fail on regressions"
+	)
+
+	parser.add_argument(
+		"-t", "--tolerance",
+		type    = float,
+		help    = "relative slowdown that is reported as regression (default: %(default)s)",
+		default = DEFAULT_TOLERANCE
+	)
+
+	args = parser.parse_args()
+
+	benchmark = Benchmark(args.profile, args.repeat, args.only)
+
+	try:
+		results = benchmark.run()
+	finally:
+		benchmark.close()
+
+	document = {
+		"version": VERSION,
+		"profile": args.profile,
+		"python":  platform.python_version(),
+		"machine": platform.machine(),
+		"results": results
+	}
+
+	if args.output == "-":
+		json.dump(document, sys.stdout, indent = 2, sort_keys = True)
+	elif args.output:
+		with open(args.output, "w") as handle:
+			json.dump(document, handle, indent = 2, sort_keys = True)
+
+	if args.baseline:
+		with open(args.baseline, "r") as handle:
+			baseline = json.load(handle)
+
+		if baseline.get("version") != VERSION:
+			print("The baseline was written by an incompatible version.", file = sys.stderr)
+			sys.exit(2)
+
+		regressions = compare(results, baseline, args.tolerance)
+
+		for message in regressions:
+			print("Regression: " + message, file = sys.stderr)
+
+		if regressions:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
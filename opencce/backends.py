@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides the crypto backends that encrypt and decrypt the content of CCE containers. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import os
+import abc
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from distutils.spawn import find_executable
+
+from opencce import pkcs7
+from opencce.utils import LazyModule
+
+
+M2Crypto = LazyModule("M2Crypto", "M2Crypto.RSA")
+
+
+# The names of the backends.
+M2CRYPTO = "m2crypto"
+OPENSSL  = "openssl"
+
+# If no backend is chosen, contents of at least this many bytes are encrypted by the openssl binary.
+STREAMING_THRESHOLD = 256 * 1024 * 1024
+
+
+def get_backend(backend = None, size = None, compressed = False):
+	'''
+		Returns a backend instance. backend is either an instance, one of the names M2CRYPTO
+		and OPENSSL or None. If it is None, the openssl binary is used for uncompressed
+		contents of at least STREAMING_THRESHOLD bytes (if it is installed) and M2Crypto for
+		everything else. A size of None means that the size is not known.
+	'''
+
+	if isinstance(backend, Backend):
+		return backend
+	elif backend == M2CRYPTO:
+		return M2CryptoBackend()
+	elif backend == OPENSSL:
+		return OpenSSLBackend()
+	elif backend is not None:
+		raise ValueError("Unsupported backend: " + backend)
+
+	if size is not None and size >= STREAMING_THRESHOLD and not compressed:
+		openssl = OpenSSLBackend()
+		if openssl.is_available():
+			return openssl
+
+	return M2CryptoBackend()
+
+
+
+class Backend(object):
+	''' The interface of all crypto backends. '''
+
+	__metaclass__ = abc.ABCMeta
+
+	name = None
+
+	@abc.abstractmethod
+	def open_encryptor(self, output, certificates, cipher, content_type = pkcs7.OID_DATA, processes = None):
+		'''
+			Returns a writer that encrypts everything written to it for the M2Crypto X509
+			certificates and writes BER encoded PKCS#7 enveloped data to output. Closing the
+			writer does not close output. Backends that wrap the content key themselves may
+			use that many processes for it, see pkcs7.get_recipient_infos().
+		'''
+
+
+	@abc.abstractmethod
+	def decrypt(self, envelope, keys):
+		'''
+			Returns an iterator over the decrypted content of a pkcs7.EnvelopedDataReader. The
+			content key is unwrapped with the first of the M2Crypto RSA keys that works before
+			this method returns. Keys can be paired with their RecipientInfo as described in
+			pkcs7.EnvelopedDataReader.get_content_key().
+		'''
+
+
+	def get_recipient_infos(self, stream):
+		'''
+			Returns the pkcs7.RecipientInfo tuples of the PKCS#7 data in stream. Nothing is
+			decrypted for this, so all backends share the parser of the pkcs7 module.
+		'''
+
+		return pkcs7.EnvelopedDataReader(pkcs7.open_reader(stream)).recipient_infos
+
+
+
+class M2CryptoBackend(Backend):
+	'''
+		Encrypts and decrypts in this process with the ciphers and RSA keys of M2Crypto. The
+		PKCS#7 structures are written and read by the pkcs7 module one chunk at a time.
+	'''
+
+	name = M2CRYPTO
+
+	def open_encryptor(self, output, certificates, cipher, content_type = pkcs7.OID_DATA, processes = None):
+		return pkcs7.EnvelopedDataWriter(
+			output, certificates, cipher, content_type = content_type, processes = processes
+		)
+
+
+	def decrypt(self, envelope, keys):
+		return envelope.decrypt(*keys)
+
+
+
+class OpenSSLBackend(Backend):
+	'''
+		Encrypts and decrypts with "openssl cms" in a separate process, which is fed and read
+		through pipes one chunk at a time. Certificates are passed in temporary files, keys
+		through a pipe of their own, so they are never written to disk. Compressed contents can
+		be decrypted, but not encrypted, since openssl always marks the content as data.
+
+		Note that only encryption streams. "openssl cms -decrypt" reads the whole container
+		into memory before it writes anything, so it is never chosen for decryption by default.
+	'''
+
+	name = OPENSSL
+
+	def __init__(self, executable = "openssl"):
+		self.executable = executable
+
+
+	def is_available(self):
+		''' Returns True if the openssl binary can be found. '''
+
+		return find_executable(self.executable) is not None
+
+
+	def open_encryptor(self, output, certificates, cipher, content_type = pkcs7.OID_DATA, processes = None):
+		if content_type != pkcs7.OID_DATA:
+			raise ValueError("The openssl backend can not encrypt compressed containers.")
+
+		if cipher not in pkcs7.CIPHERS:
+			raise ValueError("Unsupported cipher: " + cipher)
+
+		directory = tempfile.mkdtemp(prefix = "opencce-")
+		paths = []
+
+		for index, certificate in enumerate(certificates):
+			paths.append(os.path.join(directory, "{0}.pem".format(index)))
+			certificate.save_pem(paths[-1])
+
+		if not paths:
+			shutil.rmtree(directory)
+			raise ValueError("At least one recipient certificate is required.")
+
+		process, errors = self._start([
+			"-encrypt", "-stream", "-binary", "-outform", "DER", "-" + cipher.replace("_", "-")
+		] + paths)
+
+		return _ProcessWriter(process, errors, output, directory)
+
+
+	def decrypt(self, envelope, keys):
+		# openssl takes a single key, so we find the one that works first.
+		for key in keys:
+			try:
+				envelope.get_content_key(key)
+				break
+			except IOError:
+				continue
+		else:
+			raise IOError("The container was not encrypted for this key.")
+
+		if isinstance(key, tuple):
+			key, _ = key
+
+		# openssl reads the key from a pipe that it inherits. A key is much smaller than the
+		# buffer of a pipe, so it is written completely before openssl starts.
+		read_fd, write_fd = os.pipe()
+
+		with os.fdopen(write_fd, "wb") as handle:
+			handle.write(key.as_pem(cipher = None))
+
+		try:
+			process, errors = self._start([
+				"-decrypt", "-binary", "-inform", "DER", "-inkey", "/dev/fd/{0}".format(read_fd)
+			])
+		finally:
+			os.close(read_fd)
+
+		# The header of the envelope was already read, so we write it again in front of the content.
+		content_type = pkcs7.OID_COMPRESSED_DATA if envelope.is_compressed() else pkcs7.OID_DATA
+		writer = pkcs7.EnvelopedDataWriter(
+			process.stdin, (), envelope.cipher, content_type = content_type, iv = envelope.iv,
+			recipient_infos = [recipient_info.der for recipient_info in envelope.recipient_infos]
+		)
+
+		def feed():
+			try:
+				for chunk in envelope.iter_content():
+					writer.write_encrypted(chunk)
+				writer.close()
+			except (IOError, OSError):
+				# Errors of openssl are reported when its output ends.
+				pass
+			finally:
+				process.stdin.close()
+
+		return _read_process(process, errors, threading.Thread(target = feed))
+
+
+	def _start(self, arguments):
+		'''
+			Starts "openssl cms" with the arguments and returns the process and a temporary file
+			that receives its standard error, so a lot of error output can not block it. The
+			process inherits all file descriptors.
+		'''
+
+		errors = tempfile.TemporaryFile()
+
+		try:
+			process = subprocess.Popen(
+				[self.executable, "cms"] + arguments, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+				stderr = errors, close_fds = False
+			)
+		except OSError as error:
+			raise IOError("Could not start openssl: {0}".format(error))
+
+		return process, errors
+
+
+
+def _read_process(process, errors, feeder):
+	''' Generator that starts feeder and yields the output of process. '''
+
+	try:
+		feeder.daemon = True
+		feeder.start()
+
+		for chunk in iter(lambda: process.stdout.read(pkcs7.CHUNK_SIZE), ""):
+			yield chunk
+
+		feeder.join()
+		_wait(process, errors)
+	finally:
+		# The process is still running if the caller stopped reading early.
+		if process.poll() is None:
+			process.kill()
+
+		errors.close()
+
+
+def _wait(process, errors):
+	''' Waits for process to end and raises an IOError with its error output if it failed. '''
+
+	if process.wait():
+		errors.seek(0)
+		raise IOError("openssl failed: " + errors.read().strip())
+
+
+
+class _ProcessWriter(object):
+	'''
+		Passes everything written to it to the standard input of process, while a thread
+		copies its standard output to output.
+	'''
+
+	def __init__(self, process, errors, output, directory):
+		self.process = process
+		self.errors = errors
+		self.output = output
+		self.directory = directory
+		self.error = None
+
+		self.thread = threading.Thread(target = self._copy)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def write(self, data):
+		''' Passes data to the process. '''
+
+		# The output failed, so the process was stopped.
+		if self.error:
+			self.close()
+
+		try:
+			self.process.stdin.write(data)
+		except IOError:
+			# The process ended early, so we report its error.
+			self.close()
+			raise
+
+
+	def close(self):
+		''' Waits for the process to write everything. Does not close the output. '''
+
+		try:
+			if not self.process.stdin.closed:
+				try:
+					self.process.stdin.close()
+				except IOError:
+					pass
+
+			self.thread.join()
+
+			# An error of the output comes first, since it is the reason the process was stopped.
+			if self.error:
+				self.process.wait()
+				raise self.error
+
+			_wait(self.process, self.errors)
+		finally:
+			self.errors.close()
+			shutil.rmtree(self.directory, ignore_errors = True)
+
+
+	def _copy(self):
+		'''
+			Copies the standard output of the process to the output. If the output fails, the
+			process is stopped, so writers do not wait for it forever.
+		'''
+
+		try:
+			for chunk in iter(lambda: self.process.stdout.read(pkcs7.CHUNK_SIZE), ""):
+				self.output.write(chunk)
+		except Exception as error:
+			self.error = error
+
+			if self.process.poll() is None:
+				self.process.kill()
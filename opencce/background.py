@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module runs encryption and decryption in the background, so callers are not blocked. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import time
+import threading
+import collections
+
+
+# The number of threads of the default executor.
+DEFAULT_THREADS = 4
+
+# The number of chunks a Pipe holds before writers have to wait for readers.
+DEFAULT_PIPE_SIZE = 16
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+	''' Returns the thread pool that is used if no executor is given. It is created on first use. '''
+
+	global _default_executor
+
+	with _default_executor_lock:
+		if _default_executor is None:
+			from multiprocessing.pool import ThreadPool
+			_default_executor = ThreadPool(DEFAULT_THREADS)
+
+	return _default_executor
+
+
+def submit(executor, function, *args, **kwargs):
+	'''
+		Runs function on executor and returns a handle to its result. The executor must run
+		functions in threads of this process, since containers, open files and pipes can not
+		be passed to other processes. It is either a multiprocessing.pool.ThreadPool, which
+		returns an AsyncResult, or an object with a submit method like a
+		concurrent.futures.ThreadPoolExecutor, which returns a Future. Process pools are
+		rejected with a ValueError. If executor is None, the default thread pool is used.
+	'''
+
+	executor = executor or get_default_executor()
+
+	if _is_process_pool(executor):
+		raise ValueError("Only thread based executors are supported, not process pools.")
+
+	if hasattr(executor, "submit"):
+		return executor.submit(function, *args, **kwargs)
+
+	return executor.apply_async(function, args, kwargs)
+
+
+def _is_process_pool(executor):
+	''' Returns True if executor runs functions in other processes. '''
+
+	from multiprocessing.pool import Pool, ThreadPool
+
+	if isinstance(executor, Pool) and not isinstance(executor, ThreadPool):
+		return True
+
+	try:
+		from concurrent.futures import ProcessPoolExecutor
+	except ImportError:
+		return False
+
+	return isinstance(executor, ProcessPoolExecutor)
+
+
+
+class Pipe(object):
+	'''
+		Passes chunks of data from a writer thread to a reader. A background encryption can
+		write into a pipe while the caller reads the container chunk by chunk, for example to
+		send it over a connection. Writers wait while the pipe is full, so a slow reader does
+		not make the whole container pile up in memory. Both sides block the calling thread,
+		so an event loop has to read or write from a thread of its own. If timeout is given,
+		a side that waits longer than timeout seconds gets an IOError.
+
+		A reader that stops early calls abort(), which makes the next write fail with an
+		IOError, so the writer does not wait forever. Leaving a for loop over the pipe does
+		the same.
+
+
+		Example
+		-------
+
+		pipe = Pipe()
+		result = container.encrypt_async(pipe)
+
+		for chunk in pipe:
+			connection.send(chunk)
+
+		result.get()
+
+	'''
+
+	def __init__(self, size = DEFAULT_PIPE_SIZE, timeout = None):
+		self.size = size
+		self.timeout = timeout
+		self.chunks = collections.deque()
+		self.condition = threading.Condition()
+		self.buffer = ""
+		self.closed = False
+		self.aborted = False
+
+
+	def write(self, data):
+		''' Adds a chunk of data and waits if the pipe is full. Raises an IOError if the pipe was aborted. '''
+
+		if not data:
+			return
+
+		with self.condition:
+			self._wait(lambda: self.aborted or len(self.chunks) < self.size)
+
+			if self.aborted:
+				raise IOError("The pipe was aborted.")
+
+			self.chunks.append(data)
+			self.condition.notify_all()
+
+
+	def close(self):
+		''' Marks the end of the data. Readers get an empty string once everything was read. '''
+
+		with self.condition:
+			self.chunks.append(None)
+			self.condition.notify_all()
+
+
+	def abort(self):
+		''' Drops everything that was not read yet and makes all further writes fail. '''
+
+		with self.condition:
+			self.aborted = True
+			self.closed = True
+			self.chunks.clear()
+			self.condition.notify_all()
+
+
+	def read(self, size = -1):
+		''' Reads up to size bytes, or everything until the end if size is negative. Waits for the writer. '''
+
+		while not self.closed and (size < 0 or len(self.buffer) < size):
+			chunk = self._get()
+			if chunk is None:
+				break
+			self.buffer += chunk
+
+		if size < 0:
+			size = len(self.buffer)
+
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+
+	def __iter__(self):
+		''' Yields the chunks in the order they were written until the pipe is closed. '''
+
+		try:
+			if self.buffer:
+				yield self.buffer
+				self.buffer = ""
+
+			while not self.closed:
+				chunk = self._get()
+				if chunk is None:
+					break
+				yield chunk
+		finally:
+			if not self.closed:
+				self.abort()
+
+
+	def _get(self):
+		''' Waits for the next chunk and returns it, or None at the end of the data. '''
+
+		with self.condition:
+			self._wait(lambda: self.aborted or self.chunks)
+
+			if self.aborted:
+				return None
+
+			chunk = self.chunks.popleft()
+			self.closed = chunk is None
+			self.condition.notify_all()
+
+		return chunk
+
+
+	def _wait(self, predicate):
+		''' Waits on the condition until predicate is true. Raises an IOError once the timeout has passed. '''
+
+		deadline = None if self.timeout is None else time.time() + self.timeout
+
+		while not predicate():
+			if deadline is None:
+				self.condition.wait()
+				continue
+
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise IOError("Timed out waiting for the other end of the pipe.")
+
+			self.condition.wait(remaining)
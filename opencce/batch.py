@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides functions to encrypt and decrypt many CCE containers in parallel. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import os
+import csv
+import json
+import tempfile
+
+from StringIO import StringIO
+from collections import namedtuple
+
+from opencce import x509
+from opencce import pkcs7
+from opencce import extract
+from opencce.utils import LazyModule
+from opencce.containers.CCEContainer import CCEContainer, Decryptor, DEFAULT_CIPHER_STRING
+
+
+multiprocessing = LazyModule("multiprocessing", "multiprocessing.pool")
+
+
+# Separates multiple files or certificates in a single CSV field.
+CSV_LIST_SEPARATOR = ";"
+
+
+# A single container that should be built from files for the given certificates.
+BatchJob = namedtuple("BatchJob", ["output", "files", "certificates"])
+
+# The outcome of a BatchJob. The error is None if the container was built successfully.
+BatchResult = namedtuple("BatchResult", ["job", "error"])
+
+
+# Every worker process keeps the certificate stores it has loaded, keyed by the certificate paths.
+_certificate_stores = {}
+
+# The KeyIndex and password that decryption workers use. They are set by _init_decryption.
+_key_index = None
+_password = None
+
+
+def read_manifest(handle):
+	'''
+		Reads a list of BatchJob instances from a manifest file. The manifest is either JSONL
+		with one object per line that has the keys output, files and certificates (each a
+		string or a list of strings), or CSV with a header row and the same columns, where
+		multiple values are separated by semicolons.
+	'''
+
+	lines = [line for line in handle if line.strip()]
+
+	try:
+		if lines and lines[0].lstrip().startswith("{"):
+			return [
+				BatchJob(row["output"], _as_list(row["files"]), _as_list(row["certificates"]))
+				for row in (json.loads(line) for line in lines)
+			]
+
+		return [
+			BatchJob(row["output"], _split(row["files"]), _split(row["certificates"]))
+			for row in csv.DictReader(lines)
+		]
+	except (KeyError, TypeError, AttributeError, ValueError):
+		raise IOError("Invalid manifest (every job needs output, files and certificates).")
+
+
+def encrypt_batch(jobs, processes = None, output_format = pkcs7.FORMAT_SMIME, compression_level = None):
+	'''
+		Builds the containers described by jobs in a pool of worker processes and yields a
+		BatchResult for each job as soon as it is done. Uses one process per CPU by default.
+	'''
+
+	pool = multiprocessing.Pool(processes)
+
+	try:
+		for result in pool.imap_unordered(
+			_encrypt_job, [(job, output_format, compression_level) for job in jobs]
+		):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+
+def encrypt_fan_out(
+	container, groups, processes = None, cipher = DEFAULT_CIPHER_STRING, output_format = pkcs7.FORMAT_SMIME,
+	compression_level = None
+):
+	'''
+		Encrypts the files of container for many groups of recipients, one container each.
+		groups is a list of output filenames and CertificateStore instances. The MIME message
+		(and its compressed form) is built only once in a temporary file, so the worker
+		processes only encrypt it and add the certificate store of their group. Yields a
+		BatchResult for each group as soon as it is done, where the job is the output filename.
+	'''
+
+	content_type = pkcs7.OID_DATA if compression_level is None else pkcs7.OID_COMPRESSED_DATA
+
+	with tempfile.NamedTemporaryFile(prefix = "opencce-") as message:
+		if compression_level is None:
+			boundary = container.write_files(message)
+		else:
+			compressor = pkcs7.CompressedDataWriter(message, compression_level)
+			boundary = container.write_files(compressor)
+
+		message.flush()
+
+		# Only the certificate stores differ, and they are small enough to pass to the workers.
+		jobs = []
+		for output, recipients in groups:
+			ending = StringIO()
+
+			if compression_level is None:
+				CCEContainer.write_certificate_store(ending, boundary, recipients)
+			else:
+				writer = compressor.copy(ending)
+				CCEContainer.write_certificate_store(writer, boundary, recipients)
+				writer.close()
+
+			certificates = [certificate.as_der() for certificate in recipients]
+			jobs.append((output, certificates, message.name, ending.getvalue(), content_type, cipher, output_format))
+
+		pool = multiprocessing.Pool(processes)
+
+		try:
+			for result in pool.imap_unordered(_fan_out_job, jobs):
+				yield result
+		finally:
+			pool.close()
+			pool.join()
+
+
+def decrypt_batch(containers, key_index, directory, password = None, processes = None):
+	'''
+		Decrypts the container files in a pool of worker processes. Each container is decrypted
+		with the key from key_index that matches one of its recipients and extracted to a new
+		directory below directory that is named after the container. A number is appended to
+		the name if it is already taken. Yields a BatchResult for each container as soon as it
+		is done, where the job is the container filename.
+	'''
+
+	jobs = []
+	targets = set()
+
+	for path in containers:
+		target = os.path.join(directory, os.path.splitext(os.path.basename(path))[0])
+
+		# Like a single decryption, we never extract into an existing directory.
+		counter = 0
+		while os.path.exists(target) or target in targets:
+			target += str(counter)
+			counter += 1
+
+		targets.add(target)
+		jobs.append((path, target))
+
+	# The workers inherit the keys that the index has already opened.
+	pool = multiprocessing.Pool(processes, _init_decryption, (key_index, password))
+
+	try:
+		for result in pool.imap_unordered(_decrypt_job, jobs):
+			yield result
+	finally:
+		pool.close()
+		pool.join()
+
+
+def _split(value):
+	''' Splits a CSV field into a list of values. '''
+
+	return [item for item in value.split(CSV_LIST_SEPARATOR) if item]
+
+
+def _as_list(value):
+	''' Returns a JSON value that is a single string or a list of strings as a list. '''
+
+	if isinstance(value, basestring):
+		return [value]
+
+	if not isinstance(value, list) or not all(isinstance(item, basestring) for item in value):
+		raise ValueError("Expected a string or a list of strings.")
+
+	return value
+
+
+def _get_certificate_store(certificates):
+	''' Returns a CertificateStore for the certificate paths and loads it only once per process. '''
+
+	key = tuple(sorted(certificates))
+
+	if key not in _certificate_stores:
+		store = x509.CertificateStore()
+		for certificate in key:
+			store.add_from_file(certificate)
+		_certificate_stores[key] = store
+
+	return _certificate_stores[key]
+
+
+def _encrypt_job(arguments):
+	''' Builds a single container in a worker process. '''
+
+	job, output_format, compression_level = arguments
+
+	container = CCEContainer()
+
+	try:
+		container.recipients = _get_certificate_store(job.certificates)
+
+		for path in job.files:
+			container.add(path)
+
+		_write_file(
+			job.output,
+			lambda handle: container.encrypt_to(
+				handle, output_format = output_format, compression_level = compression_level
+			)
+		)
+	except (IOError, OSError, ValueError) as error:
+		return BatchResult(job, str(error))
+	finally:
+		container.close()
+
+	return BatchResult(job, None)
+
+
+def _fan_out_job(arguments):
+	''' Encrypts the shared message for a single group of recipients in a worker process. '''
+
+	output, certificates, message, ending, content_type, cipher, output_format = arguments
+
+	def encrypt(handle):
+		recipients = [x509.load_certificate(certificate) for certificate in certificates]
+
+		with open(message, "rb") as message_handle:
+			writer = pkcs7.open_writer(handle, output_format)
+			envelope = pkcs7.EnvelopedDataWriter(writer, recipients, cipher, content_type = content_type)
+
+			for chunk in iter(lambda: message_handle.read(pkcs7.CHUNK_SIZE), ""):
+				envelope.write(chunk)
+
+			envelope.write(ending)
+			envelope.close()
+			writer.close()
+
+	try:
+		_write_file(output, encrypt)
+	except (IOError, OSError, ValueError) as error:
+		return BatchResult(output, str(error))
+
+	return BatchResult(output, None)
+
+
+def _write_file(path, write):
+	'''
+		Calls write with a temporary file next to path and replaces path with it once write
+		returns, so a failed job never leaves a partial container behind.
+	'''
+
+	temporary = "{0}.{1}.tmp".format(path, os.getpid())
+
+	try:
+		with open(temporary, "wb") as handle:
+			write(handle)
+	except:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+		raise
+
+	os.rename(temporary, path)
+
+
+def _init_decryption(key_index, password):
+	''' Sets up a worker process for decryption. '''
+
+	global _key_index, _password
+
+	_key_index = key_index
+	_password = password
+
+
+def _decrypt_job(arguments):
+	''' Decrypts and extracts a single container in a worker process. '''
+
+	path, target = arguments
+	container = None
+
+	try:
+		with open(path, "rb") as handle:
+			envelope = pkcs7.EnvelopedDataReader(pkcs7.open_reader(handle))
+			key_path, recipient_info = _key_index.find_recipient(envelope.recipient_infos)
+
+			if not key_path:
+				return BatchResult(path, "No key for any of the recipients.")
+
+			# The key is only tried with its own recipient, and the header is not read again.
+			decryptor = Decryptor()
+			decryptor.add_key(
+				_key_index.get_private_key(key_path, _password), certificate = (recipient_info.issuer, recipient_info.serial)
+			)
+			container = decryptor.decrypt(envelope)
+
+		# Fails if the directory was created since the targets were chosen.
+		os.mkdir(target)
+
+		# The containers are already spread over processes, so each one is written by a single thread.
+		extract.extract(container, target, threads = 1)
+	except (IOError, OSError, ValueError) as error:
+		return BatchResult(path, str(error))
+	finally:
+		if container is not None:
+			container.close()
+
+	return BatchResult(path, None)
@@ -26,11 +26,20 @@
 
 from __future__ import print_function
 
+import sys
 import os.path
 import argparse
 
+from opencce import mime
+from opencce import batch
+from opencce import backends
+from opencce import extract
+from opencce import pkcs7
+from opencce import x509
+from opencce.keys import KeyIndex
 from opencce.utils import Log
-from opencce.containers.CCEContainer import CCEContainer
+from opencce.stats import Stats
+from opencce.containers.CCEContainer import CCEContainer, Decryptor
 
 
 class OpenCCE(object):
@@ -46,8 +55,17 @@ class OpenCCE(object):
 
 		# Parse the arguments and run the correct method based on the result.
 		args = OpenCCE.parse_arguments()
+		args.statistics = Stats() if args.stats else None
+
 		args.func(args, log = Log(args.quiet))
 
+		# Statistics go to standard error, so they never mix with a container written to standard output.
+		if args.statistics and args.statistics.stages:
+			if args.stats_format == "json":
+				print(args.statistics.as_json(), file = sys.stderr)
+			else:
+				print(args.statistics.format(), file = sys.stderr)
+
 
 	@staticmethod
 	def encrypt(args, log):
@@ -64,6 +82,18 @@ class OpenCCE(object):
 				log.warn(error.message)
 
 		for path in args.files:
+			if args.recursive and os.path.isdir(path):
+				log.log("Adding directory: " + path)
+				count = container.add_tree(
+					path, directory = _get_tree_directory(path),
+					include = args.include, exclude = args.exclude
+				)
+				if count:
+					log.success()
+				else:
+					log.warn("No files found.")
+				continue
+
 			log.log("Adding file: " + path)
 			try:
 				container.add(path)
@@ -71,10 +101,23 @@ class OpenCCE(object):
 			except OSError as error:
 				log.warn(error.message)
 
-		with open(args.output, "wb") as handle:
-			log.log("Encrypting to " + args.output)
-			handle.write(container.encrypt())
-			log.success()
+		log.log("Encrypting to " + args.output)
+
+		compression_level = args.compression_level if args.compress else None
+
+		if args.output == "-":
+			container.encrypt_to(
+				sys.stdout, output_format = args.format, compression_level = compression_level,
+				stats = args.statistics, backend = args.backend, processes = args.processes
+			)
+		else:
+			with open(args.output, "wb") as handle:
+				container.encrypt_to(
+					handle, output_format = args.format, compression_level = compression_level,
+					stats = args.statistics, backend = args.backend, processes = args.processes
+				)
+
+		log.success()
 
 
 	@staticmethod
@@ -82,26 +125,300 @@ class OpenCCE(object):
 		''' Runs when the user uses the 'decrypt' positional argument. '''
 
 		log.log("Decrypting container: " + args.container_file[0])
-		with open(args.container_file[0], "r") as handle:
-			container = CCEContainer.load(handle, args.key[0], password = args.password)
+		decryptor = Decryptor()
+		for key in args.key:
+			decryptor.add_key(key, password = args.password)
+
+		with open(args.container_file[0], "rb") as handle:
+			container = decryptor.decrypt(
+				handle, spool_size = args.spool_size, patterns = args.only, stats = args.statistics,
+				backend = args.backend
+			)
+		log.success()
+
+		# Without a policy for existing files, we extract into a new directory.
+		if not args.existing:
+			log.log("Making sure that the extraction directory is clean: " + args.directory)
+			counter = 0
+			while os.path.exists(args.directory):
+				args.directory += str(counter)
+				counter += 1
+
+			os.mkdir(args.directory)
+			log.success()
+
+		results = extract.extract(
+			container, args.directory, threads = args.threads, policy = args.existing or extract.OVERWRITE,
+			fsync = args.fsync
+		)
+
+		for path, written in results:
+			log.log("Extracting file: " + os.path.relpath(path))
+			if written:
+				log.success()
+			else:
+				log.warn("File exists, skipped.")
+
+
+	@staticmethod
+	def batch_encrypt(args, log):
+		''' Runs when the user uses the 'batch-encrypt' positional argument. '''
+
+		log.log("Reading manifest: " + args.manifest[0])
+		with open(args.manifest[0], "r") as handle:
+			jobs = batch.read_manifest(handle)
 		log.success()
 
-		log.log("Making sure that the extraction directory is clean: " + args.directory)
-		counter = 0
-		while os.path.exists(args.directory):
-			args.directory += str(counter)
-			counter += 1
+		compression_level = args.compression_level if args.compress else None
+		failures = 0
+
+		for result in batch.encrypt_batch(
+			jobs, args.processes, output_format = args.format, compression_level = compression_level
+		):
+			log.log("Encrypting to " + result.job.output)
+			if result.error:
+				failures += 1
+				log.error(result.error)
+			else:
+				log.success()
+
+		log.print("{0} of {1} containers encrypted.".format(len(jobs) - failures, len(jobs)))
+
+		if failures:
+			sys.exit(1)
+
+
+	@staticmethod
+	def fan_out(args, log):
+		''' Runs when the user uses the 'fan-out' positional argument. '''
+
+		container = CCEContainer()
+
+		for path in args.files:
+			log.log("Adding file: " + path)
+			try:
+				if args.recursive and os.path.isdir(path):
+					container.add_tree(path, directory = _get_tree_directory(path))
+				else:
+					container.add(path)
+				log.success()
+			except OSError as error:
+				log.warn(error.message)
+
+		groups = []
+		for group in args.group:
+			output, _, paths = group.partition("=")
+			log.log("Loading recipients for " + output)
+
+			recipients = x509.CertificateStore()
+			for path in paths.split(","):
+				if os.path.isdir(path):
+					recipients.add_directory(path)
+				elif path:
+					recipients.add_from_file(path)
+
+			groups.append((output, recipients))
+			log.success()
+
+		compression_level = args.compression_level if args.compress else None
+		failures = 0
+
+		for result in batch.encrypt_fan_out(
+			container, groups, args.processes, output_format = args.format, compression_level = compression_level
+		):
+			log.log("Encrypting to " + result.job)
+			if result.error:
+				failures += 1
+				log.error(result.error)
+			else:
+				log.success()
+
+		log.print("{0} of {1} containers encrypted.".format(len(groups) - failures, len(groups)))
+
+		if failures:
+			sys.exit(1)
+
+
+	@staticmethod
+	def batch_decrypt(args, log):
+		''' Runs when the user uses the 'batch-decrypt' positional argument. '''
+
+		log.log("Indexing keys: " + args.keys)
+		key_index = KeyIndex.from_directory(args.keys, password = args.password)
+		log.success()
+		log.print("Found {0} keys with matching certificates.".format(len(key_index)))
+
+		failures = 0
+
+		for result in batch.decrypt_batch(
+			args.containers, key_index, args.directory, password = args.password, processes = args.processes
+		):
+			log.log("Decrypting container: " + result.job)
+			if result.error:
+				failures += 1
+				log.error(result.error)
+			else:
+				log.success()
+
+		log.print("{0} of {1} containers decrypted.".format(len(args.containers) - failures, len(args.containers)))
+
+		if failures:
+			sys.exit(1)
+
+
+	@staticmethod
+	def info(args, log):
+		''' Runs when the user uses the 'info' positional argument. Nothing is decrypted. '''
+
+		for path in args.containers:
+			with open(path, "rb") as handle:
+				head = handle.read(1024)
+				handle.seek(0)
+				envelope = pkcs7.EnvelopedDataReader(pkcs7.open_reader(handle))
+
+			print(path)
+			print("  Format:     " + pkcs7.detect_format(head))
+			print("  Cipher:     " + envelope.cipher)
+			print("  Compressed: " + ("yes" if envelope.is_compressed() else "no"))
+
+			for recipient_info in envelope.recipient_infos:
+				print("  Recipient:  " + pkcs7.format_name(recipient_info.issuer))
+				print("              Serial " + pkcs7.format_serial(recipient_info.serial))
+
+
+	@staticmethod
+	def list_files(args, log):
+		''' Runs when the user uses the 'list' positional argument. Files are not decoded. '''
+
+		decryptor = Decryptor()
+		for key in args.key:
+			decryptor.add_key(key, password = args.password)
+
+		with open(args.container_file[0], "rb") as handle:
+			for directory, filename, content_type, size in decryptor.list_files(handle, args.statistics, args.backend):
+				print("{0:>12}  {1:<32}  {2}".format(size, content_type, "/".join(directory + [filename])))
+
+
+	@staticmethod
+	def rekey(args, log):
+		''' Runs when the user uses the 'rekey' positional argument. The files are not encrypted again. '''
+
+		decryptor = Decryptor()
+		for key in args.key:
+			decryptor.add_key(key, password = args.password)
+
+		add = [OpenCCE._load_certificate(path) for path in args.add or []]
+		remove = [OpenCCE._load_certificate(path) for path in args.remove or []]
+
+		path = args.container_file[0]
+		output = args.output or path
+
+		log.log("Changing the recipients of " + path)
+
+		with open(path, "rb") as handle:
+			output_format = args.format or pkcs7.detect_format(handle.read(1024))
+			handle.seek(0)
+
+			if output == "-":
+				decryptor.rekey(handle, sys.stdout, add, remove, output_format, args.refresh)
+			else:
+				# The new container replaces the old one only when it is complete.
+				temporary = output + ".tmp"
+				try:
+					with open(temporary, "wb") as handle2:
+						decryptor.rekey(handle, handle2, add, remove, output_format, args.refresh)
+				except:
+					os.remove(temporary)
+					raise
+
+				os.rename(temporary, output)
 
-		os.mkdir(args.directory)
 		log.success()
 
-		for directory, filename, handle in container.export():
-			path = os.path.join(args.directory, *(directory + [filename]))
-			log.log("Extracting file: " + path)
-			with open(path, "wb") as handle2:
-				handle2.write(handle.read())
+
+	@staticmethod
+	def _load_certificate(path):
+		''' Loads a certificate file in PEM or DER format. '''
+
+		with open(path, "rb") as handle:
+			return x509.load_certificate(handle.read())
+
+
+	@staticmethod
+	def serve(args, log):
+		''' Runs when the user uses the 'serve' positional argument. Runs until it is interrupted. '''
+
+		# The HTTP server modules are only needed here.
+		from opencce import server
+
+		# Every local user can connect to a TCP port, so it is only opened with a token.
+		if not args.socket and not args.token_file:
+			log.log("Checking access: " + args.host)
+			log.error("A TCP port needs a --token-file, or use --socket.")
+			sys.exit(1)
+
+		# The token and everything else is sent in plain text.
+		if not args.socket and not args.allow_remote and not server.is_loopback(args.host):
+			log.log("Checking address: " + args.host)
+			log.error("Not a loopback address, use --allow-remote to listen on it anyway.")
+			sys.exit(1)
+
+		token = None
+
+		if args.token_file:
+			log.log("Reading token: " + args.token_file)
+			with open(args.token_file, "r") as handle:
+				token = handle.readline().strip()
+
+			if not token:
+				log.error("The token file is empty.")
+				sys.exit(1)
+
+			log.success()
+
+		service = server.Service(workers = args.workers, token = token)
+
+		for group in args.recipients or []:
+			name, _, paths = group.partition("=")
+			log.log("Loading recipients: " + name)
+			service.add_group(name, [path for path in paths.split(",") if path])
+			log.success()
+
+		for key in args.key or []:
+			log.log("Loading key: " + key)
+			service.add_key(key, password = args.password)
 			log.success()
 
+		if args.socket:
+			instance = server.UnixHTTPServer(args.socket, service, log)
+			log.print("Listening on " + args.socket)
+		else:
+			instance = server.HTTPServer((args.host, args.port), service, log)
+			log.print("Listening on http://{0}:{1}/".format(*instance.server_address))
+
+		try:
+			instance.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			instance.server_close()
+
+
+	@staticmethod
+	def convert(args, log):
+		''' Runs when the user uses the 'convert' positional argument. '''
+
+		log.log("Converting container {0} to {1}".format(args.container_file[0], args.format))
+
+		with open(args.container_file[0], "rb") as handle:
+			if args.output == "-":
+				pkcs7.convert(handle, sys.stdout, args.format)
+			else:
+				with open(args.output, "wb") as handle2:
+					pkcs7.convert(handle, handle2, args.format)
+
+		log.success()
+
 
 	@staticmethod
 	def parse_arguments():
@@ -118,27 +435,68 @@ class OpenCCE(object):
 			help   = "suppress all log messages"
 		)
 
+		parser.add_argument(
+			"--stats",
+			action  = "store_true",
+			help    = "print the time and bytes of each stage of encrypt, decrypt and list to standard error"
+		)
+
+		parser.add_argument(
+			"--stats-format",
+			choices = ["text", "json"],
+			help    = "format of the statistics printed by --stats (default: %(default)s)",
+			default = "text"
+		)
+
+		parser.add_argument(
+			"--backend",
+			choices = [backends.M2CRYPTO, backends.OPENSSL],
+			help    = "crypto backend for encrypt, decrypt and list (default: openssl to encrypt large "
+				"uncompressed containers if it is installed, m2crypto for everything else)"
+		)
+
+		# The format and compression options are shared by all commands that write new containers.
+		output_parser = argparse.ArgumentParser(add_help = False)
+
+		output_parser.add_argument(
+			"-f", "--format",
+			choices = pkcs7.FORMATS,
+			help    = "output format of the containers (only smime is compatible with the original CCE)",
+			default = pkcs7.FORMAT_SMIME
+		)
+
+		output_parser.add_argument(
+			"-C", "--compress",
+			action  = "store_true",
+			help    = "create compressed containers (this is NOT compatible with the original CCE)"
+		)
+
+		output_parser.add_argument(
+			"--compression-level",
+			type    = int,
+			choices = range(1, 10),
+			help    = "zlib compression level for compressed containers (default: %(default)s)",
+			default = pkcs7.DEFAULT_COMPRESSION_LEVEL,
+			metavar = "LEVEL"
+		)
+
 		# All main functions have their own subparser.
 		subparsers = parser.add_subparsers()
 
 		# This is the 'encrypt' parser.
-		encryption_parser = subparsers.add_parser("encrypt", help = "Encrypt files in a CCE container.")
+		encryption_parser = subparsers.add_parser(
+			"encrypt", help = "Encrypt files in a CCE container.", parents = [output_parser]
+		)
 
 		# The func parameter is later used to automatically call the correct method.
 		encryption_parser.set_defaults(func = OpenCCE.encrypt)
 
 		encryption_parser.add_argument(
 			"-O", "--output",
-			help    = "sets the filename of CCE container when encrypting",
+			help    = "sets the filename of CCE container when encrypting (use - for standard output)",
 			default = "Container.cce"
 		)
 
-		encryption_parser.add_argument(
-			"-C", "--compress",
-			action  = "store_true",
-			help    = "create a compressed container (this is NOT compatible with the original CCE)"
-		)
-
 		encryption_parser.add_argument(
 			"-c", "--certificates",
 			nargs    = "+",
@@ -147,6 +505,32 @@ class OpenCCE(object):
 			required = True
 		)
 
+		encryption_parser.add_argument(
+			"-j", "--processes",
+			type    = int,
+			help    = "wrap the content key for the recipients in this many worker processes (default: in this process)"
+		)
+
+		encryption_parser.add_argument(
+			"-r", "--recursive",
+			action  = "store_true",
+			help    = "add directories with all files below them"
+		)
+
+		encryption_parser.add_argument(
+			"--include",
+			action  = "append",
+			help    = "only add files whose relative path or name matches this glob pattern (may be given more than once)",
+			metavar = "PATTERN"
+		)
+
+		encryption_parser.add_argument(
+			"--exclude",
+			action  = "append",
+			help    = "skip files and directories that match this glob pattern (may be given more than once)",
+			metavar = "PATTERN"
+		)
+
 		encryption_parser.add_argument(
 			"files",
 			help = "files that should be stored and encrypted",
@@ -167,8 +551,8 @@ class OpenCCE(object):
 
 		decryption_parser.add_argument(
 			"-k", "--key",
-			nargs    = 1,
-			help     = "the key to be used for decryption",
+			action   = "append",
+			help     = "the key to be used for decryption (may be given more than once)",
 			required = True
 		)
 
@@ -184,4 +568,329 @@ class OpenCCE(object):
 			help    = "password for the key file, if needed"
 		)
 
+		decryption_parser.add_argument(
+			"--only",
+			action  = "append",
+			help    = "only extract files whose path or name matches this glob pattern (may be given more than once)",
+			metavar = "PATTERN"
+		)
+
+		decryption_parser.add_argument(
+			"--existing",
+			choices = extract.POLICIES,
+			help    = "extract into the directory even if it exists and overwrite or skip existing files"
+		)
+
+		decryption_parser.add_argument(
+			"-j", "--threads",
+			type    = int,
+			help    = "number of threads that write files (default: %(default)s)",
+			default = extract.DEFAULT_THREADS
+		)
+
+		decryption_parser.add_argument(
+			"--fsync",
+			action  = "store_true",
+			help    = "flush all extracted files to disk before exiting"
+		)
+
+		decryption_parser.add_argument(
+			"--spool-size",
+			type    = int,
+			help    = "decrypted files are kept in memory up to this many bytes in total, the rest is buffered on disk",
+			default = mime.DEFAULT_SPOOL_SIZE,
+			metavar = "BYTES"
+		)
+
+		# This is the 'batch-encrypt' parser.
+		batch_parser = subparsers.add_parser(
+			"batch-encrypt", help = "Encrypt many CCE containers in parallel as described by a manifest.",
+			parents = [output_parser]
+		)
+		batch_parser.set_defaults(func = OpenCCE.batch_encrypt)
+
+		batch_parser.add_argument(
+			"-j", "--processes",
+			type    = int,
+			help    = "number of worker processes (default: number of CPUs)"
+		)
+
+		batch_parser.add_argument(
+			"manifest",
+			nargs   = 1,
+			help    = "JSONL or CSV file with the columns output, files and certificates",
+			metavar = "MANIFEST"
+		)
+
+
+		# This is the 'fan-out' parser.
+		fan_out_parser = subparsers.add_parser(
+			"fan-out", help = "Encrypt the same files for many groups of recipients, one CCE container each.",
+			parents = [output_parser]
+		)
+		fan_out_parser.set_defaults(func = OpenCCE.fan_out)
+
+		fan_out_parser.add_argument(
+			"-g", "--group",
+			action   = "append",
+			help     = "a container and the certificates and certificate directories of its recipients "
+				"(may be given more than once)",
+			metavar  = "OUTPUT=PATH[,PATH...]",
+			required = True
+		)
+
+		fan_out_parser.add_argument(
+			"-j", "--processes",
+			type    = int,
+			help    = "number of worker processes (default: number of CPUs)"
+		)
+
+		fan_out_parser.add_argument(
+			"-r", "--recursive",
+			action  = "store_true",
+			help    = "add directories with all files below them"
+		)
+
+		fan_out_parser.add_argument(
+			"files",
+			help    = "files that should be stored and encrypted",
+			nargs   = "+",
+			metavar = "FILE"
+		)
+
+
+		# This is the 'batch-decrypt' parser.
+		batch_decryption_parser = subparsers.add_parser(
+			"batch-decrypt", help = "Decrypt many CCE containers in parallel with a directory of keys."
+		)
+		batch_decryption_parser.set_defaults(func = OpenCCE.batch_decrypt)
+
+		batch_decryption_parser.add_argument(
+			"-K", "--keys",
+			help     = "directory with private keys and the certificates that belong to them",
+			required = True
+		)
+
+		batch_decryption_parser.add_argument(
+			"-d", "--directory",
+			help    = "each container is extracted to a subdirectory of this directory",
+			default = "."
+		)
+
+		batch_decryption_parser.add_argument(
+			"-j", "--processes",
+			type    = int,
+			help    = "number of worker processes (default: number of CPUs)"
+		)
+
+		batch_decryption_parser.add_argument(
+			"-P", "--password",
+			help    = "password for the key files, if needed"
+		)
+
+		batch_decryption_parser.add_argument(
+			"containers",
+			nargs   = "+",
+			help    = "container files to be decrypted",
+			metavar = "CONTAINER"
+		)
+
+
+		# This is the 'info' parser.
+		info_parser = subparsers.add_parser(
+			"info", help = "Show the recipients of CCE containers without decrypting them."
+		)
+		info_parser.set_defaults(func = OpenCCE.info)
+
+		info_parser.add_argument(
+			"containers",
+			nargs   = "+",
+			help    = "container files to be inspected",
+			metavar = "CONTAINER"
+		)
+
+
+		# This is the 'list' parser.
+		list_parser = subparsers.add_parser("list", help = "List the files in a CCE container.")
+		list_parser.set_defaults(func = OpenCCE.list_files)
+
+		list_parser.add_argument(
+			"-k", "--key",
+			action   = "append",
+			help     = "the key to be used for decryption (may be given more than once)",
+			required = True
+		)
+
+		list_parser.add_argument(
+			"-P", "--password",
+			help    = "password for the key file, if needed"
+		)
+
+		list_parser.add_argument(
+			"container_file",
+			nargs    = 1,
+			help     = "container file to be listed",
+			metavar  = "CONTAINER"
+		)
+
+
+		# This is the 'rekey' parser.
+		rekey_parser = subparsers.add_parser(
+			"rekey", help = "Add or remove recipients of a CCE container without encrypting its files again."
+		)
+		rekey_parser.set_defaults(func = OpenCCE.rekey)
+
+		rekey_parser.add_argument(
+			"-k", "--key",
+			action   = "append",
+			help     = "a key of a current recipient (may be given more than once)",
+			required = True
+		)
+
+		rekey_parser.add_argument(
+			"-P", "--password",
+			help    = "password for the key file, if needed"
+		)
+
+		rekey_parser.add_argument(
+			"-a", "--add",
+			action  = "append",
+			help    = "certificate of a recipient to add (may be given more than once)",
+			metavar = "CERTIFICATE"
+		)
+
+		rekey_parser.add_argument(
+			"-x", "--remove",
+			action  = "append",
+			help    = "certificate of a recipient to remove (may be given more than once)",
+			metavar = "CERTIFICATE"
+		)
+
+		rekey_parser.add_argument(
+			"--refresh",
+			action  = "store_true",
+			help    = "also update the certificate listing inside the container (not for compressed containers)"
+		)
+
+		rekey_parser.add_argument(
+			"-f", "--format",
+			choices = pkcs7.FORMATS,
+			help    = "format of the new container (default: the format of CONTAINER)"
+		)
+
+		rekey_parser.add_argument(
+			"-O", "--output",
+			help    = "sets the filename of the new container (use - for standard output, default: replace CONTAINER)"
+		)
+
+		rekey_parser.add_argument(
+			"container_file",
+			nargs    = 1,
+			help     = "container file to be changed",
+			metavar  = "CONTAINER"
+		)
+
+
+		# This is the 'serve' parser.
+		serve_parser = subparsers.add_parser(
+			"serve", help = "Keep certificates and keys loaded and encrypt or decrypt containers over HTTP."
+		)
+		serve_parser.set_defaults(func = OpenCCE.serve)
+
+		serve_parser.add_argument(
+			"-r", "--recipients",
+			action  = "append",
+			help    = "a named group of recipients made of certificates and certificate directories "
+				"(may be given more than once)",
+			metavar = "NAME=PATH[,PATH...]"
+		)
+
+		serve_parser.add_argument(
+			"-k", "--key",
+			action  = "append",
+			help    = "a key to be used for decryption (may be given more than once)"
+		)
+
+		serve_parser.add_argument(
+			"-P", "--password",
+			help    = "password for the key files, if needed"
+		)
+
+		serve_parser.add_argument(
+			"-s", "--socket",
+			help    = "listen on this Unix socket instead of a TCP port"
+		)
+
+		serve_parser.add_argument(
+			"--host",
+			help    = "address to listen on, only loopback addresses are allowed without --allow-remote "
+				"(default: %(default)s)",
+			default = "127.0.0.1"
+		)
+
+		serve_parser.add_argument(
+			"--allow-remote",
+			action  = "store_true",
+			help    = "allow --host to be an address that other machines can connect to (the token is sent "
+				"in plain text, so anyone who can read the traffic can use the loaded keys)"
+		)
+
+		serve_parser.add_argument(
+			"--token-file",
+			help    = "require requests to send the first line of this file in an 'Authorization: Bearer' "
+				"header (required for TCP ports, which every local user can connect to)",
+			metavar = "FILE"
+		)
+
+		serve_parser.add_argument(
+			"-p", "--port",
+			type    = int,
+			help    = "TCP port to listen on (default: %(default)s)",
+			default = 8573
+		)
+
+		serve_parser.add_argument(
+			"-j", "--workers",
+			type    = int,
+			help    = "number of jobs that run at the same time (default: %(default)s)",
+			default = 4
+		)
+
+
+		# This is the 'convert' parser.
+		conversion_parser = subparsers.add_parser(
+			"convert", help = "Convert a CCE container to another format without decrypting it."
+		)
+		conversion_parser.set_defaults(func = OpenCCE.convert)
+
+		conversion_parser.add_argument(
+			"-f", "--format",
+			choices  = pkcs7.FORMATS,
+			help     = "output format of the container",
+			required = True
+		)
+
+		conversion_parser.add_argument(
+			"-O", "--output",
+			help     = "sets the filename of the converted container (use - for standard output)",
+			required = True
+		)
+
+		conversion_parser.add_argument(
+			"container_file",
+			nargs    = 1,
+			help     = "container file to be converted",
+			metavar  = "CONTAINER"
+		)
+
 		return parser.parse_args()
+
+
+
+def _get_tree_directory(path):
+	''' Returns the name of the directory that holds the files of a directory tree in a container. '''
+
+	# Relative paths like "." or ".." are named after the directory they point to.
+	name = os.path.basename(os.path.abspath(path))
+
+	return "" if name in (os.curdir, os.pardir) else name
@@ -24,39 +24,141 @@
 ##
 
 import os.path
+import stat
+import mmap
+import errno
+import fnmatch
+import tempfile
+import contextlib
 import getpass
 
-import M2Crypto.BIO
-import M2Crypto.SMIME
-import M2Crypto.X509
-import M2Crypto.EVP
-
 from StringIO import StringIO
-from collections import defaultdict
 
-from email.parser import Parser
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from email.mime.audio import MIMEAudio
-from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
+try:
+	from scandir import walk
+except ImportError:
+	from os import walk
 
 from opencce import x509
-from opencce.utils import Utils
+from opencce import backends
+from opencce import background
+from opencce import pkcs7
+from opencce import mime
+from opencce.stats import NO_STATS
+from opencce.utils import Utils, ChunkReader, LazyModule, MIMETYPE_HEADER_SIZE
+
+
+# These modules take long to import and are not needed by every command, so they are imported on first use.
+M2Crypto = LazyModule("M2Crypto", "M2Crypto.BIO", "M2Crypto.RSA", "M2Crypto.SMIME", "M2Crypto.EVP")
+email = LazyModule("email", "email.parser")
 
 
 DEFAULT_CIPHER_STRING = "aes_256_cbc"
 
+# The number of threads that check files and guess their MIME types in add_tree.
+DEFAULT_SCAN_THREADS = 8
+
+# Files of at least this size are read through a memory map instead of read calls.
+MMAP_MIN_SIZE = 4 * 1024 * 1024
+
+# Main types that are kept when building a MIME part. Everything else is sent as application/octet-stream.
+MIME_MAIN_TYPES = ("application", "audio", "image", "text")
+
 
 class CCEContainerFile(object):
-	''' Holds a single file by reference along with some container meta data. '''
+	'''
+		Holds a single file along with some container meta data. Files are either held by path
+		and only opened while they are read, or by an already open handle.
+	'''
 
-	def __init__(self, handle, name, directory):
+	def __init__(self, handle, name, directory, path = None, mimetype = None):
 		self.handle = handle
+		self.path = path
 		self.name = name
 
-		# Prevent against relative directory changes by disallowing "../"
-		self.directory = directory.replace("../", "")
+		# The main and subtype of the file, if it is already known.
+		self.mimetype = mimetype
+
+		# Prevent against relative directory changes by dropping "." and ".." components.
+		self.directory = "/".join(
+			component for component in directory.replace("\\", "/").split("/") if component not in ("", ".", "..")
+		)
+
+
+	@contextlib.contextmanager
+	def open(self):
+		'''
+			Context manager that yields a handle positioned at the start of the file. Large
+			files that are held by path are memory mapped, so they are read from the page
+			cache without copying them into a buffer first.
+		'''
+
+		if self.handle is not None:
+			self.handle.seek(0)
+			yield self.handle
+			self.handle.seek(0)
+		else:
+			with open(self.path, "rb") as handle:
+				mapped = _map_file(handle)
+
+				if mapped is None:
+					yield handle
+				else:
+					try:
+						yield mapped
+					finally:
+						mapped.close()
+
+
+	def get_size(self):
+		''' Returns the size of the file in bytes. '''
+
+		if self.handle is None:
+			return os.path.getsize(self.path)
+
+		self.handle.seek(0, os.SEEK_END)
+		size = self.handle.tell()
+		self.handle.seek(0)
+
+		return size
+
+
+
+class _LazyFile(object):
+	''' A file that is opened for reading when it is first used, so exporting many files does not open them all. '''
+
+	def __init__(self, path):
+		self.path = path
+		self.handle = None
+		self.closed = False
+
+
+	def __getattr__(self, name):
+		if self.handle is None:
+			if self.closed:
+				raise ValueError("I/O operation on closed file")
+			self.handle = open(self.path, "rb")
+
+		return getattr(self.handle, name)
+
+
+	def __iter__(self):
+		return iter(self.__getattr__("readline"), "")
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+	def close(self):
+		self.closed = True
+
+		if self.handle is not None:
+			self.handle.close()
 
 
 
@@ -90,10 +192,75 @@ class CCEContainer(set):
 
 		'''
 
+		# The file is only opened when the container is written, but missing files should fail here.
+		if os.path.isdir(path):
+			raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+
+		os.stat(path)
+
 		name = os.path.basename(path)
-		handle = open(path, "r")
 
-		super(CCEContainer, self).add(CCEContainerFile(handle, name, directory))
+		super(CCEContainer, self).add(CCEContainerFile(None, name, directory, path = path))
+
+
+	def add_tree(self, root, directory = "", include = None, exclude = None, threads = DEFAULT_SCAN_THREADS):
+		'''
+			Adds all files below root and keeps their hierarchy relative to root below directory.
+			Files are only added if their relative path or name matches one of the glob patterns
+			in include (if given) and none of the patterns in exclude. Directories that match
+			exclude are skipped entirely. Files are checked and their MIME types are guessed in
+			a pool of threads. Returns the number of files that were added.
+
+
+			Example
+			-------
+
+			# add project/src/main.c as src/main.c, but skip all object files
+			container.add_tree("project", exclude = ["*.o"])
+
+		'''
+
+		candidates = []
+
+		for current, directories, filenames in walk(root):
+			relative = os.path.relpath(current, root)
+			relative = "" if relative == os.curdir else relative.replace(os.sep, "/")
+			target = "/".join(filter(None, [directory, relative]))
+
+			# Pruning the list in place stops the walk from descending into excluded directories.
+			directories[:] = [
+				name for name in directories
+				if not _matches("/".join(filter(None, [relative, name])), exclude)
+			]
+
+			for name in filenames:
+				path = "/".join(filter(None, [relative, name]))
+
+				if include and not _matches(path, include):
+					continue
+				if _matches(path, exclude):
+					continue
+
+				candidates.append((os.path.join(current, name), name, target))
+
+		from multiprocessing.pool import ThreadPool
+
+		pool = ThreadPool(threads)
+
+		try:
+			scanned = pool.map(_scan_file, candidates)
+		finally:
+			pool.close()
+			pool.join()
+
+		added = 0
+
+		for cce_file in scanned:
+			if cce_file:
+				super(CCEContainer, self).add(cce_file)
+				added += 1
+
+		return added
 
 
 	def add_stream(self, handle, name, directory = ""):
@@ -111,145 +278,614 @@ class CCEContainer(set):
 	def get_message(self):
 		''' Returns all files in this container as MIME message instance. '''
 
-		# Since we can add multiple files, this must be a multipart message.
-		message = MIMEMultipart()
+		return email.parser.Parser().parsestr(str(self))
+
+
+	def encrypt(
+		self, cipher = DEFAULT_CIPHER_STRING, output_format = pkcs7.FORMAT_SMIME, compression_level = None,
+		stats = None, backend = None, processes = None
+	):
+		'''
+			Performs the encryption and returns the PKCS#7 message as a string. The output format
+			is either S/MIME (compatible with the original CCE), binary DER or PEM. If a
+			compression_level is given, the message is compressed before it is encrypted, which
+			is NOT compatible with the original CCE. If a opencce.stats.Stats instance is given,
+			the time and bytes of each stage are added to it. See encrypt_to() for the backend
+			and processes.
+		'''
+
+		output = StringIO()
+		self.encrypt_to(output, cipher, output_format, compression_level, stats, backend, processes)
+
+		if output_format == pkcs7.FORMAT_SMIME:
+			return output.getvalue().strip()
+
+		return output.getvalue()
+
+
+	def write_message(self, output, stats = NO_STATS):
+		'''
+			Writes all files and the certificate store to output as a MIME message. Files are
+			encoded one chunk at a time, so only a single chunk is held in memory.
+		'''
+
+		boundary = self.write_files(output, stats = stats)
+
+		# Generate and append the certificate store.
+		_write_certificate_store(output, boundary, stats.source(self.recipients.get_archive()))
+
+
+	def write_files(self, output, boundary = None, stats = NO_STATS):
+		'''
+			Writes the headers and all files of the MIME message to output, but not the
+			certificate store that ends it (see write_certificate_store). Returns the boundary,
+			which is generated unless one is given.
+		'''
+
+		if boundary is None:
+			import uuid
+
+			boundary = "opencce-" + uuid.uuid4().hex
+
+		output.write("Content-Type: multipart/mixed; boundary=\"{0}\"\r\n".format(boundary))
+		output.write("MIME-Version: 1.0\r\n\r\n")
 
-		# Add all files to the message.
 		for cce_file in self:
-			# Try to guess main and subtypes of the file.
-			mtype, stype = Utils.get_mimetype(cce_file.name, cce_file.handle.read(1024))
-			cce_file.handle.seek(0)
-
-			# Mapping from main type to the correct Message class. Default is application/octet-stream.
-			tmap = defaultdict(
-				lambda: (MIMEApplication, "octet-stream"),
-				{
-					"application": (MIMEApplication, stype),
-					"audio":       (MIMEAudio,       stype),
-					"image":       (MIMEImage,       stype),
-					"text":        (MIMEText,        stype)
-				}
-			)
+			with cce_file.open() as handle:
+				handle = stats.source(handle)
 
-			mime_generator, stype = tmap[mtype]
+				# Try to guess main and subtypes of the file. The header is written as part of the payload.
+				header = handle.read(MIMETYPE_HEADER_SIZE)
+				mtype, stype = cce_file.mimetype or Utils.get_mimetype(cce_file.name, header)
 
-			# Generate the message part from the file
-			part = mime_generator(cce_file.handle.read(),	stype)
-			cce_file.handle.seek(0)
+				if mtype not in MIME_MAIN_TYPES:
+					mtype, stype = "application", "octet-stream"
 
-			# Assemble the file name from directory and basename.
-			fname = "/".join([cce_file.directory, cce_file.name])
+				# Assemble the file name from directory and basename.
+				fname = "/".join([cce_file.directory, cce_file.name])
 
-			# Add the file name to the headers of the MIME part.
-			part.add_header("Content-Disposition", "attachment", filename = fname)
-			part.set_param("name", fname)
+				mime.write_part(output, boundary, handle, mtype + "/" + stype, fname, header = header)
 
-			# Attach the message part to the main message.
-			message.attach(part)
+		return boundary
 
-		return message
 
+	@staticmethod
+	def write_certificate_store(output, boundary, recipients):
+		''' Writes the archive of the CertificateStore recipients as the last part of a MIME message. '''
 
-	def encrypt(self, cipher = DEFAULT_CIPHER_STRING):
-		''' Performs the encryption and returns the PKCS#7 message as a string. '''
+		_write_certificate_store(output, boundary, recipients.get_archive())
 
-		message = self.get_message()
 
-		# Generate and append the certificate store.
-		part = MIMEApplication(self.recipients.get_archive().read(), "zip")
-		part.add_header("Content-Disposition", "attachment", filename = x509.CERTIFICATE_STORE_NAME)
-		part.set_param("name", x509.CERTIFICATE_STORE_NAME)
-		message.attach(part)
+	def encrypt_to(
+		self, output_handle, cipher = DEFAULT_CIPHER_STRING, output_format = pkcs7.FORMAT_SMIME,
+		compression_level = None, stats = None, backend = None, processes = None
+	):
+		'''
+			Performs the encryption and writes the PKCS#7 message to output_handle while it is
+			being produced. Memory usage does not depend on the size of the files. If a
+			compression_level is given, the message is compressed with zlib before it is encrypted.
+			If a opencce.stats.Stats instance is given, the time and bytes of the stages mime,
+			compress, cipher, key_wrap and output are added to it. The backend is passed to
+			opencce.backends.get_backend() along with the total size of the files. For very many
+			recipients, the content key can be wrapped in a number of processes (see
+			opencce.pkcs7.get_recipient_infos()).
+		'''
+
+		stats = stats or NO_STATS
+
+		if not isinstance(backend, backends.Backend):
+			size = sum(cce_file.get_size() for cce_file in self)
+			backend = backends.get_backend(backend, size, compressed = compression_level is not None)
+
+		with stats.stage("output"):
+			writer = stats.writer("output", pkcs7.open_writer(stats.sink(output_handle), output_format))
 
-		# Write the message to a memory buffer.
-		buf = M2Crypto.BIO.MemoryBuffer(message.as_string())
+		content_type = pkcs7.OID_DATA if compression_level is None else pkcs7.OID_COMPRESSED_DATA
 
-		# Prepare the SMIME message and set the recipient certificates.
-		smime = M2Crypto.SMIME.SMIME()
-		smime.set_x509_stack(self.recipients.as_stack())
+		# The content encryption key is wrapped for every recipient when the envelope is created.
+		with stats.stage("key_wrap"):
+			envelope = backend.open_encryptor(
+				writer, self.recipients, cipher, content_type = content_type, processes = processes
+			)
+
+		envelope = stats.writer("cipher", envelope)
+
+		if compression_level is None:
+			with stats.stage("mime"):
+				self.write_message(envelope, stats)
+		else:
+			with stats.stage("compress"):
+				compressor = stats.writer("compress", pkcs7.CompressedDataWriter(envelope, compression_level))
 
-		# Set the cipher string and encrypt the memory buffer.
-		smime.set_cipher(M2Crypto.SMIME.Cipher(cipher))
-		pkcs7 = smime.encrypt(buf)
+			with stats.stage("mime"):
+				self.write_message(compressor, stats)
 
-		# Prepare the output buffer and write the encrypted PKCS#7 message.
-		out = M2Crypto.BIO.MemoryBuffer()
-		smime.write(out, pkcs7)
+			compressor.close()
 
-		return out.read().strip()
+		envelope.close()
+		writer.close()
+
+
+	def encrypt_async(self, output_handle, executor = None, **kwargs):
+		'''
+			Runs encrypt_to() on executor (see opencce.background.submit) and returns a handle
+			to the result, so the caller is not blocked. The keyword arguments are passed on
+			to encrypt_to(). If output_handle is a opencce.background.Pipe, it is closed when
+			the encryption ends, so readers do not wait forever if it fails.
+		'''
+
+		def run():
+			try:
+				self.encrypt_to(output_handle, **kwargs)
+			finally:
+				if isinstance(output_handle, background.Pipe):
+					output_handle.close()
+
+		return background.submit(executor, run)
 
 
 	def export(self):
-		''' Generator that yields directory, filename and a handle to each file. '''
+		'''
+			Generator that yields directory, filename and a handle to each file. Files that were
+			added by path are only opened when their handle is first used, and the caller should
+			close those handles.
+		'''
 
 		for cce_file in self:
 			# Path is delivered in components, ready for os.path.join.
 			path = cce_file.directory.strip("/").split("/")
 			filename = cce_file.name
 
-			yield path, filename, cce_file.handle
-
-		# Reset all file handles to zero.
-		for cce_file in self:
-			cce_file.handle.seek(0)
+			if cce_file.handle is None:
+				yield path, filename, _LazyFile(cce_file.path)
+			else:
+				cce_file.handle.seek(0)
+				yield path, filename, cce_file.handle
 
 
 	def __str__(self):
 		''' Returns the unencrypted MIME message as a string. '''
 
-		return self.get_message().as_string()
+		output = StringIO()
+		self.write_message(output)
+
+		return output.getvalue()
 
 
 	def close(self):
 		''' Close the CCEContainer instance. All further behavior is unspecified. '''
 
 		for cce_file in self:
-			cce_file.handle.close()
+			if cce_file.handle is not None:
+				cce_file.handle.close()
 
 
 	@staticmethod
-	def load(input_stream, key, password = None):
-		''' Loads a CCE container from an input stream. '''
+	def load(input_stream, key, password = None, stats = None):
+		'''
+			Loads a CCE container in S/MIME, DER or PEM format from an input stream. If a
+			opencce.stats.Stats instance is given, the time and bytes of the stages input, key,
+			parse, decrypt, decompress and mime are added to it.
+		'''
 
-		# If we don't get a password for the key, we prepare an interactive prompt.
-		if not password:
-			password_callback = lambda x: getpass.getpass("Password for " + key + ": ")
-		else:
-			password_callback = lambda x: password
+		stats = stats or NO_STATS
+		password_callback = _get_password_callback(key, password)
 
 		# Read the message and prepare the SMIME structures.
-		buf = M2Crypto.BIO.MemoryBuffer(input_stream.read())
-		smime = M2Crypto.SMIME.SMIME()
+		with stats.stage("input"):
+			data = input_stream.read()
+			buf = M2Crypto.BIO.MemoryBuffer(data)
+			smime = M2Crypto.SMIME.SMIME()
+
+		stats.count("input", len(data), len(data))
 
 		# Try to load the key.
+		with stats.stage("key"):
+			try:
+				smime.load_key(key, callback = password_callback)
+			except M2Crypto.EVP.EVPError as error:
+				raise IOError(error)
+
+		# Load the PKCS#7 message in the format we detect and try to decrypt it.
+		input_format = pkcs7.detect_format(data)
+
+		with stats.stage("parse"):
+			try:
+				if input_format == pkcs7.FORMAT_DER:
+					envelope = M2Crypto.SMIME.load_pkcs7_bio_der(buf)
+				elif input_format == pkcs7.FORMAT_PEM:
+					envelope = M2Crypto.SMIME.load_pkcs7_bio(buf)
+				else:
+					envelope, _ = M2Crypto.SMIME.smime_load_pkcs7_bio(buf)
+			except M2Crypto.SMIME.PKCS7_Error as error:
+				raise IOError(error)
+
+		with stats.stage("decrypt"):
+			try:
+				message = smime.decrypt(envelope)
+			except M2Crypto.SMIME.PKCS7_Error as error:
+				raise IOError(error)
+
+		stats.count("decrypt", len(data), len(message))
+
+		# Compressed containers are inflated transparently.
+		if pkcs7.is_compressed(message):
+			compressed = len(message)
+
+			with stats.stage("decompress"):
+				message = "".join(pkcs7.decompress(ChunkReader([message])))
+
+			stats.count("decompress", compressed, len(message))
+
+		instance = CCEContainer()
+
+		# Extract each message part in turn and retrieve the payload and filename.
+		with stats.stage("mime"):
+			for part in email.parser.Parser().parsestr(message).get_payload():
+				payload = part.get_payload(decode = True)
+				instance._add_part(part.get_param("name"), StringIO(payload))
+				stats.count("mime", bytes_out = len(payload))
+
+		stats.count("mime", bytes_in = len(message))
+
+		return instance
+
+
+	@staticmethod
+	def load_stream(
+		input_stream, key, password = None, spool_size = mime.DEFAULT_SPOOL_SIZE, stats = None, backend = None
+	):
+		'''
+			Loads a CCE container in S/MIME, DER or PEM format from an input stream without reading
+			it into memory at once. The container is decrypted and parsed while it is read and each
+			file is decoded into a temporary file. All files together are kept in memory up to
+			spool_size bytes, the rest is written to disk.
+			The key is either a filename or an already loaded M2Crypto RSA private key. See
+			Decryptor.decrypt() for the stages that are added to stats and the backend.
+		'''
+
+		decryptor = Decryptor()
+		decryptor.add_key(key, password = password)
+
+		return decryptor.decrypt(input_stream, spool_size = spool_size, stats = stats, backend = backend)
+
+
+	@staticmethod
+	def load_async(input_stream, key, password = None, executor = None, **kwargs):
+		'''
+			Runs load_stream() on executor (see opencce.background.submit) and returns a handle
+			to the result, which is the loaded container. The input_stream may be a
+			opencce.background.Pipe that the caller fills while the container is decrypted. It
+			is aborted if the decryption fails, so the caller does not wait forever to write.
+		'''
+
+		def run():
+			try:
+				return CCEContainer.load_stream(input_stream, key, password, **kwargs)
+			except:
+				if isinstance(input_stream, background.Pipe):
+					input_stream.abort()
+				raise
+
+		return background.submit(executor, run)
+
+
+	def _add_part(self, fname, stream):
+		''' Adds a decoded message part using the file name stored in the message. '''
+
+		struct = fname.strip("/").split("/")
+		name = struct[-1]
+
+		if name == x509.CERTIFICATE_STORE_NAME:
+			# We want to deal with the CertificateStore separately.
+			self.recipients = x509.CertificateStore.load(stream)
+		else:
+			# Add all other files to the container.
+			directory = "/".join(struct[0:-1])
+			self.add_stream(stream, name, directory = directory)
+
+
+
+class Decryptor(object):
+	'''
+		Holds one or more private keys that are loaded and unlocked only once and decrypts any
+		number of containers with them.
+
+
+		Example
+		-------
+
+		decryptor = Decryptor()
+		decryptor.add_key("alice.pem", certificate = "alice.cer")
+		decryptor.add_key("bob.pem", password = "secret")
+
+		for filename in filenames:
+			with open(filename, "rb") as handle:
+				container = decryptor.decrypt(handle)
+
+	'''
+
+	def __init__(self):
+		self.keys = []
+		self.index = {}
+
+
+	def add_key(self, key, password = None, certificate = None):
+		'''
+			Adds a private key, which is either a filename or a loaded M2Crypto RSA key. If the
+			filename of the matching certificate (or its issuer and serial number as returned by
+			pkcs7.get_issuer_and_serial) is given, containers for it are routed to this key
+			directly instead of trying every key.
+		'''
+
+		if not isinstance(key, M2Crypto.RSA.RSA):
+			# Try to load the key.
+			try:
+				key = M2Crypto.RSA.load_key(key, callback = _get_password_callback(key, password))
+			except M2Crypto.RSA.RSAError as error:
+				raise IOError(error)
+
+		if isinstance(certificate, tuple):
+			self.index[certificate] = key
+		elif certificate:
+			with open(certificate, "rb") as handle:
+				self.index[pkcs7.get_issuer_and_serial(x509.load_certificate(handle.read()))] = key
+		else:
+			self.keys.append(key)
+
+
+	def decrypt(
+		self, input_stream, spool_size = mime.DEFAULT_SPOOL_SIZE, patterns = None, stats = None, backend = None
+	):
+		'''
+			Loads a CCE container from an input stream like CCEContainer.load_stream(). If glob
+			patterns are given, only files whose path or name matches one of them are decoded,
+			all other files are skipped. If a opencce.stats.Stats instance is given, the time
+			and bytes of the stages input, key_unwrap, decipher, decompress and mime are added
+			to it. See open_message() for the input stream and the backend.
+		'''
+
+		stats = stats or NO_STATS
+
+		def select(headers):
+			fname = headers.get_param("name").strip("/")
+			return fname == x509.CERTIFICATE_STORE_NAME or _matches(fname, patterns)
+
+		instance = CCEContainer()
+		parts = mime.iter_parts(
+			self.open_message(input_stream, stats, backend), spool_size, select if patterns else None
+		)
+
+		for headers, handle in stats.iterate("mime", parts):
+			handle.seek(0, os.SEEK_END)
+			stats.count("mime", bytes_out = handle.tell())
+			handle.seek(0)
+
+			instance._add_part(headers.get_param("name"), handle)
+
+		return instance
+
+
+	def list_files(self, input_stream, stats = None, backend = None):
+		'''
+			Generator that yields directory, filename, MIME type and size of each file in a
+			CCE container from an input stream without decoding the files.
+		'''
+
+		for headers, size in mime.iter_headers(self.open_message(input_stream, stats, backend)):
+			struct = headers.get_param("name").strip("/").split("/")
+
+			if struct[-1] != x509.CERTIFICATE_STORE_NAME:
+				yield struct[:-1], struct[-1], headers.get_content_type(), size
+
+
+	def open_message(self, input_stream, stats = None, backend = None):
+		'''
+			Returns a file like object that reads the decrypted (and inflated) MIME message of a
+			CCE container from an input stream. The key is unwrapped right away, everything
+			else is read and decrypted while the message is read. Instead of a stream, a
+			pkcs7.EnvelopedDataReader whose header was already read can be given, then the
+			input stage is not counted in stats. The backend is passed to
+			opencce.backends.get_backend(), which chooses M2Crypto if none is given, since it
+			streams large containers and openssl does not when decrypting.
+		'''
+
+		stats = stats or NO_STATS
+		backend = backends.get_backend(backend)
+
+		if isinstance(input_stream, pkcs7.EnvelopedDataReader):
+			envelope = input_stream
+		else:
+			with stats.stage("input"):
+				reader = stats.reader("input", pkcs7.open_reader(stats.source(input_stream)))
+				envelope = pkcs7.EnvelopedDataReader(reader)
+
+		with stats.stage("key_unwrap"):
+			message = backend.decrypt(envelope, self._get_keys(envelope))
+
+		# The header and the start of the content were already read, so we count what the cipher consumed.
+		message = stats.iterate("decipher", message, consumed = lambda: envelope.content_read)
+
+		# Compressed containers are inflated transparently.
+		if envelope.is_compressed():
+			message = stats.iterate("decompress", pkcs7.decompress(ChunkReader(message)))
+
+		return ChunkReader(message)
+
+
+	def rekey(
+		self, input_stream, output, add = (), remove = (), output_format = pkcs7.FORMAT_SMIME, refresh = False
+	):
+		'''
+			Copies a CCE container from input_stream to output and adds or removes recipients,
+			given as M2Crypto X509 certificates. Only the content key is unwrapped with one of
+			our keys and wrapped for the new recipients, the encrypted content is copied as it
+			is. If refresh is True, the recipient certificate listing inside the container is
+			updated too. Only the listing at the end of the content is encrypted again, but the
+			content is decrypted once to find it. This is not possible for compressed containers.
+		'''
+
+		envelope = pkcs7.EnvelopedDataReader(pkcs7.open_reader(input_stream))
+		content_key = envelope.get_content_key(*self._get_keys(envelope))
+
+		removed = set(pkcs7.get_issuer_and_serial(certificate) for certificate in remove)
+		kept = [
+			recipient_info for recipient_info in envelope.recipient_infos
+			if (recipient_info.issuer, recipient_info.serial) not in removed
+		]
+
+		# Recipients that already have the key are left as they are.
+		present = set((recipient_info.issuer, recipient_info.serial) for recipient_info in kept)
+		added = [certificate for certificate in add if pkcs7.get_issuer_and_serial(certificate) not in present]
+
+		if refresh and envelope.is_compressed():
+			raise IOError("The certificate listing of a compressed container can not be refreshed.")
+
+		content_type = pkcs7.OID_COMPRESSED_DATA if envelope.is_compressed() else pkcs7.OID_DATA
+
+		writer = pkcs7.open_writer(output, output_format)
+		rekeyed = pkcs7.EnvelopedDataWriter(
+			writer, added, envelope.cipher, content_type = content_type, key = content_key, iv = envelope.iv,
+			recipient_infos = [recipient_info.der for recipient_info in kept]
+		)
+
+		if refresh:
+			_refresh_certificate_store(envelope, content_key, rekeyed, add, remove)
+		else:
+			for chunk in envelope.iter_content():
+				rekeyed.write_encrypted(chunk)
+
+		rekeyed.close()
+		writer.close()
+
+
+	def _get_keys(self, envelope):
+		'''
+			Returns our keys for a pkcs7.EnvelopedDataReader. Keys with a matching certificate go
+			first, paired with their RecipientInfo, so only that one is decrypted with them. Keys
+			without a certificate are tried with every RecipientInfo.
+		'''
+
+		keys = [
+			(self.index[(recipient_info.issuer, recipient_info.serial)], recipient_info)
+			for recipient_info in envelope.recipient_infos
+			if (recipient_info.issuer, recipient_info.serial) in self.index
+		]
+
+		return keys + self.keys
+
+
+
+def _matches(path, patterns):
+	''' Returns True if the relative path or its last component matches one of the glob patterns. '''
+
+	name = path.rsplit("/", 1)[-1]
+
+	return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns or [])
+
+
+def _scan_file(candidate):
+	''' Returns a CCEContainerFile for a regular file found by add_tree, or None for anything else. '''
+
+	path, name, directory = candidate
+
+	try:
+		if not stat.S_ISREG(os.stat(path).st_mode):
+			return None
+	except OSError:
+		return None
+
+	return CCEContainerFile(None, name, directory, path = path, mimetype = Utils.get_mimetype(path))
+
+
+def _map_file(handle):
+	''' Returns a read only memory map of a file of at least MMAP_MIN_SIZE bytes, or None. '''
+
+	if os.fstat(handle.fileno()).st_size < MMAP_MIN_SIZE:
+		return None
+
+	# Some file systems do not support memory maps, and 32 bit systems can not map large files.
+	try:
+		return mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ)
+	except (mmap.error, ValueError, OverflowError):
+		return None
+
+
+def _write_certificate_store(output, boundary, handle):
+	''' Writes the certificate store archive from handle as the last part of a MIME message. '''
+
+	mime.write_part(output, boundary, handle, "application/zip", x509.CERTIFICATE_STORE_NAME)
+
+	output.write("--{0}--\r\n".format(boundary))
+
+
+def _refresh_certificate_store(envelope, content_key, rekeyed, add, remove):
+	'''
+		Copies the encrypted content of envelope to the pkcs7.EnvelopedDataWriter rekeyed and
+		replaces the certificate store at its end. The content is decrypted to find the start
+		of the store and spooled to disk, then everything before it is copied unchanged and
+		only the new store is encrypted, continuing the cipher block chain.
+	'''
+
+	_, _, block_size = pkcs7.CIPHERS[envelope.cipher]
+
+	cipher = M2Crypto.EVP.Cipher(envelope.cipher, content_key, envelope.iv, op = 0)
+	finder = mime.DelimiterFinder()
+
+	with tempfile.SpooledTemporaryFile(max_size = mime.DEFAULT_SPOOL_SIZE) as spool:
 		try:
-			smime.load_key(key, callback = password_callback)
+			for chunk in envelope.iter_content():
+				spool.write(chunk)
+				finder.write(cipher.update(chunk))
+
+			finder.write(cipher.final())
 		except M2Crypto.EVP.EVPError as error:
 			raise IOError(error)
 
-		# Load the PKCS#7 message and try to decrypt it.
-		pkcs7, _ = M2Crypto.SMIME.smime_load_pkcs7_bio(buf)
+		if len(finder.offsets) < 2:
+			raise IOError("The container does not contain a certificate store.")
 
-		try:
-			message = smime.decrypt(pkcs7)
-		except M2Crypto.SMIME.PKCS7_Error as error:
-			raise IOError(error)
+		# CBC can only be resumed at a block boundary, so the beginning of the block that
+		# contains the start of the store is encrypted again.
+		start = finder.offsets[0]
+		aligned = start - start % block_size
 
-		instance = CCEContainer()
+		if aligned:
+			spool.seek(aligned - block_size)
+			iv = spool.read(block_size)
+		else:
+			iv = envelope.iv
 
-		# Extract each message part in turn and retrieve the payload and filename.
-		for part in Parser().parsestr(message).get_payload():
-			struct = part.get_param("name").strip("/").split("/")
-			name = struct[-1]
+		cipher = M2Crypto.EVP.Cipher(envelope.cipher, content_key, iv, op = 0)
+		tail = cipher.update(spool.read()) + cipher.final()
 
-			stream = StringIO(part.get_payload(decode = True))
+		header = "Content-Type: multipart/mixed; boundary=\"{0}\"\r\n\r\n".format(finder.boundary)
+		parts = list(mime.iter_parts(StringIO(header + tail[start - aligned:])))
 
-			if name == x509.CERTIFICATE_STORE_NAME:
-				# We want to deal with the CertificateStore separately.
-				instance.recipients = x509.CertificateStore.load(stream)
-			else:
-				# Add all other files to the container.
-				directory = "/".join(struct[0:-1])
-				instance.add_stream(stream, name, directory = directory)
+		if len(parts) != 1 or parts[0][0].get_param("name").strip("/") != x509.CERTIFICATE_STORE_NAME:
+			raise IOError("The certificate store is not the last part of the container.")
+
+		store = x509.CertificateStore.load(parts[0][1])
+
+		for certificate in remove:
+			store.discard(certificate)
+
+		for certificate in add:
+			store.add_certificate(certificate)
+
+		spool.seek(0)
+		while spool.tell() < aligned:
+			rekeyed.write_encrypted(spool.read(min(pkcs7.CHUNK_SIZE, aligned - spool.tell())))
+
+	rekeyed.write(tail[:start - aligned])
+	_write_certificate_store(rekeyed, finder.boundary, store.get_archive())
+
+
+def _get_password_callback(key, password):
+	''' Returns a password callback for M2Crypto that prompts for the password if none is given. '''
+
+	if not password:
+		return lambda x: getpass.getpass("Password for " + key + ": ")
+
+	return lambda x: password
 
-		return instance
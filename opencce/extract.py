@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module extracts the files of a decrypted CCE container to disk in parallel. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import os
+
+
+# Existing files are either replaced or kept.
+OVERWRITE = "overwrite"
+SKIP      = "skip"
+POLICIES  = (OVERWRITE, SKIP)
+
+# The number of threads that write files concurrently.
+DEFAULT_THREADS = 8
+
+# Files are copied in chunks of this size.
+CHUNK_SIZE = 1024 * 1024
+
+
+def extract(container, directory, threads = DEFAULT_THREADS, policy = OVERWRITE, fsync = False):
+	'''
+		Writes all files of container below directory and returns a list with the path of each
+		file and whether it was written. All directories are created first, then the files are
+		copied in chunks by a pool of threads. Existing files are kept if policy is SKIP. If
+		fsync is True, all files and directories are flushed to disk once everything is written.
+	'''
+
+	if policy not in POLICIES:
+		raise ValueError("Unsupported policy: " + policy)
+
+	root = os.path.abspath(directory)
+	tasks = []
+
+	for cce_file in container:
+		components = [part for part in cce_file.directory.split("/") if part not in ("", ".", "..")]
+		path = os.path.join(root, *(components + [cce_file.name]))
+
+		if not os.path.abspath(path).startswith(root + os.sep):
+			raise IOError("Invalid file name in container: " + cce_file.name)
+
+		tasks.append((cce_file, path, policy))
+
+	for parent in sorted(set(os.path.dirname(path) for _, path, _ in tasks)):
+		if not os.path.isdir(parent):
+			os.makedirs(parent)
+
+	from multiprocessing.pool import ThreadPool
+
+	pool = ThreadPool(threads)
+
+	try:
+		results = pool.map(_write_file, tasks)
+
+		if fsync:
+			written = [path for path, done in results if done]
+			pool.map(_sync, written + sorted(set(os.path.dirname(path) for path in written)))
+	finally:
+		pool.close()
+		pool.join()
+
+	return results
+
+
+def _write_file(task):
+	''' Copies a single file in chunks. Returns its path and whether it was written. '''
+
+	cce_file, path, policy = task
+
+	if policy == SKIP and os.path.exists(path):
+		return path, False
+
+	with cce_file.open() as handle:
+		with open(path, "wb") as output:
+			while True:
+				chunk = handle.read(CHUNK_SIZE)
+				if not chunk:
+					break
+				output.write(chunk)
+
+	return path, True
+
+
+def _sync(path):
+	''' Flushes a file or directory to disk. '''
+
+	descriptor = os.open(path, os.O_RDONLY)
+
+	try:
+		os.fsync(descriptor)
+	finally:
+		os.close(descriptor)
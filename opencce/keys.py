@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides classes to find and load the private keys for CCE containers. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import os
+
+from opencce import x509
+from opencce import pkcs7
+from opencce.utils import LazyModule
+
+
+M2Crypto = LazyModule("M2Crypto", "M2Crypto.RSA", "M2Crypto.X509")
+
+
+class KeyIndex(object):
+	'''
+		Maps the issuer and serial number of recipient certificates to the private key files
+		that belong to them, so a container can be decrypted without trying every key. Keys
+		that were already opened are kept, so they are not decrypted again.
+	'''
+
+	def __init__(self):
+		self.keys = {}
+		self.private_keys = {}
+
+
+	def add(self, certificate, key_path, key = None):
+		''' Adds the key file for a M2Crypto X509 certificate and the M2Crypto RSA key from it, if it is open. '''
+
+		self.keys[pkcs7.get_issuer_and_serial(certificate)] = key_path
+
+		if key is not None:
+			self.private_keys[key_path] = key
+
+
+	def get_private_key(self, key_path, password = None):
+		''' Returns the M2Crypto RSA key from a key file of the index and opens it only once. '''
+
+		if key_path not in self.private_keys:
+			try:
+				self.private_keys[key_path] = M2Crypto.RSA.load_key(key_path, callback = lambda x: password or "")
+			except M2Crypto.RSA.RSAError as error:
+				raise IOError(error)
+
+		return self.private_keys[key_path]
+
+
+	def find(self, recipient_infos):
+		''' Returns the key file for the first recipient we have a key for, or None. '''
+
+		return self.find_recipient(recipient_infos)[0]
+
+
+	def find_recipient(self, recipient_infos):
+		'''
+			Returns the key file and the pkcs7.RecipientInfo of the first recipient we have a key
+			for, or None and None.
+		'''
+
+		for recipient_info in recipient_infos:
+			key_path = self.keys.get((recipient_info.issuer, recipient_info.serial))
+			if key_path:
+				return key_path, recipient_info
+
+		return None, None
+
+
+	def __len__(self):
+		return len(self.keys)
+
+
+	@staticmethod
+	def from_directory(path, password = None):
+		'''
+			Creates a new instance from a directory that contains private keys and certificates
+			in PEM or DER format. Keys and certificates are matched by their RSA modulus. A file
+			may contain both. Encrypted keys that can not be opened with password are skipped.
+			The modulus of an encrypted key can not be read without opening it, so each key is
+			opened here once and kept in the index.
+		'''
+
+		certificates = []
+		keys = {}
+
+		for name in sorted(os.listdir(path)):
+			filename = os.path.join(path, name)
+			if not os.path.isfile(filename):
+				continue
+
+			with open(filename, "rb") as handle:
+				data = handle.read()
+
+			try:
+				certificates.append(x509.load_certificate(data))
+			except IOError:
+				pass
+
+			try:
+				key = M2Crypto.RSA.load_key_string(data, callback = lambda x: password or "")
+			except M2Crypto.RSA.RSAError:
+				continue
+
+			keys[key.n] = (filename, key)
+
+		instance = KeyIndex()
+
+		for certificate in certificates:
+			modulus = certificate.get_pubkey().get_rsa().n
+			if modulus in keys:
+				instance.add(certificate, *keys[modulus])
+
+		return instance
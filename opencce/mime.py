@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides functions to write and read MIME messages one part at a time. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import re
+import base64
+import quopri
+import tempfile
+
+from opencce.utils import LazyModule, split_base64
+
+
+email = LazyModule("email", "email.parser", "email.utils")
+
+# Files are read in chunks of this size when streaming. A multiple of 57 bytes always
+# encodes to complete lines of base64.
+CHUNK_SIZE = 57 * 1024
+
+# Header lines longer than this are split when reading, so a single line can not exhaust memory.
+MAX_LINE_LENGTH = 64 * 1024
+
+# Decoded parts are kept in memory up to this size in total, the rest is written to disk.
+DEFAULT_SPOOL_SIZE = 4 * 1024 * 1024
+
+
+def write_part(output, boundary, handle, content_type, fname, header = ""):
+	'''
+		Writes a single base64 encoded MIME part with the contents of handle to output. If the
+		first bytes were already read from handle, they are passed as header.
+	'''
+
+	quote = email.utils.quote
+
+	output.write("--{0}\r\n".format(boundary))
+	output.write("Content-Type: {0}; name=\"{1}\"\r\n".format(content_type, quote(fname)))
+	output.write("MIME-Version: 1.0\r\n")
+	output.write("Content-Transfer-Encoding: base64\r\n")
+	output.write("Content-Disposition: attachment; filename=\"{0}\"\r\n\r\n".format(quote(fname)))
+
+	remainder = header
+
+	while True:
+		# Reading only up to the next multiple of a line keeps the chunks aligned, so they are
+		# passed on without copying them (memory mapped files always return full chunks).
+		chunk = handle.read(CHUNK_SIZE - len(remainder) % CHUNK_SIZE)
+		if not chunk:
+			break
+
+		# Short reads are possible, so we only encode complete lines and keep the rest.
+		chunk = remainder + chunk
+		complete = len(chunk) - len(chunk) % 57
+		remainder = chunk[complete:]
+
+		output.write(base64.encodestring(chunk[:complete]).replace("\n", "\r\n"))
+
+	output.write(base64.encodestring(remainder).replace("\n", "\r\n"))
+
+
+def iter_parts(stream, spool_size = DEFAULT_SPOOL_SIZE, select = None):
+	'''
+		Generator that reads a multipart MIME message from stream and yields the headers of
+		each part along with a file handle to its decoded payload. Payloads are decoded in
+		chunks into temporary files. All payloads together are kept in memory up to spool_size
+		bytes, every part that does not fit in the rest of that budget is written to disk. If
+		select is given, it is called with the headers of each part, and parts for which it
+		returns False are skipped without decoding them.
+	'''
+
+	# The number of bytes that the following parts may still keep in memory.
+	budget = [spool_size]
+
+	def create(headers):
+		encoding = headers.get("Content-Transfer-Encoding", "7bit")
+
+		if select and not select(headers):
+			return _Counter(encoding)
+
+		# A maximum size of 0 would never roll over to disk.
+		if budget[0] <= 0:
+			return _Decoder(tempfile.TemporaryFile(), encoding)
+
+		return _Decoder(tempfile.SpooledTemporaryFile(max_size = budget[0]), encoding)
+
+	for headers, sink in _walk(stream, create):
+		if isinstance(sink, _Decoder):
+			# Parts that stayed in memory use up the budget.
+			size = sink.output.tell()
+			if size <= budget[0]:
+				budget[0] -= size
+
+			sink.output.seek(0)
+			yield headers, sink.output
+
+
+def iter_headers(stream):
+	'''
+		Generator that reads a multipart MIME message from stream and yields the headers of
+		each part along with the size of its decoded payload. Payloads are only counted, not
+		decoded.
+	'''
+
+	def create(headers):
+		return _Counter(headers.get("Content-Transfer-Encoding", "7bit"))
+
+	for headers, counter in _walk(stream, create):
+		yield headers, counter.size
+
+
+def _walk(stream, create):
+	'''
+		Generator that reads a multipart MIME message from stream. For each part, create is
+		called with its headers and returns an object whose write method receives the body.
+		Yields the headers and that object after the whole body was written to it.
+	'''
+
+	scanner = _Scanner(stream)
+
+	headers = scanner.read_headers()
+	boundary = headers.get_boundary()
+
+	if not boundary:
+		raise IOError("The message is not a multipart message.")
+
+	# The line break before a delimiter belongs to the delimiter.
+	delimiter = "\n--" + boundary
+
+	# Skip the preamble.
+	if not scanner.read_until(delimiter, lambda data: None):
+		return
+
+	while not scanner.read_line().strip().startswith("--"):
+		headers = scanner.read_headers()
+
+		sink = create(headers)
+		found = scanner.read_until(delimiter, sink.write)
+		sink.close()
+
+		yield headers, sink
+
+		if not found:
+			break
+
+
+def _split_at_delimiter(buffer, delimiter):
+	'''
+		Splits a buffer that was searched for delimiter into the part that can not belong to a
+		delimiter and the end that has to be kept, so a delimiter that is split between two
+		chunks is still recognized.
+	'''
+
+	cut = max(len(buffer) - len(delimiter) + 1, 0)
+
+	return buffer[:cut], buffer[cut:]
+
+
+
+class DelimiterFinder(object):
+	'''
+		Finds the delimiter lines of a multipart MIME message that is written to it in chunks.
+		The boundary is taken from the headers of the message. Only the offsets of the last
+		two delimiters are kept, which are the start of the last part and the closing
+		delimiter.
+	'''
+
+	def __init__(self):
+		self.boundary = None
+		self.delimiter = None
+		self.offsets = []
+		self.buffer = ""
+		self.position = 0
+
+
+	def write(self, data):
+		''' Searches a chunk of the message for delimiters. '''
+
+		self.buffer += data
+
+		if self.delimiter is None:
+			match = re.search(r"\r?\n\r?\n", self.buffer)
+			if not match:
+				if len(self.buffer) > MAX_LINE_LENGTH:
+					raise IOError("The message is not a multipart message.")
+				return
+
+			headers = email.parser.Parser().parsestr(self.buffer[:match.end()], headersonly = True)
+			self.boundary = headers.get_boundary()
+
+			if not self.boundary:
+				raise IOError("The message is not a multipart message.")
+
+			# The offsets point to the dashes, the line break before them belongs to the part before.
+			self.delimiter = "\n--" + self.boundary
+
+		position = self.buffer.find(self.delimiter)
+		while position >= 0:
+			self.offsets = (self.offsets + [self.position + position + 1])[-2:]
+			position = self.buffer.find(self.delimiter, position + 1)
+
+		searched, self.buffer = _split_at_delimiter(self.buffer, self.delimiter)
+		self.position += len(searched)
+
+
+	def close(self):
+		''' Does nothing, since there is nothing to finalize. '''
+
+		pass
+
+
+
+class _Scanner(object):
+	''' Reads lines and delimited blocks from a stream in large chunks. '''
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffer = ""
+
+
+	def _fill(self, size):
+		''' Reads from the stream until the buffer holds size bytes. Returns False at the end of the stream. '''
+
+		while len(self.buffer) < size:
+			data = self.stream.read(CHUNK_SIZE)
+			if not data:
+				return False
+			self.buffer += data
+
+		return True
+
+
+	def read_line(self):
+		''' Returns the next line including its line break, but never more than MAX_LINE_LENGTH bytes. '''
+
+		position = self.buffer.find("\n")
+
+		while position < 0 and len(self.buffer) < MAX_LINE_LENGTH:
+			searched = len(self.buffer)
+			if not self._fill(searched + 1):
+				break
+			position = self.buffer.find("\n", searched)
+
+		end = len(self.buffer) if position < 0 else position + 1
+		end = min(end, MAX_LINE_LENGTH)
+
+		line, self.buffer = self.buffer[:end], self.buffer[end:]
+		return line
+
+
+	def read_headers(self):
+		''' Reads header lines up to and including the next empty line and returns them as a message. '''
+
+		lines = []
+
+		while True:
+			line = self.read_line()
+			if not line.strip():
+				break
+			lines.append(line)
+
+		return email.parser.Parser().parsestr("".join(lines), headersonly = True)
+
+
+	def read_until(self, delimiter, write):
+		'''
+			Passes everything up to the next occurrence of delimiter to write and skips the
+			delimiter. A delimiter at the current position is also found without the leading
+			line break. Returns False if the stream ended before the delimiter was found.
+		'''
+
+		self._fill(len(delimiter))
+
+		if self.buffer.startswith(delimiter[1:]):
+			self.buffer = self.buffer[len(delimiter) - 1:]
+			return True
+
+		while True:
+			position = self.buffer.find(delimiter)
+			if position >= 0:
+				write(self.buffer[:position])
+				self.buffer = self.buffer[position + len(delimiter):]
+				return True
+
+			searched, self.buffer = _split_at_delimiter(self.buffer, delimiter)
+			if searched:
+				write(searched)
+
+			if not self._fill(len(self.buffer) + 1):
+				write(self.buffer)
+				self.buffer = ""
+				return False
+
+
+
+class _Decoder(object):
+	''' Decodes the body of a MIME part chunk by chunk according to its transfer encoding. '''
+
+	def __init__(self, output, encoding):
+		self.output = output
+		self.encoding = encoding.strip().lower()
+		self.pending = ""
+
+
+	def write(self, data):
+		''' Decodes a chunk of the body and writes the result to the output. '''
+
+		data = self.pending + data
+
+		if self.encoding == "base64":
+			data, self.pending = split_base64(data)
+		else:
+			if self.encoding == "quoted-printable":
+				# Only decode complete lines, so we do not split escape sequences.
+				complete = data.rfind("\n") + 1
+			else:
+				# A carriage return at the end could belong to the delimiter, so we hold it back.
+				complete = len(data) - 1 if data.endswith("\r") else len(data)
+
+			data, self.pending = data[:complete], data[complete:]
+
+		self.output.write(self._decode(data))
+
+
+	def close(self):
+		''' Decodes the remaining data without the carriage return that belongs to the delimiter. '''
+
+		data = self.pending
+		if data.endswith("\r"):
+			data = data[:-1]
+
+		self.output.write(self._decode(data))
+		self.pending = ""
+
+
+	def _decode(self, data):
+		''' Decodes data according to the transfer encoding. '''
+
+		if self.encoding == "base64":
+			try:
+				return base64.b64decode(data)
+			except TypeError:
+				raise IOError("Invalid MIME part (malformed base64).")
+		elif self.encoding == "quoted-printable":
+			return quopri.decodestring(data)
+
+		return data
+
+
+
+class _Counter(object):
+	''' Counts the decoded size of the body of a MIME part without decoding it. '''
+
+	def __init__(self, encoding):
+		self.base64 = encoding.strip().lower() == "base64"
+		self.length = 0
+		self.padding = 0
+		self.size = 0
+		self.last = ""
+
+
+	def write(self, data):
+		''' Counts a chunk of the body. '''
+
+		if self.base64:
+			self.length += len(data) - sum(data.count(character) for character in " \t\r\n")
+			self.padding += data.count("=")
+		else:
+			self.length += len(data)
+			self.last = data[-1:] or self.last
+
+
+	def close(self):
+		''' Computes the size. A carriage return at the end belongs to the delimiter. '''
+
+		if self.base64:
+			self.size = self.length * 3 // 4 - self.padding
+		else:
+			self.size = self.length - (1 if self.last == "\r" else 0)
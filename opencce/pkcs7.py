@@ -0,0 +1,872 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides a streaming implementation of PKCS#7 enveloped data. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+import re
+import zlib
+import base64
+import itertools
+
+from collections import namedtuple
+
+from opencce.utils import ChunkReader, LazyModule, split_base64
+
+
+M2Crypto = LazyModule("M2Crypto", "M2Crypto.EVP", "M2Crypto.RSA", "M2Crypto.Rand", "M2Crypto.X509")
+multiprocessing = LazyModule("multiprocessing", "multiprocessing.pool")
+
+
+OID_DATA            = "1.2.840.113549.1.7.1"
+OID_ENVELOPED_DATA  = "1.2.840.113549.1.7.3"
+OID_RSA_ENCRYPTION  = "1.2.840.113549.1.1.1"
+OID_COMPRESSED_DATA = "1.2.840.113549.1.9.16.1.9"
+OID_ZLIB            = "1.2.840.113549.1.9.16.3.8"
+
+# Short names of the attribute types that usually appear in distinguished names.
+NAME_ATTRIBUTES = {
+	"2.5.4.3":              "CN",
+	"2.5.4.5":              "serialNumber",
+	"2.5.4.6":              "C",
+	"2.5.4.7":              "L",
+	"2.5.4.8":              "ST",
+	"2.5.4.10":             "O",
+	"2.5.4.11":             "OU",
+	"1.2.840.113549.1.9.1": "emailAddress"
+}
+
+# The zlib compression level that is used if none is given.
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Maps M2Crypto cipher names to their OID, key length and IV length.
+CIPHERS = {
+	"aes_128_cbc":  ("2.16.840.1.101.3.4.1.2",  16, 16),
+	"aes_192_cbc":  ("2.16.840.1.101.3.4.1.22", 24, 16),
+	"aes_256_cbc":  ("2.16.840.1.101.3.4.1.42", 32, 16),
+	"des_ede3_cbc": ("1.2.840.113549.3.7",      24, 8)
+}
+
+# The same envelope that M2Crypto.SMIME.SMIME.write() produces for enveloped data.
+SMIME_HEADER = (
+	"MIME-Version: 1.0\n"
+	"Content-Disposition: attachment; filename=\"smime.p7m\"\n"
+	"Content-Type: application/x-pkcs7-mime; smime-type=enveloped-data; name=\"smime.p7m\"\n"
+	"Content-Transfer-Encoding: base64\n"
+	"\n"
+)
+
+# PEM files use the same base64 encoding between these lines.
+PEM_HEADER = "-----BEGIN PKCS7-----\n"
+PEM_FOOTER = "-----END PKCS7-----\n"
+
+# The supported container formats.
+FORMAT_SMIME = "smime"
+FORMAT_DER   = "der"
+FORMAT_PEM   = "pem"
+FORMATS      = (FORMAT_SMIME, FORMAT_DER, FORMAT_PEM)
+
+# Marks the end of a BER element with indefinite length.
+END_OF_CONTENTS = "\x00\x00"
+
+# Encrypted content is read in chunks of this size.
+CHUNK_SIZE = 64 * 1024
+
+
+# Holds the DER encoded issuer and serial number of a recipient, the key wrapped for it and the
+# whole DER encoded RecipientInfo structure.
+RecipientInfo = namedtuple("RecipientInfo", ["issuer", "serial", "encrypted_key", "der"])
+
+
+def encode_length(length):
+	''' Returns the DER encoding of a length field. '''
+
+	if length < 0x80:
+		return chr(length)
+
+	octets = ""
+	while length:
+		octets = chr(length & 0xff) + octets
+		length >>= 8
+
+	return chr(0x80 | len(octets)) + octets
+
+
+def encode(tag, value):
+	''' Returns a DER element with the given tag and value. '''
+
+	return chr(tag) + encode_length(len(value)) + value
+
+
+def write_octets(output, chunk):
+	''' Writes a chunk of a constructed OCTET STRING to output as a primitive OCTET STRING, unless it is empty. '''
+
+	if chunk:
+		output.write(encode(0x04, chunk))
+
+
+def encode_oid(dotted):
+	''' Returns the DER encoding of an object identifier given in dotted notation. '''
+
+	arcs = [int(arc) for arc in dotted.split(".")]
+	body = chr(40 * arcs[0] + arcs[1])
+
+	for arc in arcs[2:]:
+		octets = chr(arc & 0x7f)
+		arc >>= 7
+		while arc:
+			octets = chr(0x80 | (arc & 0x7f)) + octets
+			arc >>= 7
+		body += octets
+
+	return encode(0x06, body)
+
+
+def decode(data, offset = 0):
+	'''
+		Reads the DER element at offset and returns a tuple of its tag, the offset of its
+		value and the offset directly after the element.
+	'''
+
+	tag = ord(data[offset])
+	length = ord(data[offset + 1])
+	start = offset + 2
+
+	if length & 0x80:
+		count = length & 0x7f
+		length = 0
+		for octet in data[start:start + count]:
+			length = (length << 8) | ord(octet)
+		start += count
+
+	return tag, start, start + length
+
+
+def decode_oid(value):
+	''' Returns the dotted notation of the value of a DER encoded object identifier. '''
+
+	arcs = list(divmod(ord(value[0]), 40))
+	arc = 0
+
+	for octet in value[1:]:
+		arc = (arc << 7) | (ord(octet) & 0x7f)
+		if not ord(octet) & 0x80:
+			arcs.append(arc)
+			arc = 0
+
+	return ".".join(str(arc) for arc in arcs)
+
+
+def format_name(name):
+	''' Returns a readable representation of a DER encoded distinguished name. '''
+
+	components = []
+
+	_, offset, end = decode(name)
+
+	# Each relative distinguished name is a SET of SEQUENCEs of type and value.
+	while offset < end:
+		_, attribute, offset = decode(name, offset)
+
+		while attribute < offset:
+			_, sequence_start, attribute = decode(name, attribute)
+			_, oid_start, oid_end = decode(name, sequence_start)
+			_, value_start, value_end = decode(name, oid_end)
+
+			oid = decode_oid(name[oid_start:oid_end])
+			components.append("{0}={1}".format(NAME_ATTRIBUTES.get(oid, oid), name[value_start:value_end]))
+
+	return ", ".join(components)
+
+
+def format_serial(serial):
+	''' Returns the hexadecimal representation of a DER encoded serial number. '''
+
+	_, start, end = decode(serial)
+
+	return ":".join("{0:02X}".format(ord(octet)) for octet in serial[start:end].lstrip("\x00") or "\x00")
+
+
+def parse_recipient_infos(data):
+	''' Returns a list of RecipientInfo tuples from the DER encoded content of a SET OF RecipientInfo. '''
+
+	recipient_infos = []
+	offset = 0
+
+	while offset < len(data):
+		_, start, end = decode(data, offset)
+
+		# Skip the version.
+		_, _, position = decode(data, start)
+
+		# The issuer name is followed by the serial number.
+		_, sequence_start, sequence_end = decode(data, position)
+		_, _, issuer_end = decode(data, sequence_start)
+
+		# Skip the key encryption algorithm.
+		_, _, position = decode(data, sequence_end)
+		_, key_start, key_end = decode(data, position)
+
+		recipient_infos.append(RecipientInfo(
+			data[sequence_start:issuer_end], data[issuer_end:sequence_end], data[key_start:key_end],
+			data[offset:end]
+		))
+
+		offset = end
+
+	return recipient_infos
+
+
+def get_issuer_and_serial(certificate):
+	''' Returns the DER encoded issuer name and serial number of a M2Crypto X509 certificate or its DER encoding. '''
+
+	der = certificate if isinstance(certificate, str) else certificate.as_der()
+
+	# Certificate -> TBSCertificate
+	_, offset, _ = decode(der)
+	_, offset, _ = decode(der, offset)
+
+	# Skip the optional explicitly tagged version.
+	tag, _, end = decode(der, offset)
+	if tag == 0xa0:
+		offset = end
+
+	# The serial number is followed by the signature algorithm and the issuer name.
+	_, _, serial_end = decode(der, offset)
+	_, _, algorithm_end = decode(der, serial_end)
+	_, _, issuer_end = decode(der, algorithm_end)
+
+	return der[algorithm_end:issuer_end], der[offset:serial_end]
+
+
+def get_recipient_info(certificate, key):
+	''' Returns a DER encoded RecipientInfo structure that holds key wrapped for certificate. '''
+
+	issuer, serial = get_issuer_and_serial(certificate)
+	encrypted_key = certificate.get_pubkey().get_rsa().public_encrypt(key, M2Crypto.RSA.pkcs1_padding)
+
+	return _encode_recipient_info(issuer, serial, encrypted_key)
+
+
+def _encode_recipient_info(issuer, serial, encrypted_key):
+	''' Returns a DER encoded RecipientInfo structure from its DER encoded parts and the wrapped key. '''
+
+	return encode(0x30, "".join([
+		encode(0x02, "\x00"),
+		encode(0x30, issuer + serial),
+		encode(0x30, encode_oid(OID_RSA_ENCRYPTION) + encode(0x05, "")),
+		encode(0x04, encrypted_key)
+	]))
+
+
+
+def get_recipient_infos(certificates, key, processes = None):
+	'''
+		Returns a list of DER encoded RecipientInfo structures that hold key wrapped for each
+		of the M2Crypto X509 certificates. The key is wrapped in this process unless a number
+		of processes is given, in which case a pool of that many worker processes is started
+		for this call and shut down before it returns. Starting the pool takes about as long as
+		wrapping the key for a thousand recipients in this process (see key_wrap and
+		key_wrap_pool in benchmarks/benchmark.py), so it only pays off for many more
+		recipients and CPUs.
+	'''
+
+	certificates = list(certificates)
+
+	# Worker processes of another pool can not start their own.
+	if not processes or processes < 2 or len(certificates) < 2 or multiprocessing.current_process().daemon:
+		return [get_recipient_info(certificate, key) for certificate in certificates]
+
+	# Parsing certificates takes longer than wrapping the key, so the workers only get public keys.
+	jobs = [
+		(get_issuer_and_serial(certificate), certificate.get_pubkey().get_rsa().pub(), key)
+		for certificate in certificates
+	]
+
+	pool = multiprocessing.Pool(processes)
+
+	try:
+		return pool.map(_wrap_key, jobs, chunksize = len(jobs) // (processes * 4) + 1)
+	finally:
+		pool.close()
+		pool.join()
+
+
+def _wrap_key(arguments):
+	''' Returns a DER encoded RecipientInfo structure for an issuer, serial number and RSA public key in a worker process. '''
+
+	(issuer, serial), public_key, key = arguments
+	encrypted_key = M2Crypto.RSA.new_pub_key(public_key).public_encrypt(key, M2Crypto.RSA.pkcs1_padding)
+
+	return _encode_recipient_info(issuer, serial, encrypted_key)
+
+
+
+class EnvelopedDataWriter(object):
+	'''
+		Encrypts everything written to it and writes a BER encoded PKCS#7 enveloped data
+		structure to the output handle. Only the data passed to a single write() call is
+		held in memory, so arbitrarily large payloads can be encrypted.
+
+		To change the recipients of an existing envelope, pass its content key, IV and the
+		DER encoded RecipientInfo structures to keep, and copy its encrypted content with
+		write_encrypted(). Data written afterwards continues the cipher block chain.
+
+		The key is wrapped for many recipients in parallel, see get_recipient_infos().
+	'''
+
+	def __init__(
+		self, output, certificates, cipher, content_type = OID_DATA, key = None, iv = None,
+		recipient_infos = (), processes = None
+	):
+		if cipher not in CIPHERS:
+			raise ValueError("Unsupported cipher: " + cipher)
+
+		oid, key_length, iv_length = CIPHERS[cipher]
+
+		key = key or M2Crypto.Rand.rand_bytes(key_length)
+		iv = iv or M2Crypto.Rand.rand_bytes(iv_length)
+
+		# DER requires the elements of a SET OF to be sorted.
+		recipient_infos = sorted(set(recipient_infos) | set(get_recipient_infos(certificates, key, processes)))
+		if not recipient_infos:
+			raise ValueError("At least one recipient certificate is required.")
+
+		self.output = output
+		self.name = cipher
+		self.key = key
+		self.cipher = None
+		self.copied = False
+
+		# The last block of ciphertext, which is the IV for the data that follows it.
+		self.chain = iv
+
+		# All enclosing elements use the indefinite length form, since we do not know the
+		# size of the encrypted content in advance.
+		self.output.write("".join([
+			"\x30\x80",
+			encode_oid(OID_ENVELOPED_DATA),
+			"\xa0\x80",
+			"\x30\x80",
+			encode(0x02, "\x00"),
+			encode(0x31, "".join(recipient_infos)),
+			"\x30\x80",
+			encode_oid(content_type),
+			encode(0x30, encode_oid(oid) + encode(0x04, iv)),
+			"\xa0\x80"
+		]))
+
+
+	def write(self, data):
+		''' Encrypts data and writes it to the output as a chunk of the encrypted content. '''
+
+		write_octets(self.output, self._get_cipher().update(data))
+
+
+	def write_encrypted(self, chunk):
+		''' Writes a chunk of content that was already encrypted with the same key and IV. '''
+
+		if self.cipher:
+			raise ValueError("Encrypted content must be written before any other data.")
+
+		write_octets(self.output, chunk)
+		self.chain = (self.chain + chunk)[-len(self.chain):]
+		self.copied = True
+
+
+	def close(self):
+		'''
+			Finalizes the cipher and closes all open elements. Does not close the output. If
+			only encrypted content was copied, it is expected to be padded already.
+		'''
+
+		if self.cipher or not self.copied:
+			write_octets(self.output, self._get_cipher().final())
+
+		self.output.write(END_OF_CONTENTS * 5)
+
+
+	def _get_cipher(self):
+		''' Returns the cipher, which is created when it is first needed, so it can continue copied content. '''
+
+		if not self.cipher:
+			self.cipher = M2Crypto.EVP.Cipher(self.name, self.key, self.chain, op = 1)
+
+		return self.cipher
+
+
+
+class CompressedDataWriter(object):
+	'''
+		Compresses everything written to it with zlib and writes a BER encoded compressed data
+		structure (RFC 3274) to the output handle. The structure is meant to be used as the
+		content of an EnvelopedDataWriter with the content type OID_COMPRESSED_DATA.
+	'''
+
+	def __init__(self, output, level = DEFAULT_COMPRESSION_LEVEL):
+		self.output = output
+		self.compressor = zlib.compressobj(level)
+
+		self.output.write("".join([
+			"\x30\x80",
+			encode(0x02, "\x00"),
+			encode(0x30, encode_oid(OID_ZLIB)),
+			"\x30\x80",
+			encode_oid(OID_DATA),
+			"\xa0\x80",
+			"\x24\x80"
+		]))
+
+
+	def write(self, data):
+		''' Compresses data and writes it to the output as a chunk of the compressed content. '''
+
+		write_octets(self.output, self.compressor.compress(data))
+
+
+	def copy(self, output):
+		'''
+			Returns a writer that continues the compressed data from here and writes to output,
+			so data that many structures start with only needs to be compressed once.
+		'''
+
+		writer = CompressedDataWriter.__new__(CompressedDataWriter)
+		writer.output = output
+		writer.compressor = self.compressor.copy()
+
+		return writer
+
+
+	def close(self):
+		''' Flushes the compressor and closes all open elements. Does not close the output. '''
+
+		write_octets(self.output, self.compressor.flush())
+		self.output.write(END_OF_CONTENTS * 4)
+
+
+
+class Base64Writer(object):
+	''' Writes binary data written to it as base64 encoded lines between a header and a footer. '''
+
+	# OpenSSL uses 64 characters per line, which corresponds to 48 bytes of input.
+	LINE_LENGTH = 48
+
+	def __init__(self, output, header, footer = ""):
+		self.output = output
+		self.footer = footer
+		self.buffer = ""
+
+		self.output.write(header)
+
+
+	def write(self, data):
+		''' Encodes all complete lines of data and writes them to the output. '''
+
+		self.buffer += data
+
+		complete = len(self.buffer) - len(self.buffer) % self.LINE_LENGTH
+		self._write_lines(self.buffer[:complete])
+		self.buffer = self.buffer[complete:]
+
+
+	def close(self):
+		''' Writes the remaining data and the footer to the output. Does not close the output. '''
+
+		self._write_lines(self.buffer)
+		self.buffer = ""
+
+		self.output.write(self.footer)
+
+
+	def _write_lines(self, data):
+		''' Writes data as lines of base64 encoded text. '''
+
+		if data:
+			self.output.write("".join(
+				base64.b64encode(data[i:i + self.LINE_LENGTH]) + "\n"
+				for i in range(0, len(data), self.LINE_LENGTH)
+			))
+
+
+
+class BinaryWriter(object):
+	''' Passes binary data through to the output unchanged. '''
+
+	def __init__(self, output):
+		self.output = output
+
+
+	def write(self, data):
+		''' Writes data to the output. '''
+
+		self.output.write(data)
+
+
+	def close(self):
+		''' Does nothing, since there is nothing to finalize. Does not close the output. '''
+
+		pass
+
+
+
+class Base64Reader(object):
+	'''
+		Provides the binary content of a base64 encoded S/MIME or PEM message from stream
+		through a file interface. Everything up to header_end is skipped and reading stops at
+		the first dash, which marks a PEM footer.
+	'''
+
+	def __init__(self, stream, header_end):
+		self.stream = stream
+		self.pending = ""
+		self.eof = False
+
+		# Skip the header.
+		text = ""
+		while True:
+			match = header_end.search(text)
+			if match:
+				break
+
+			data = stream.read(CHUNK_SIZE)
+			if not data:
+				raise IOError("Invalid PKCS#7 data (missing header).")
+			text += data
+
+		self.pending = text[match.end():]
+
+
+	def read(self, size):
+		''' Decodes and returns roughly size bytes. Returns an empty string at the end of the stream. '''
+
+		data = ""
+
+		while not data and not self.eof:
+			text = self.stream.read(size * 4 // 3 + 4)
+			if not text:
+				self.eof = True
+
+			text = self.pending + text
+
+			footer = text.find("-")
+			if footer >= 0:
+				text = text[:footer]
+				self.eof = True
+
+			text, self.pending = split_base64(text, final = self.eof)
+
+			try:
+				data = base64.b64decode(text)
+			except TypeError:
+				raise IOError("Invalid PKCS#7 data (malformed base64).")
+
+		return data
+
+
+
+def detect_format(data):
+	''' Guesses the format of a container from its first bytes. '''
+
+	if data.lstrip().startswith(PEM_HEADER[:10]):
+		return FORMAT_PEM
+	elif data.startswith("\x30"):
+		return FORMAT_DER
+
+	return FORMAT_SMIME
+
+
+def open_writer(output, output_format):
+	''' Returns a writer that stores binary PKCS#7 data written to it in the given format. '''
+
+	if output_format == FORMAT_SMIME:
+		return Base64Writer(output, SMIME_HEADER)
+	elif output_format == FORMAT_PEM:
+		return Base64Writer(output, PEM_HEADER, PEM_FOOTER)
+	elif output_format == FORMAT_DER:
+		return BinaryWriter(output)
+
+	raise ValueError("Unsupported format: " + output_format)
+
+
+def open_reader(stream):
+	''' Detects the format of the PKCS#7 data in stream and returns a reader for its binary content. '''
+
+	head = stream.read(CHUNK_SIZE)
+	reader = ChunkReader(itertools.chain([head], iter(lambda: stream.read(CHUNK_SIZE), "")))
+
+	input_format = detect_format(head)
+
+	if input_format == FORMAT_SMIME:
+		return Base64Reader(reader, re.compile(r"\r?\n\r?\n"))
+	elif input_format == FORMAT_PEM:
+		return Base64Reader(reader, re.compile(r"-----\r?\n"))
+
+	return reader
+
+
+def convert(input_stream, output, output_format):
+	''' Copies the PKCS#7 data from input_stream to output in the given format without decrypting it. '''
+
+	reader = open_reader(input_stream)
+	writer = open_writer(output, output_format)
+
+	while True:
+		data = reader.read(CHUNK_SIZE)
+		if not data:
+			break
+		writer.write(data)
+
+	writer.close()
+
+
+
+class BERReader(object):
+	''' Reads BER encoded elements from a stream without reading the whole stream. '''
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffer = ""
+		self.position = 0
+
+
+	def read(self, size):
+		''' Reads exactly size bytes. '''
+
+		while len(self.buffer) < size:
+			data = self.stream.read(max(size - len(self.buffer), CHUNK_SIZE))
+			if not data:
+				raise IOError("Unexpected end of PKCS#7 data.")
+			self.buffer += data
+
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		self.position += size
+
+		return data
+
+
+	def read_header(self, expected_tag = None):
+		''' Reads the tag and length of the next element. The length is None for the indefinite form. '''
+
+		tag = ord(self.read(1))
+		length = ord(self.read(1))
+
+		if expected_tag is not None and tag != expected_tag:
+			raise IOError("Invalid PKCS#7 data (unexpected tag {0:#x}).".format(tag))
+
+		if length == 0x80:
+			length = None
+		elif length & 0x80:
+			octets = self.read(length & 0x7f)
+			length = 0
+			for octet in octets:
+				length = (length << 8) | ord(octet)
+
+		return tag, length
+
+
+	def read_value(self, expected_tag = None):
+		''' Reads the next element and returns its value with all nested elements in definite form. '''
+
+		_, length = self.read_header(expected_tag)
+
+		return self._read_content(length)
+
+
+	def _read_content(self, length):
+		''' Reads the content of an element whose header has already been read. '''
+
+		if length is not None:
+			return self.read(length)
+
+		children = []
+
+		while True:
+			child_tag, child_length = self.read_header()
+			if child_tag == 0 and child_length == 0:
+				break
+
+			children.append(encode(child_tag, self._read_content(child_length)))
+
+		return "".join(children)
+
+
+	def iter_octets(self, tag, length):
+		''' Generator that yields the content of a primitive or constructed string in chunks. '''
+
+		if not tag & 0x20:
+			while length > 0:
+				data = self.read(min(length, CHUNK_SIZE))
+				length -= len(data)
+				yield data
+			return
+
+		end = None if length is None else self.position + length
+
+		while end is None or self.position < end:
+			child_tag, child_length = self.read_header()
+			if end is None and child_tag == 0 and child_length == 0:
+				return
+
+			for data in self.iter_octets(child_tag, child_length):
+				yield data
+
+
+
+class EnvelopedDataReader(object):
+	'''
+		Reads a PKCS#7 enveloped data structure from a stream. The header is parsed when the
+		reader is created, the encrypted content is only read and decrypted by decrypt().
+	'''
+
+	def __init__(self, stream):
+		self.ber = BERReader(stream)
+
+		# ContentInfo
+		self.ber.read_header(0x30)
+		if encode(0x06, self.ber.read_value(0x06)) != encode_oid(OID_ENVELOPED_DATA):
+			raise IOError("The PKCS#7 message does not contain enveloped data.")
+
+		# EnvelopedData
+		self.ber.read_header(0xa0)
+		self.ber.read_header(0x30)
+		self.ber.read_value(0x02)
+		self.recipient_infos = parse_recipient_infos(self.ber.read_value(0x31))
+
+		# EncryptedContentInfo
+		self.ber.read_header(0x30)
+		self.content_type = encode(0x06, self.ber.read_value(0x06))
+		algorithm = self.ber.read_value(0x30)
+
+		_, _, oid_end = decode(algorithm)
+		_, iv_start, iv_end = decode(algorithm, oid_end)
+
+		self.cipher = None
+		self.algorithm = algorithm
+		self.iv = algorithm[iv_start:iv_end]
+
+		# The number of bytes of encrypted content that were read so far.
+		self.content_read = 0
+
+		for name, (oid, _, _) in CIPHERS.items():
+			if encode_oid(oid) == algorithm[:oid_end]:
+				self.cipher = name
+
+		if not self.cipher:
+			raise IOError("Unsupported content encryption algorithm.")
+
+
+	def is_compressed(self):
+		''' Returns True if the encrypted content is compressed data. '''
+
+		return self.content_type == encode_oid(OID_COMPRESSED_DATA)
+
+
+	def get_content_key(self, *keys):
+		'''
+			Unwraps the content encryption key using the first of the M2Crypto RSA private keys
+			that works. Instead of a key, a tuple of a key and the RecipientInfo that belongs to
+			it can be given, then only that RecipientInfo is decrypted with the key.
+		'''
+
+		_, key_length, _ = CIPHERS[self.cipher]
+
+		for key in keys:
+			key, recipient_infos = (key[0], [key[1]]) if isinstance(key, tuple) else (key, self.recipient_infos)
+
+			for recipient_info in recipient_infos:
+				try:
+					content_key = key.private_decrypt(recipient_info.encrypted_key, M2Crypto.RSA.pkcs1_padding)
+				except M2Crypto.RSA.RSAError:
+					continue
+
+				if len(content_key) == key_length:
+					return content_key
+
+		raise IOError("The container was not encrypted for this key.")
+
+
+	def decrypt(self, *keys):
+		''' Generator that reads the encrypted content and yields it in decrypted chunks. See get_content_key() for the keys. '''
+
+		return self.decrypt_content(self.get_content_key(*keys))
+
+
+	def decrypt_content(self, content_key):
+		''' Generator that reads the encrypted content and decrypts it with an already unwrapped key. '''
+
+		cipher = M2Crypto.EVP.Cipher(self.cipher, content_key, self.iv, op = 0)
+
+		try:
+			for data in self.iter_content():
+				yield cipher.update(data)
+
+			yield cipher.final()
+		except M2Crypto.EVP.EVPError as error:
+			raise IOError(error)
+
+
+	def iter_content(self):
+		''' Generator that reads the encrypted content and yields it in chunks without decrypting it. '''
+
+		tag, length = self.ber.read_header()
+		if tag not in (0x80, 0xa0):
+			raise IOError("The PKCS#7 message does not contain encrypted content.")
+
+		for data in self.ber.iter_octets(tag, length):
+			self.content_read += len(data)
+			yield data
+
+
+
+def decompress(stream):
+	''' Generator that reads a BER encoded compressed data structure from stream and yields the inflated content. '''
+
+	ber = BERReader(stream)
+
+	# CompressedData
+	ber.read_header(0x30)
+	ber.read_value(0x02)
+	if not ber.read_value(0x30).startswith(encode_oid(OID_ZLIB)):
+		raise IOError("Unsupported compression algorithm.")
+
+	# EncapsulatedContentInfo
+	ber.read_header(0x30)
+	ber.read_value(0x06)
+	ber.read_header(0xa0)
+
+	decompressor = zlib.decompressobj()
+	tag, length = ber.read_header()
+
+	try:
+		for data in ber.iter_octets(tag, length):
+			yield decompressor.decompress(data)
+
+		yield decompressor.flush()
+	except zlib.error as error:
+		raise IOError(error)
+
+
+def is_compressed(data):
+	''' Returns True if the decrypted content data starts with a compressed data structure instead of a MIME message. '''
+
+	return data.startswith("\x30")
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module provides a long-running service that encrypts and decrypts CCE containers over HTTP. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+from __future__ import print_function
+
+import os
+import hmac
+import json
+import stat
+import time
+import socket
+import urlparse
+import threading
+import tempfile
+import BaseHTTPServer
+import SocketServer
+
+from opencce import mime
+from opencce import pkcs7
+from opencce import x509
+from opencce.containers.CCEContainer import CCEContainer, Decryptor
+
+
+# The upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# The number of jobs that are processed at the same time.
+DEFAULT_WORKERS = 4
+
+# Request bodies are read in chunks of this size.
+CHUNK_SIZE = 64 * 1024
+
+# The zlib compression levels that requests may ask for.
+COMPRESSION_LEVELS = range(1, 10)
+
+
+
+def is_loopback(host):
+	''' Returns True if every address that host resolves to is a loopback address. '''
+
+	try:
+		addresses = set(info[4][0] for info in socket.getaddrinfo(host, None))
+	except socket.gaierror:
+		return False
+
+	return all(address.startswith("127.") or address == "::1" for address in addresses)
+
+
+
+class Metrics(object):
+	''' Counts requests and errors and keeps a latency histogram for each endpoint. '''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.endpoints = {}
+		self.started = time.time()
+
+
+	def record(self, endpoint, seconds, error):
+		''' Records a single request. '''
+
+		with self.lock:
+			if endpoint not in self.endpoints:
+				self.endpoints[endpoint] = {
+					"requests": 0, "errors": 0, "seconds": 0.0, "latency": [0] * len(LATENCY_BUCKETS)
+				}
+
+			metrics = self.endpoints[endpoint]
+			metrics["requests"] += 1
+			metrics["errors"] += 1 if error else 0
+			metrics["seconds"] += seconds
+
+			for index, bound in enumerate(LATENCY_BUCKETS):
+				if seconds <= bound:
+					metrics["latency"][index] += 1
+					break
+
+
+	def as_dict(self):
+		''' Returns all counters. Histogram buckets are keyed by their upper bound. '''
+
+		with self.lock:
+			return {
+				"uptime": time.time() - self.started,
+				"endpoints": dict(
+					(endpoint, {
+						"requests": metrics["requests"],
+						"errors": metrics["errors"],
+						"seconds": metrics["seconds"],
+						"latency": [
+							[str(bound), count] for bound, count in zip(LATENCY_BUCKETS, metrics["latency"])
+						]
+					})
+					for endpoint, metrics in self.endpoints.items()
+				)
+			}
+
+
+
+class Service(object):
+	'''
+		Holds everything that is expensive to set up and shared by all requests: the recipient
+		certificate stores (by group name), a Decryptor with all unlocked private keys, a
+		limit on the number of jobs that run at the same time and the metrics. If a token is
+		given, every request has to send it in an "Authorization: Bearer TOKEN" header.
+	'''
+
+	def __init__(self, workers = DEFAULT_WORKERS, token = None):
+		self.groups = {}
+		self.decryptor = Decryptor()
+		self.workers = threading.BoundedSemaphore(workers)
+		self.metrics = Metrics()
+		self.token = token
+
+
+	def add_group(self, name, paths):
+		''' Adds a group of recipients from certificate files and directories of certificates. '''
+
+		store = self.groups.setdefault(name, x509.CertificateStore())
+
+		for path in paths:
+			if os.path.isdir(path):
+				store.add_directory(path)
+			else:
+				store.add_from_file(path)
+
+
+	def add_key(self, key, password = None):
+		''' Adds a private key that is used to decrypt containers. '''
+
+		self.decryptor.add_key(key, password = password)
+
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''
+		Handles a single HTTP request.
+
+		POST /encrypt?recipients=GROUP&name=FILE[&format=FORMAT][&compress=LEVEL]
+			Encrypts the request body as a file called FILE for a group of recipients and
+			responds with the container.
+
+		POST /decrypt
+			Decrypts the container in the request body and responds with its MIME message.
+
+		GET /stats
+			Responds with the request counters and latency histograms as JSON.
+
+		Requests without the token of the service are answered with 401.
+	'''
+
+	server_version = "opencce"
+
+	def do_GET(self):
+		''' Dispatches GET requests. '''
+
+		if not self._is_authorized():
+			self._respond_json(401, {"error": "A valid token is required."})
+		elif urlparse.urlparse(self.path).path == "/stats":
+			self._respond_json(200, self.server.service.metrics.as_dict())
+		else:
+			self._respond_json(404, {"error": "Not found."})
+
+
+	def do_POST(self):
+		''' Dispatches POST requests and records their latency. '''
+
+		url = urlparse.urlparse(self.path)
+		query = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+		handlers = {"/encrypt": self._encrypt, "/decrypt": self._decrypt}
+
+		if not self._is_authorized():
+			self._respond_json(401, {"error": "A valid token is required."})
+			return
+
+		if url.path not in handlers:
+			self._respond_json(404, {"error": "Not found."})
+			return
+
+		if self.headers.getheader("Content-Length") is None:
+			self._respond_json(411, {"error": "A Content-Length is required."})
+			return
+
+		start = time.time()
+		error = True
+
+		self.responded = False
+
+		try:
+			body = _BodyReader(self.rfile, _get_length(self.headers.getheader("Content-Length")))
+			error = not handlers[url.path](body, query)
+		except (IOError, ValueError) as exception:
+			if self.responded:
+				# The response is already on its way, so all we can do is to cut it short.
+				self.log_error("Aborted response: %s", exception)
+				self.close_connection = 1
+			else:
+				self._respond_json(400, {"error": str(exception)})
+		finally:
+			self.server.service.metrics.record(url.path, time.time() - start, error)
+
+
+	def _encrypt(self, body, query):
+		'''
+			Encrypts the request body. Returns False if the request was rejected. All parameters
+			are checked before the body is read, so invalid ones are answered with an error.
+		'''
+
+		group = self.server.service.groups.get(query.get("recipients"))
+		if group is None:
+			self._respond_json(404, {"error": "Unknown recipients."})
+			return False
+
+		output_format = query.get("format", pkcs7.FORMAT_SMIME)
+		if output_format not in pkcs7.FORMATS:
+			raise ValueError("Unsupported format: " + output_format)
+
+		compression_level = None
+		if "compress" in query:
+			if query["compress"] not in [str(level) for level in COMPRESSION_LEVELS]:
+				raise ValueError("Unsupported compression level: " + query["compress"])
+			compression_level = int(query["compress"])
+
+		# The file has to be read twice (MIME type and payload), so it is spooled first.
+		container = CCEContainer()
+		container.recipients = group
+		container.add_stream(_spool(body), os.path.basename(query.get("name", "file")))
+
+		try:
+			with self.server.service.workers:
+				self._start_response("application/pkcs7-mime")
+				container.encrypt_to(self.wfile, output_format = output_format, compression_level = compression_level)
+		finally:
+			container.close()
+
+		return True
+
+
+	def _decrypt(self, body, query):
+		''' Decrypts the request body and streams the MIME message back. '''
+
+		body = _spool(body)
+
+		try:
+			with self.server.service.workers:
+				message = self.server.service.decryptor.open_message(body)
+
+				self._start_response("message/rfc822")
+
+				while True:
+					data = message.read(CHUNK_SIZE)
+					if not data:
+						break
+					self.wfile.write(data)
+		finally:
+			body.close()
+
+		return True
+
+
+	def _is_authorized(self):
+		''' Returns True if the service has no token or the request sends it. '''
+
+		token = self.server.service.token
+		if token is None:
+			return True
+
+		return hmac.compare_digest(self.headers.getheader("Authorization") or "", "Bearer " + token)
+
+
+	def _start_response(self, content_type):
+		''' Sends the headers of a successful response whose body is streamed. '''
+
+		self.responded = True
+
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.end_headers()
+
+
+	def _respond_json(self, status, document):
+		''' Sends a complete JSON response. '''
+
+		body = json.dumps(document)
+
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def address_string(self):
+		# Clients of a Unix socket have no address.
+		return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+	def log_message(self, format, *args):
+		if self.server.log:
+			self.server.log.print("{0} {1}".format(self.address_string(), format % args))
+
+
+
+def _spool(body):
+	'''
+		Reads a whole request body into a temporary file that is kept in memory up to a size
+		and returns it, so slow clients do not hold a worker while they send it.
+	'''
+
+	handle = tempfile.SpooledTemporaryFile(max_size = mime.DEFAULT_SPOOL_SIZE)
+
+	while True:
+		data = body.read(CHUNK_SIZE)
+		if not data:
+			break
+		handle.write(data)
+
+	handle.seek(0)
+	return handle
+
+
+def _get_length(value):
+	''' Returns the value of a Content-Length header as a number. Raises a ValueError if it is invalid. '''
+
+	if not value.strip().isdigit():
+		raise ValueError("Invalid Content-Length: " + value)
+
+	return int(value)
+
+
+
+class _BodyReader(object):
+	''' Reads no more than length bytes of a request body. '''
+
+	def __init__(self, stream, length):
+		self.stream = stream
+		self.remaining = length
+
+
+	def read(self, size = -1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+
+		data = self.stream.read(size) if size else ""
+		self.remaining -= len(data)
+
+		return data
+
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	''' Serves a Service on a TCP port. Every connection is handled by its own thread. '''
+
+	daemon_threads = True
+
+	def __init__(self, address, service, log = None):
+		BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+		self.service = service
+		self.log = log
+
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	''' Serves a Service on a Unix socket. Every connection is handled by its own thread. '''
+
+	daemon_threads = True
+
+	def __init__(self, path, service, log = None):
+		# A socket left behind by a previous instance would make bind() fail. Anything else
+		# at that path is left alone, so bind() fails for it.
+		try:
+			if stat.S_ISSOCK(os.lstat(path).st_mode):
+				os.remove(path)
+		except OSError:
+			pass
+
+		SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+		self.service = service
+		self.log = log
+
+
+	def server_bind(self):
+		SocketServer.UnixStreamServer.server_bind(self)
+
+		# Only the owner may connect, whatever the umask. Nobody can connect before listen().
+		os.chmod(self.server_address, stat.S_IRUSR | stat.S_IWUSR)
+
+		# BaseHTTPRequestHandler expects these to be set.
+		self.server_name = socket.gethostname()
+		self.server_port = 0
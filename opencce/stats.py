@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+''' This module measures time and bytes for each stage of encryption and decryption. '''
+
+##
+## Copyright (c) 2015 Stephan Klein (@privatwolke)
+##
+## Permission is hereby granted, free of charge, to any person obtaining
+## a copy of this software and associated documentation files (the "Software"),
+## to deal in the Software without restriction, including without limitation the
+## rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+## copies of the Software, and to permit persons to whom the Software is furnished
+## to do so, subject to the following conditions:
+##
+## The above copyright notice and this permission notice shall be included in all
+## copies or substantial portions of the Software.
+##
+## THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+## IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+## FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+## COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+## IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+##
+
+
+import time
+import json
+import contextlib
+
+from collections import OrderedDict
+
+
+class Stage(object):
+	''' The totals of a single stage. '''
+
+	def __init__(self):
+		self.calls = 0
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.bytes_in = 0
+		self.bytes_out = 0
+
+
+	def as_dict(self):
+		''' Returns the totals as dictionary. '''
+
+		return OrderedDict([
+			("calls", self.calls), ("wall", self.wall), ("cpu", self.cpu),
+			("bytes_in", self.bytes_in), ("bytes_out", self.bytes_out)
+		])
+
+
+
+class Stats(object):
+	'''
+		Collects wall time, CPU time and the bytes passed in and out of each stage of a
+		pipeline. Stages are nested, for example the cipher stage runs inside the MIME stage
+		that writes to it, so only the time spent in a stage itself is added to it. Data
+		passed between two wrapped stages is counted as output of the one and input of the
+		other. Instances must not be shared between threads.
+
+
+		Example
+		-------
+
+		stats = Stats()
+		container.encrypt_to(handle, stats = stats)
+		print(stats.format())
+
+	'''
+
+	def __init__(self):
+		self.stages = OrderedDict()
+		self.stack = []
+
+
+	def get(self, name):
+		''' Returns the totals of a stage and creates it if needed. '''
+
+		if name not in self.stages:
+			self.stages[name] = Stage()
+
+		return self.stages[name]
+
+
+	def stage(self, name):
+		''' Context manager that adds the time spent inside it to the stage name. '''
+
+		return self._measure(self.get(name))
+
+
+	def writer(self, name, target):
+		''' Wraps a writer, so its write and close calls are measured as stage name. '''
+
+		return _StageWriter(self, name, target)
+
+
+	def reader(self, name, source):
+		''' Wraps a reader, so its read calls are measured as stage name. '''
+
+		return _StageReader(self, name, source)
+
+
+	def iterate(self, name, iterable, consumed = None):
+		'''
+			Generator that measures every step of iterable as stage name. Readers read ahead,
+			so what a stage reads from another stage is not always what it consumes. If
+			consumed is given, it is called after every step and returns the number of bytes
+			that iterable consumed so far, which is then counted as the input of the stage
+			instead.
+		'''
+
+		stage = self.get(name)
+		iterator = iter(iterable)
+		start = stage.bytes_in
+
+		while True:
+			self._push(stage)
+
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			finally:
+				self._pop()
+
+				if consumed:
+					stage.bytes_in = start + consumed()
+
+			if isinstance(item, str):
+				stage.bytes_out += len(item)
+				self._count_in(len(item), stage)
+
+			yield item
+
+
+	def count(self, name, bytes_in = 0, bytes_out = 0):
+		''' Adds bytes to the totals of stage name, for stages that are measured with stage(). '''
+
+		stage = self.get(name)
+		stage.bytes_in += bytes_in
+		stage.bytes_out += bytes_out
+
+
+	def source(self, stream):
+		''' Wraps the input stream, so everything read from it is counted as input of the reading stage. '''
+
+		return _Boundary(self, stream)
+
+
+	def sink(self, output):
+		''' Wraps the output handle, so everything written to it is counted as output of the writing stage. '''
+
+		return _Boundary(self, output)
+
+
+	def as_dict(self):
+		''' Returns the totals of all stages as dictionary. '''
+
+		return OrderedDict((name, stage.as_dict()) for name, stage in self.stages.items())
+
+
+	def as_json(self):
+		''' Returns the totals of all stages as JSON. '''
+
+		return json.dumps({"stages": self.as_dict()})
+
+
+	def format(self):
+		''' Returns the totals of all stages as a table. '''
+
+		lines = ["{0:<12} {1:>8} {2:>10} {3:>10} {4:>14} {5:>14}".format(
+			"Stage", "Calls", "Wall (s)", "CPU (s)", "Bytes in", "Bytes out"
+		)]
+
+		for name, stage in self.stages.items():
+			lines.append("{0:<12} {1:>8} {2:>10.4f} {3:>10.4f} {4:>14} {5:>14}".format(
+				name, stage.calls, stage.wall, stage.cpu, stage.bytes_in, stage.bytes_out
+			))
+
+		return "\n".join(lines)
+
+
+	@contextlib.contextmanager
+	def _measure(self, stage):
+		''' Context manager that adds the time spent inside it to stage. '''
+
+		self._push(stage)
+
+		try:
+			yield
+		finally:
+			self._pop()
+
+
+	def _push(self, stage):
+		''' Enters a stage and pauses the stage that called it. '''
+
+		now = (time.time(), time.clock())
+
+		if self.stack:
+			self._charge(now)
+
+		stage.calls += 1
+		self.stack.append([stage, now])
+
+
+	def _pop(self):
+		''' Leaves the current stage and resumes the stage that called it. '''
+
+		now = (time.time(), time.clock())
+
+		self._charge(now)
+		self.stack.pop()
+
+		if self.stack:
+			self.stack[-1][1] = now
+
+
+	def _charge(self, now):
+		''' Adds the time since the current stage was entered or resumed to it. '''
+
+		stage, start = self.stack[-1]
+		stage.wall += now[0] - start[0]
+		stage.cpu += now[1] - start[1]
+
+
+	def _count_in(self, length, source = None):
+		''' Counts data that the current stage received, unless it received it from itself. '''
+
+		if self.stack and self.stack[-1][0] is not source:
+			self.stack[-1][0].bytes_in += length
+
+
+	def _count_out(self, length, target = None):
+		''' Counts data that the current stage produced, unless it passed it to itself. '''
+
+		if self.stack and self.stack[-1][0] is not target:
+			self.stack[-1][0].bytes_out += length
+
+
+
+class NoStats(Stats):
+	''' Does not measure anything. It is used when no Stats instance is given. '''
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		yield
+
+
+	def writer(self, name, target):
+		return target
+
+
+	def reader(self, name, source):
+		return source
+
+
+	def iterate(self, name, iterable, consumed = None):
+		return iterable
+
+
+	def count(self, name, bytes_in = 0, bytes_out = 0):
+		pass
+
+
+	def source(self, stream):
+		return stream
+
+
+	def sink(self, output):
+		return output
+
+
+
+NO_STATS = NoStats()
+
+
+
+class _StageWriter(object):
+	''' Measures the write and close calls of a writer. '''
+
+	def __init__(self, stats, name, target):
+		self.stats = stats
+		self.stage = stats.get(name)
+		self.target = target
+
+
+	def write(self, data):
+		self.stats._count_out(len(data), self.stage)
+		self.stage.bytes_in += len(data)
+
+		with self.stats._measure(self.stage):
+			self.target.write(data)
+
+
+	def close(self):
+		with self.stats._measure(self.stage):
+			self.target.close()
+
+
+
+class _StageReader(object):
+	''' Measures the read calls of a reader. '''
+
+	def __init__(self, stats, name, source):
+		self.stats = stats
+		self.stage = stats.get(name)
+		self.source = source
+
+
+	def read(self, size = -1):
+		with self.stats._measure(self.stage):
+			data = self.source.read(size)
+
+		self.stage.bytes_out += len(data)
+		self.stats._count_in(len(data), self.stage)
+
+		return data
+
+
+
+class _Boundary(object):
+	''' Counts the data read from the input stream or written to the output handle. '''
+
+	def __init__(self, stats, handle):
+		self.stats = stats
+		self.handle = handle
+
+
+	def read(self, size = -1):
+		data = self.handle.read(size)
+		self.stats._count_in(len(data))
+		return data
+
+
+	def write(self, data):
+		self.stats._count_out(len(data))
+		self.handle.write(data)
+
+
+	def __getattr__(self, name):
+		return getattr(self.handle, name)
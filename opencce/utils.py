@@ -27,39 +27,177 @@
 
 from __future__ import print_function
 
+import os
 import sys
+import hashlib
+import importlib
+import mimetypes
+import threading
 
-try:
-	import magic
-except ImportError:
-	import mimetypes
+from collections import OrderedDict
+
+
+# The number of bytes at the start of a file that are used to guess its MIME type.
+MIMETYPE_HEADER_SIZE = 1024
+
+# The number of sniffed MIME types that are remembered.
+MIMETYPE_CACHE_SIZE = 4096
+
+DEFAULT_MIMETYPE = "application/octet-stream"
+
+# python-magic is optional. It is imported on first use and set to None if it is not available.
+_magic = False
+
+
+
+class LazyModule(object):
+	'''
+		Stands in for a module that takes long to import. The module (and the submodules
+		listed along with it) are only imported when one of its attributes is used first.
+
+
+		Example
+		-------
+
+		M2Crypto = LazyModule("M2Crypto", "M2Crypto.RSA")
+
+		# M2Crypto and M2Crypto.RSA are imported here.
+		key = M2Crypto.RSA.load_key("key.pem")
+
+	'''
+
+	def __init__(self, name, *submodules):
+		self.__dict__["_names"] = (name, ) + submodules
+		self.__dict__["_module"] = None
+
+
+	def __getattr__(self, attribute):
+		if self._module is None:
+			for name in self._names:
+				importlib.import_module(name)
+
+			self.__dict__["_module"] = sys.modules[self._names[0]]
+
+		return getattr(self._module, attribute)
+
+
+
+def split_base64(text, final = False):
+	'''
+		Removes all whitespace from base64 text and splits it into the complete groups of four
+		characters, which can be decoded, and the rest, which has to wait for the next chunk.
+		If final is True, nothing follows, so everything is returned for decoding.
+	'''
+
+	text = "".join(text.split())
+	complete = len(text) if final else len(text) - len(text) % 4
+
+	return text[:complete], text[complete:]
+
+
+def get_magic():
+	''' Returns the magic module of python-magic, or None if it is not installed. '''
+
+	global _magic
+
+	if _magic is False:
+		try:
+			import magic
+		except ImportError:
+			magic = None
+
+		_magic = magic
+
+	return _magic
+
+
+
+class LRUCache(object):
+	''' A thread safe mapping that only keeps the max_size most recently used entries. '''
+
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+
+	def get(self, key, default = None):
+		''' Returns the value for key and marks it as recently used. '''
+
+		with self.lock:
+			if key not in self.entries:
+				return default
+
+			value = self.entries.pop(key)
+			self.entries[key] = value
+			return value
+
+
+	def put(self, key, value):
+		''' Stores value for key and drops the least recently used entry if the cache is full. '''
+
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = value
+
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last = False)
 
 
 
 class Utils(object):
 	''' Provides common utility functions. '''
 
+	_mimetype_cache = LRUCache(MIMETYPE_CACHE_SIZE)
+
 	def __init__(self):
 		pass
 
 
 	@staticmethod
-	def get_mimetype(filename, buf = ""):
-		''' Try our best to guess the MIME type of a given file. '''
+	def get_mimetype(filename, buf = None):
+		'''
+			Try our best to guess the MIME type of a given file. Well known extensions are looked
+			up in a table. Only other files are sniffed with libmagic (if available), using buf
+			or the first bytes of the file if buf is None. Sniffed results are cached by
+			extension and a hash of the sniffed bytes.
+		'''
 
-		if magic:
-			try:
-				mimetype = magic.from_file(filename, mime = True)
-			except IOError:
-				mimetype = magic.from_buffer(buf, mime = True)
-		else:
-			mimetype, _ = mimetypes.guess_type(filename)
-			if not mimetype:
-				mimetype = "application/octet-stream"
+		mimetype, encoding = mimetypes.guess_type(filename, strict = False)
+
+		# Compressed files (e.g. file.tar.gz) are reported as their uncompressed type, so we sniff them.
+		if mimetype and not encoding:
+			return tuple(mimetype.split("/", 1))
+
+		magic = get_magic()
+
+		if not magic:
+			return tuple((mimetype or DEFAULT_MIMETYPE).split("/", 1))
+
+		if buf is None:
+			buf = Utils._read_header(filename)
+
+		key = (os.path.splitext(filename)[1].lower(), hashlib.sha1(buf).digest())
+		mimetype = Utils._mimetype_cache.get(key)
+
+		if not mimetype:
+			mimetype = magic.from_buffer(buf, mime = True) or DEFAULT_MIMETYPE
+			Utils._mimetype_cache.put(key, mimetype)
 
 		return tuple(mimetype.split("/", 1))
 
 
+	@staticmethod
+	def _read_header(filename):
+		''' Returns the first bytes of a file, or an empty string if it can not be read. '''
+
+		try:
+			with open(filename, "rb") as handle:
+				return handle.read(MIMETYPE_HEADER_SIZE)
+		except IOError:
+			return ""
+
+
 
 class Log(object):
 	''' A simple logging class that supports partial log messages. '''
@@ -101,3 +239,45 @@ class Log(object):
 
 		if not self.quiet:
 			print("... [\033[0;33mWARNING\033[0m] {0}".format(message), file = sys.stderr)
+
+
+
+class ChunkReader(object):
+	''' Provides a read-only file interface on top of an iterable that yields strings. '''
+
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.buffer = ""
+		self.eof = False
+
+
+	def _fill(self, size):
+		''' Pulls chunks into the buffer until it holds at least size bytes or the input ends. '''
+
+		pieces = [self.buffer]
+		available = len(self.buffer)
+
+		while not self.eof and (size < 0 or available < size):
+			try:
+				chunk = next(self.chunks)
+			except StopIteration:
+				self.eof = True
+				break
+
+			pieces.append(chunk)
+			available += len(chunk)
+
+		self.buffer = "".join(pieces)
+
+
+	def read(self, size = -1):
+		''' Reads up to size bytes. Reads everything that is left if size is negative. '''
+
+		self._fill(size)
+
+		if size < 0:
+			size = len(self.buffer)
+
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
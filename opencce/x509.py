@@ -24,13 +24,22 @@
 ## CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 ##
 
-import tempfile
-import lxml.etree
-import lxml.builder
-import M2Crypto.X509
+import os
+import json
+import base64
+import hashlib
 
+from StringIO import StringIO
+from collections import OrderedDict
 from zipfile import ZipFile, ZIP_DEFLATED
 
+from opencce import pkcs7
+from opencce.utils import LazyModule
+
+
+lxml = LazyModule("lxml", "lxml.etree", "lxml.builder")
+M2Crypto = LazyModule("M2Crypto", "M2Crypto.X509")
+
 
 ASIT_NAMESPACE               = "http://www.a-sit.at/2006/12/09/XMLCertificateStore"
 CERTIFICATE_STORE_NAME_INNER = "CertificateStore"
@@ -38,39 +47,280 @@ CERTIFICATE_STORE_NAME       = "RecipientCertificates.xml.zip"
 CERTIFICATE_GROUP_NAME       = "opencce certificates"
 
 
-E  = lxml.builder.ElementMaker()
-EE = lxml.builder.ElementMaker(
-	namespace = ASIT_NAMESPACE,
-	nsmap = {"certStore": ASIT_NAMESPACE}
-)
 
+def get_fingerprints(certificate):
+	'''
+		Returns the SHA-1 and SHA-256 fingerprints of a M2Crypto X509 instance or its DER
+		encoding as uppercase hex strings.
+	'''
 
-class CertificateStore(set):
-	''' A simple data structure that stores X509 certificates. '''
+	der = certificate if isinstance(certificate, str) else certificate.as_der()
 
-	def add(self, certificate):
-		''' Adds a new certificate from a string buffer in either CER/DER or PEM format. '''
+	return hashlib.sha1(der).hexdigest().upper(), hashlib.sha256(der).hexdigest().upper()
 
+
+def load_certificate(certificate):
+	''' Returns a M2Crypto X509 instance from a string buffer in either CER/DER or PEM format. '''
+
+	try:
+		return M2Crypto.X509.load_cert_string(certificate, M2Crypto.X509.FORMAT_DER)
+	except M2Crypto.X509.X509Error:
 		try:
-			cer = M2Crypto.X509.load_cert_string(certificate, M2Crypto.X509.FORMAT_DER)
-		except M2Crypto.X509.X509Error:
-			try:
-				cer = M2Crypto.X509.load_cert_string(certificate, M2Crypto.X509.FORMAT_PEM)
-			except:
-				raise IOError("Could not load certificate (unknown format).")
+			return M2Crypto.X509.load_cert_string(certificate, M2Crypto.X509.FORMAT_PEM)
+		except:
+			raise IOError("Could not load certificate (unknown format).")
+
+
+
+class CertificateStore(object):
+	'''
+		A simple data structure that stores X509 certificates. Certificates are indexed by their
+		SHA-1 fingerprint, so every certificate is only stored once, and can be looked up by
+		SHA-1 or SHA-256 fingerprint, subject common name and issuer and serial number. The
+		archive and the X509 stack are built once and cached until the store is changed.
+		Certificates that were added in DER encoding are only loaded when they are needed.
+	'''
+
+	def __init__(self, certificates = ()):
+		# The values are M2Crypto X509 instances, or DER strings until they are needed.
+		self._certificates = OrderedDict()
+		self._details = {}
+		self._sha256 = {}
+		self._names = {}
+		self._issuers = {}
+		self._invalidate()
+
+		self.update(certificates)
+
+
+	def add(self, certificate):
+		'''
+			Adds a new certificate from a string buffer in either CER/DER or PEM format. Returns
+			the stored M2Crypto X509 instance, which is the existing one for duplicates.
+		'''
+
+		return self.add_certificate(load_certificate(certificate))
+
+
+	def add_certificate(self, certificate):
+		''' Adds a M2Crypto X509 instance unless the store already holds the same certificate. '''
+
+		der = certificate.as_der()
+		sha1, sha256 = get_fingerprints(der)
+		name = certificate.get_subject().commonName
+
+		return self._get(self._add(certificate, sha1, sha256, name, pkcs7.get_issuer_and_serial(der)))
+
+
+	def _add(self, certificate, sha1, sha256, name, issuer_and_serial):
+		'''
+			Adds a certificate (a M2Crypto X509 instance or its DER encoding) with known
+			fingerprints, subject common name and issuer and serial number to the indexes.
+			Returns the SHA-1 fingerprint.
+		'''
+
+		if sha1 in self._certificates:
+			return sha1
+
+		self._certificates[sha1] = certificate
+		self._details[sha1] = sha256, name, issuer_and_serial
+		self._sha256[sha256] = sha1
+		self._issuers[issuer_and_serial] = sha1
+
+		if name is not None:
+			self._names.setdefault(name, []).append(sha1)
+
+		self._invalidate()
+		return sha1
+
+
+	def _get(self, sha1):
+		''' Returns the stored certificate as M2Crypto X509 instance and loads it if necessary. '''
+
+		certificate = self._certificates[sha1]
+
+		if isinstance(certificate, str):
+			certificate = M2Crypto.X509.load_cert_string(certificate, M2Crypto.X509.FORMAT_DER)
+			self._certificates[sha1] = certificate
+
+		return certificate
+
+
+	def update(self, certificates):
+		''' Adds all M2Crypto X509 instances from an iterable, for example another store. '''
+
+		for certificate in certificates:
+			self.add_certificate(certificate)
+
+
+	def discard(self, certificate):
+		''' Removes a certificate given as M2Crypto X509 instance or fingerprint if it is stored. '''
+
+		sha1 = self._find(certificate)
+		if sha1 is None:
+			return
+
+		del self._certificates[sha1]
+		sha256, name, issuer_and_serial = self._details.pop(sha1)
+
+		del self._sha256[sha256]
+		del self._issuers[issuer_and_serial]
+
+		if name is not None:
+			self._names[name].remove(sha1)
+			if not self._names[name]:
+				del self._names[name]
+
+		self._invalidate()
+
+
+	def remove(self, certificate):
+		''' Removes a certificate given as M2Crypto X509 instance or fingerprint. '''
+
+		if certificate not in self:
+			raise KeyError(certificate)
+
+		self.discard(certificate)
+
+
+	def clear(self):
+		''' Removes all certificates. '''
+
+		self._certificates.clear()
+		self._details.clear()
+		self._sha256.clear()
+		self._names.clear()
+		self._issuers.clear()
+		self._invalidate()
+
+
+	def get_by_fingerprint(self, fingerprint):
+		''' Returns the certificate with the SHA-1 or SHA-256 fingerprint (hex, colons allowed) or None. '''
+
+		sha1 = self._find(fingerprint)
+
+		return self._get(sha1) if sha1 else None
+
+
+	def get_by_issuer_and_serial(self, issuer, serial):
+		''' Returns the certificate with the DER encoded issuer name and serial number or None. '''
+
+		sha1 = self._issuers.get((issuer, serial))
+
+		return self._get(sha1) if sha1 else None
+
 
-		super(CertificateStore, self).add(cer)
+	def find_by_name(self, name):
+		''' Returns a list of all certificates with the subject common name. '''
+
+		return [self._get(sha1) for sha1 in self._names.get(name, [])]
+
+
+	def _find(self, certificate):
+		''' Returns the SHA-1 fingerprint of a stored certificate or None. '''
+
+		if isinstance(certificate, M2Crypto.X509.X509):
+			sha1 = get_fingerprints(certificate)[0]
+		else:
+			fingerprint = certificate.replace(":", "").upper()
+			sha1 = self._sha256.get(fingerprint, fingerprint)
+
+		return sha1 if sha1 in self._certificates else None
+
+
+	def __contains__(self, certificate):
+		return self._find(certificate) is not None
+
+
+	def __iter__(self):
+		return iter([self._get(sha1) for sha1 in self._certificates.keys()])
+
+
+	def __len__(self):
+		return len(self._certificates)
+
+
+	def _invalidate(self):
+		''' Drops the cached archive and stack after the store was changed. '''
+
+		self._archive = None
+		self._stack = None
 
 
 	def add_from_file(self, filename):
 		''' Adds a new certificate from a filename in either CER/DER or PEM format. '''
 
-		return self.add(open(filename, "r").read())
+		with open(filename, "rb") as handle:
+			return self.add(handle.read())
+
+
+	def add_directory(self, path, cache = None):
+		'''
+			Adds all certificates from the files in a directory and returns how many were read.
+			Files that do not contain a certificate are skipped. If cache is the name of a file,
+			the DER encoding, fingerprints, common name and issuer and serial number of every
+			certificate are kept there, so files that did not change since the last call are
+			neither guessed nor parsed again. Their certificates are only loaded when they are
+			needed.
+		'''
+
+		entries = _read_directory_cache(cache) if cache else {}
+		changed = False
+		found = OrderedDict()
+		loaded = {}
+
+		for name in sorted(os.listdir(path)):
+			filename = os.path.abspath(os.path.join(path, name))
+			if not os.path.isfile(filename):
+				continue
+
+			status = os.stat(filename)
+			entry = entries.get(filename)
+
+			if not _is_current(entry, status):
+				entry, loaded[filename] = _read_directory_entry(filename, status)
+				changed = True
+
+			found[filename] = entry
+
+		count = 0
+
+		for filename, entry in found.items():
+			if entry["der"] is None:
+				continue
+
+			# Certificates that were just read are not loaded again.
+			certificate = loaded.get(filename) or base64.b64decode(entry["der"])
+			issuer_and_serial = base64.b64decode(entry["issuer"]), base64.b64decode(entry["serial"])
+
+			self._add(certificate, entry["sha1"], entry["sha256"], entry["name"], issuer_and_serial)
+			count += 1
+
+		# Entries of deleted files are dropped as well.
+		if cache and (changed or len(found) != len(entries)):
+			_write_directory_cache(cache, found)
+
+		return count
 
 
 	def get_archive(self):
 		''' Creates a CCE compliant RecipientStore.xml.zip file and returns a handle to it. '''
 
+		if self._archive is None:
+			self._archive = self._build_archive()
+
+		return StringIO(self._archive)
+
+
+	def _build_archive(self):
+		''' Returns the contents of a CCE compliant RecipientStore.xml.zip file. '''
+
+		E  = lxml.builder.ElementMaker()
+		EE = lxml.builder.ElementMaker(
+			namespace = ASIT_NAMESPACE,
+			nsmap = {"certStore": ASIT_NAMESPACE}
+		)
+
 		# Build the CertificateStoreConfiguration element.
 		# Everything here is required or the Container won't open in the original CCE program.
 		xml = EE.XMLCertificateStore(
@@ -119,8 +369,8 @@ class CertificateStore(set):
 
 		xml_text = lxml.etree.tostring(xml, xml_declaration = True, encoding = "utf-8")
 
-		# We create the ZIP archive as a temporary file.
-		archive = tempfile.TemporaryFile()
+		# We create the ZIP archive in memory, it is small enough.
+		archive = StringIO()
 
 		try:
 			# Try to use ZIP_DEFLATED.
@@ -132,21 +382,19 @@ class CertificateStore(set):
 		zipfile.writestr(CERTIFICATE_STORE_NAME_INNER, xml_text)
 		zipfile.close()
 
-		# Rewind the file handle so we can read it again later.
-		archive.seek(0)
-
-		return archive
+		return archive.getvalue()
 
 
 	def as_stack(self):
 		''' Returns the certificates as a M2Crypto X509_Stack instance. '''
 
-		stack = M2Crypto.X509.X509_Stack()
+		if self._stack is None:
+			self._stack = M2Crypto.X509.X509_Stack()
 
-		for certificate in set(self):
-			stack.push(certificate)
+			for certificate in self:
+				self._stack.push(certificate)
 
-		return stack
+		return self._stack
 
 
 	@staticmethod
@@ -169,3 +417,62 @@ class CertificateStore(set):
 			]))
 
 		return instance
+
+
+
+def _is_current(entry, status):
+	''' Returns True if a cache entry is complete and its file did not change. '''
+
+	if not entry or entry["mtime"] != status.st_mtime or entry["size"] != status.st_size:
+		return False
+
+	# Caches of older versions do not have the issuer and serial number.
+	return entry["der"] is None or "issuer" in entry
+
+
+def _read_directory_entry(filename, status):
+	'''
+		Returns the cache entry for a file and the M2Crypto X509 instance it was made from. The
+		certificate is None in both if the file has none.
+	'''
+
+	entry = {"mtime": status.st_mtime, "size": status.st_size, "der": None}
+
+	with open(filename, "rb") as handle:
+		try:
+			certificate = load_certificate(handle.read())
+		except IOError:
+			return entry, None
+
+	der = certificate.as_der()
+	issuer, serial = pkcs7.get_issuer_and_serial(der)
+
+	entry["der"] = base64.b64encode(der)
+	entry["sha1"], entry["sha256"] = get_fingerprints(der)
+	entry["name"] = certificate.get_subject().commonName
+	entry["issuer"], entry["serial"] = base64.b64encode(issuer), base64.b64encode(serial)
+
+	return entry, certificate
+
+
+def _read_directory_cache(cache):
+	''' Returns the entries of a directory cache file, or nothing if it is missing or invalid. '''
+
+	try:
+		with open(cache, "r") as handle:
+			entries = json.load(handle)
+	except (IOError, ValueError):
+		return {}
+
+	return entries if isinstance(entries, dict) else {}
+
+
+def _write_directory_cache(cache, entries):
+	''' Replaces the directory cache file, so readers never see a partially written cache. '''
+
+	temporary = "{0}.{1}.tmp".format(cache, os.getpid())
+
+	with open(temporary, "w") as handle:
+		json.dump(entries, handle)
+
+	os.rename(temporary, cache)
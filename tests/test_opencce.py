@@ -2,9 +2,29 @@
 # coding: utf-8
 
 import os
+import sys
+import mmap
+import json
 import base64
+import shutil
+import tempfile
 import StringIO
-from opencce.containers.CCEContainer import CCEContainer
+import socket
+import httplib
+import threading
+import subprocess
+from opencce import batch
+from opencce import backends
+from opencce import background
+from opencce import extract
+from opencce import pkcs7
+from opencce import server
+from opencce import x509
+from opencce.keys import KeyIndex
+from opencce.utils import Utils
+from opencce.stats import Stats
+from opencce.containers import CCEContainer as CCEContainer_module
+from opencce.containers.CCEContainer import CCEContainer, Decryptor
 
 CERTIFICATE = "tests/testing-certificate.pem"
 KEY         = "tests/testing-key.pem"
@@ -24,3 +44,854 @@ def test_library():
 	c = CCEContainer.load(StringIO.StringIO(encrypted), KEY)
 	path, filename, handle = list(c.export())[0]
 	assert CERTIFICATE.split("/")[1] == filename
+
+def test_streaming_encryption():
+	c = CCEContainer()
+	c.add(CERTIFICATE, directory = "nested/directory")
+	c.add_recipient_certificate(CERTIFICATE)
+
+	output = StringIO.StringIO()
+	c.encrypt_to(output)
+	encrypted = output.getvalue()
+
+	assert "application/x-pkcs7-mime" in encrypted
+	assert base64.b64decode(encrypted.split("\n\n")[1])
+
+	c = CCEContainer.load(StringIO.StringIO(encrypted), KEY)
+	path, filename, handle = list(c.export())[0]
+	assert path == ["nested", "directory"]
+	assert filename == CERTIFICATE.split("/")[1]
+	assert handle.read() == open(CERTIFICATE, "r").read()
+	assert len(c.recipients) == 1
+
+def test_streaming_decryption():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add(KEY, directory = "keys")
+	c.add_recipient_certificate(CERTIFICATE)
+
+	output = StringIO.StringIO()
+	c.encrypt_to(output)
+
+	for encrypted in [c.encrypt(), output.getvalue()]:
+		expected = CCEContainer.load(StringIO.StringIO(encrypted), KEY)
+		loaded = CCEContainer.load_stream(StringIO.StringIO(encrypted), KEY, spool_size = 16)
+
+		assert len(loaded.recipients) == 1
+		assert sorted((path, name, handle.read()) for path, name, handle in loaded.export()) == \
+			sorted((path, name, handle.read()) for path, name, handle in expected.export())
+
+def test_output_formats():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+
+	for output_format in pkcs7.FORMATS:
+		output = StringIO.StringIO()
+		c.encrypt_to(output, output_format = output_format)
+
+		for encrypted in [c.encrypt(output_format = output_format), output.getvalue()]:
+			assert pkcs7.detect_format(encrypted) == output_format
+
+			for converted_format in pkcs7.FORMATS:
+				converted = StringIO.StringIO()
+				pkcs7.convert(StringIO.StringIO(encrypted), converted, converted_format)
+				assert pkcs7.detect_format(converted.getvalue()) == converted_format
+
+				for load in [CCEContainer.load, CCEContainer.load_stream]:
+					path, filename, handle = list(load(StringIO.StringIO(converted.getvalue()), KEY).export())[0]
+					assert CERTIFICATE.split("/")[1] == filename
+
+def test_compression():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add(KEY)
+	c.add_recipient_certificate(CERTIFICATE)
+
+	for output_format in pkcs7.FORMATS:
+		encrypted = c.encrypt(output_format = output_format, compression_level = 9)
+
+		for load in [CCEContainer.load, CCEContainer.load_stream]:
+			files = dict((name, handle.read()) for _, name, handle in load(StringIO.StringIO(encrypted), KEY).export())
+			assert files[KEY.split("/")[1]] == open(KEY, "r").read()
+			assert files[CERTIFICATE.split("/")[1]] == open(CERTIFICATE, "r").read()
+
+def test_batch_encryption():
+	directory = tempfile.mkdtemp()
+
+	try:
+		manifest = StringIO.StringIO("\n".join([
+			"output,files,certificates",
+			"{0},{1};{2},{1}".format(os.path.join(directory, "a.cce"), CERTIFICATE, KEY),
+			"{0},{1},{2}".format(os.path.join(directory, "b.cce"), os.path.join(directory, "missing"), CERTIFICATE)
+		]))
+
+		jobs = batch.read_manifest(manifest)
+		assert jobs[0].files == [CERTIFICATE, KEY]
+
+		# JSONL values are lists, single strings are not split into characters.
+		assert batch.read_manifest(StringIO.StringIO(json.dumps(
+			{"output": "a.cce", "files": [CERTIFICATE, KEY], "certificates": CERTIFICATE}
+		))) == [batch.BatchJob("a.cce", [CERTIFICATE, KEY], [CERTIFICATE])]
+
+		try:
+			batch.read_manifest(StringIO.StringIO(json.dumps({"output": "a.cce", "files": 3, "certificates": []})))
+			assert False
+		except IOError:
+			pass
+
+		results = dict((result.job.output, result.error) for result in batch.encrypt_batch(jobs, 2))
+		assert results[jobs[0].output] is None
+		assert results[jobs[1].output]
+
+		# A job that fails while it writes leaves nothing behind. The workers inherit the failure.
+		def write_message(self, output, stats):
+			output.write("x" * 10000)
+			raise IOError("Failed to read a file.")
+
+		original = CCEContainer.write_message
+		CCEContainer.write_message = write_message
+
+		try:
+			job = batch.BatchJob(os.path.join(directory, "c.cce"), [CERTIFICATE], [CERTIFICATE])
+			assert list(batch.encrypt_batch([job], 1)) == [batch.BatchResult(job, "Failed to read a file.")]
+			assert sorted(os.listdir(directory)) == ["a.cce"]
+		finally:
+			CCEContainer.write_message = original
+
+		with open(jobs[0].output, "rb") as handle:
+			assert len(list(CCEContainer.load_stream(handle, KEY).export())) == 2
+	finally:
+		shutil.rmtree(directory)
+
+def test_batch_decryption():
+	directory = tempfile.mkdtemp()
+
+	try:
+		c = CCEContainer()
+		c.add(CERTIFICATE, directory = "nested")
+		c.add_recipient_certificate(CERTIFICATE)
+
+		container = os.path.join(directory, "container.cce")
+		with open(container, "wb") as handle:
+			c.encrypt_to(handle)
+
+		with open(container, "rb") as handle:
+			recipient_info = pkcs7.EnvelopedDataReader(pkcs7.open_reader(handle)).recipient_infos[0]
+
+		assert pkcs7.format_name(recipient_info.issuer).endswith("CN=TESTING")
+		assert pkcs7.format_serial(recipient_info.serial) == "DD:1B:1E:FB:AE:A7:B2:65"
+
+		key_index = KeyIndex.from_directory("tests")
+		assert key_index.find([recipient_info]) == KEY
+		assert key_index.find_recipient([recipient_info]) == (KEY, recipient_info)
+		assert key_index.find_recipient([]) == (None, None)
+
+		# Containers with the same name and existing directories never share a target.
+		os.mkdir(os.path.join(directory, "copy"))
+		copy = os.path.join(directory, "copy", "container.cce")
+		shutil.copy(container, copy)
+		os.mkdir(os.path.join(directory, "container"))
+
+		results = list(batch.decrypt_batch([container, copy], key_index, directory, processes = 1))
+		assert sorted(results) == sorted([batch.BatchResult(container, None), batch.BatchResult(copy, None)])
+		assert os.listdir(os.path.join(directory, "container")) == []
+
+		for target in ["container0", "container01"]:
+			assert os.path.isfile(os.path.join(directory, target, "nested", CERTIFICATE.split("/")[1]))
+	finally:
+		shutil.rmtree(directory)
+
+def test_decryptor():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+	encrypted = c.encrypt()
+
+	for certificate in [None, CERTIFICATE]:
+		decryptor = Decryptor()
+		decryptor.add_key(KEY, certificate = certificate)
+
+		for _ in range(3):
+			path, filename, handle = list(decryptor.decrypt(StringIO.StringIO(encrypted)).export())[0]
+			assert CERTIFICATE.split("/")[1] == filename
+
+	try:
+		Decryptor().decrypt(StringIO.StringIO(encrypted))
+		assert False
+	except IOError:
+		pass
+
+def test_decryptor_key_routing():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+	envelope = pkcs7.EnvelopedDataReader(pkcs7.open_reader(StringIO.StringIO(c.encrypt())))
+
+	# Other recipients in front of ours.
+	recipient_info = envelope.recipient_infos[0]
+	envelope.recipient_infos = [recipient_info._replace(serial = serial) for serial in range(10)] + [recipient_info]
+
+	import M2Crypto
+	calls = []
+
+	class CountingKey(object):
+		def __init__(self, key):
+			self.key = key
+
+		def private_decrypt(self, *args):
+			calls.append(args)
+			return self.key.private_decrypt(*args)
+
+	key = CountingKey(M2Crypto.RSA.load_key(KEY))
+
+	decryptor = Decryptor()
+	decryptor.index[(recipient_info.issuer, recipient_info.serial)] = key
+	assert envelope.get_content_key(*decryptor._get_keys(envelope))
+	assert len(calls) == 1
+
+	# An envelope whose header was already read is decrypted as it is.
+	routed = Decryptor()
+	routed.add_key(KEY, certificate = (recipient_info.issuer, recipient_info.serial))
+	reader = pkcs7.EnvelopedDataReader(pkcs7.open_reader(StringIO.StringIO(c.encrypt())))
+	assert len(routed.decrypt(reader)) == 1
+
+	# Keys without a certificate still try every recipient.
+	decryptor = Decryptor()
+	decryptor.keys.append(key)
+	envelope.recipient_infos.reverse()
+	assert envelope.get_content_key(*decryptor._get_keys(envelope))
+	assert len(calls) == 2
+
+def test_certificate_store_cache():
+	c = CCEContainer()
+	c.add_recipient_certificate(CERTIFICATE)
+
+	archive = c.recipients.get_archive().read()
+	assert c.recipients.get_archive().read() == archive
+	assert c.recipients.as_stack() is c.recipients.as_stack()
+	assert [certificate.as_der() for certificate in c.recipients.as_stack()] == \
+		[certificate.as_der() for certificate in c.recipients]
+
+	c.recipients.clear()
+	assert len(c.recipients.as_stack()) == 0
+	assert c.recipients.get_archive().read() != archive
+
+def test_certificate_store_index():
+	c = CCEContainer()
+	c.add_recipient_certificate(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+	assert len(c.recipients) == 1
+
+	certificate = list(c.recipients)[0]
+	sha1 = certificate.get_fingerprint(md = "sha1")
+	sha256 = certificate.get_fingerprint(md = "sha256")
+	assert certificate in c.recipients
+	assert c.recipients.get_by_fingerprint(sha1.lower()) is certificate
+	assert c.recipients.get_by_fingerprint(sha256) is certificate
+	assert c.recipients.find_by_name(certificate.get_subject().commonName) == [certificate]
+	assert c.recipients.get_by_issuer_and_serial(*pkcs7.get_issuer_and_serial(certificate)) is certificate
+
+	c.recipients.discard(sha1)
+	assert len(c.recipients) == 0
+	assert c.recipients.find_by_name(certificate.get_subject().commonName) == []
+
+def test_certificate_directory_cache():
+	directory = tempfile.mkdtemp()
+
+	try:
+		shutil.copy(CERTIFICATE, directory)
+		shutil.copy(KEY, directory)
+		cache = os.path.join(directory, "cache.json")
+
+		for _ in range(2):
+			store = x509.CertificateStore()
+			# The key file contains the same certificate.
+			assert store.add_directory(directory, cache = cache) == 2
+			assert len(store) == 1
+			assert os.path.exists(cache)
+
+		# Cached certificates are only loaded when they are needed.
+		certificate = x509.load_certificate(open(CERTIFICATE).read())
+		assert all(isinstance(value, str) for value in store._certificates.values())
+		assert store.get_by_issuer_and_serial(*pkcs7.get_issuer_and_serial(certificate)).as_der() == certificate.as_der()
+		assert list(store)[0].as_der() == certificate.as_der()
+
+		store.discard(certificate)
+		assert len(store) == 0
+	finally:
+		shutil.rmtree(directory)
+
+def test_mimetype():
+	assert Utils.get_mimetype("document.pdf", "") == ("application", "pdf")
+	assert Utils.get_mimetype(CERTIFICATE) == Utils.get_mimetype(CERTIFICATE)
+	assert Utils.get_mimetype("image.png") == ("image", "png")
+
+def test_lazy_files():
+	directory = tempfile.mkdtemp()
+
+	try:
+		c = CCEContainer()
+		c.add_recipient_certificate(CERTIFICATE)
+
+		for index in range(3):
+			path = os.path.join(directory, "file{0}.bin".format(index))
+			with open(path, "wb") as handle:
+				handle.write(os.urandom(1000 + index * 70000))
+			c.add(path)
+
+		assert all(cce_file.handle is None for cce_file in c)
+
+		# Exported handles stay usable until the caller closes them.
+		exported = list(c.export())
+		for path, filename, handle in exported:
+			assert handle.read() == open(os.path.join(directory, filename), "rb").read()
+			handle.close()
+
+		loaded = CCEContainer.load(StringIO.StringIO(c.encrypt()), KEY)
+		for path, filename, handle in loaded.export():
+			assert handle.read() == open(os.path.join(directory, filename), "rb").read()
+	finally:
+		shutil.rmtree(directory)
+
+def test_add_tree():
+	directory = tempfile.mkdtemp()
+
+	try:
+		for path in ["a.txt", "sub/b.txt", "sub/c.o", "build/d.txt"]:
+			path = os.path.join(directory, path)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, "w") as handle:
+				handle.write(path)
+
+		c = CCEContainer()
+		c.add_recipient_certificate(CERTIFICATE)
+		assert c.add_tree(directory, directory = "root", exclude = ["*.o", "build"]) == 2
+
+		loaded = CCEContainer.load(StringIO.StringIO(c.encrypt()), KEY)
+		assert sorted((path, filename) for path, filename, handle in loaded.export()) == \
+			[(["root"], "a.txt"), (["root", "sub"], "b.txt")]
+	finally:
+		shutil.rmtree(directory)
+
+def test_add_relative_tree():
+	directory = tempfile.mkdtemp()
+
+	try:
+		project = os.path.join(directory, "project")
+		os.makedirs(os.path.join(project, "sub"))
+		for path in ["a.txt", "sub/b.txt"]:
+			with open(os.path.join(project, path), "w") as handle:
+				handle.write(path)
+
+		environment = dict(os.environ, PYTHONPATH = os.getcwd())
+		output = os.path.join(directory, "out.cce")
+
+		for tree, cwd, expected in [
+			(".", project, [(["project"], "a.txt"), (["project", "sub"], "b.txt")]),
+			("..", os.path.join(project, "sub"), [(["project"], "a.txt"), (["project", "sub"], "b.txt")])
+		]:
+			subprocess.check_call([
+				sys.executable, "-m", "opencce", "-q", "encrypt", "-r", "-O", output, tree,
+				"-c", os.path.abspath(CERTIFICATE)
+			], cwd = cwd, env = environment)
+
+			with open(output, "rb") as handle:
+				loaded = CCEContainer.load_stream(handle, KEY)
+				assert sorted((path, filename) for path, filename, _ in loaded.export()) == expected
+
+		# Relative components never end up in a container.
+		assert CCEContainer_module.CCEContainerFile(None, "a.txt", "../x/./../y/").directory == "x/y"
+		assert CCEContainer_module.CCEContainerFile(None, "a.txt", "..").directory == ""
+	finally:
+		shutil.rmtree(directory)
+
+def test_selective_decryption():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add(KEY, directory = "keys")
+	c.add_recipient_certificate(CERTIFICATE)
+
+	for compression_level in [None, 6]:
+		encrypted = c.encrypt(compression_level = compression_level)
+		decryptor = Decryptor()
+		decryptor.add_key(KEY)
+
+		files = sorted(decryptor.list_files(StringIO.StringIO(encrypted)))
+		assert [(path, filename) for path, filename, _, _ in files] == \
+			[([], CERTIFICATE.split("/")[1]), (["keys"], KEY.split("/")[1])]
+		assert [size for _, _, _, size in files] == [os.path.getsize(CERTIFICATE), os.path.getsize(KEY)]
+
+		loaded = decryptor.decrypt(StringIO.StringIO(encrypted), patterns = ["keys/*"])
+		assert [(path, filename) for path, filename, _ in loaded.export()] == [(["keys"], KEY.split("/")[1])]
+		assert len(loaded.recipients) == 1
+
+def test_extract():
+	directory = tempfile.mkdtemp()
+
+	try:
+		c = CCEContainer()
+		c.add(CERTIFICATE, directory = "nested/directory")
+		c.add(KEY, directory = "../keys")
+
+		results = extract.extract(c, directory, fsync = True)
+		assert all(written for _, written in results)
+		assert open(os.path.join(directory, "nested", "directory", CERTIFICATE.split("/")[1])).read() == \
+			open(CERTIFICATE).read()
+		assert os.path.isfile(os.path.join(directory, "keys", KEY.split("/")[1]))
+
+		assert not any(written for _, written in extract.extract(c, directory, policy = extract.SKIP))
+	finally:
+		shutil.rmtree(directory)
+
+def test_stats():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+
+	encrypt_stats = Stats()
+	encrypted = c.encrypt(compression_level = 6, stats = encrypt_stats)
+	assert set(encrypt_stats.stages) == set(["mime", "compress", "cipher", "key_wrap", "output"])
+	assert encrypt_stats.stages["output"].bytes_out == len(encrypted) + 1
+	assert encrypt_stats.stages["compress"].bytes_out == encrypt_stats.stages["cipher"].bytes_in
+
+	for load in [CCEContainer.load, CCEContainer.load_stream]:
+		load_stats = Stats()
+		load(StringIO.StringIO(encrypted), KEY, stats = load_stats)
+		assert load_stats.stages["decompress"].bytes_out == encrypt_stats.stages["compress"].bytes_in
+		assert json.loads(load_stats.as_json())["stages"]["decompress"]["calls"] >= 1
+
+	# Decryption stages count what they consume, not what was read ahead.
+	payload = os.urandom(100000)
+	c = CCEContainer()
+	c.add_stream(StringIO.StringIO(payload), "payload.bin")
+	c.add_recipient_certificate(CERTIFICATE)
+
+	for output_format in pkcs7.FORMATS:
+		encrypted = c.encrypt(output_format = output_format)
+		ciphertext = pkcs7.EnvelopedDataReader(pkcs7.open_reader(StringIO.StringIO(encrypted))).iter_content()
+
+		load_stats = Stats()
+		loaded = CCEContainer.load_stream(StringIO.StringIO(encrypted), KEY, stats = load_stats)
+		archive = len(loaded.recipients.get_archive().read())
+
+		assert load_stats.stages["input"].bytes_in == len(encrypted)
+		assert load_stats.stages["decipher"].bytes_in == sum(len(chunk) for chunk in ciphertext)
+		assert load_stats.stages["decipher"].bytes_out == load_stats.stages["mime"].bytes_in
+		assert load_stats.stages["mime"].bytes_out == len(payload) + archive
+
+	# The command line prints them as text or as JSON.
+	for arguments, check in [
+		(["--stats"], lambda output: output.startswith("Stage")),
+		(["--stats", "--stats-format", "json"], lambda output: "key_wrap" in json.loads(output)["stages"])
+	]:
+		process = subprocess.Popen(
+			[sys.executable, "-m", "opencce", "-q"] + arguments +
+			["encrypt", "-O", "-", "-c", CERTIFICATE, "--", CERTIFICATE],
+			stdout = subprocess.PIPE, stderr = subprocess.PIPE
+		)
+		encrypted, output = process.communicate()
+		assert process.returncode == 0
+		assert check(output)
+
+def test_server():
+	service = server.Service(token = "secret")
+	service.add_group("people", [CERTIFICATE])
+	service.add_key(KEY)
+
+	instance = server.HTTPServer(("127.0.0.1", 0), service)
+	thread = threading.Thread(target = instance.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	def request(method, path, body = None, token = "secret"):
+		connection = httplib.HTTPConnection(*instance.server_address)
+		connection.request(method, path, body, {"Authorization": "Bearer " + token})
+		response = connection.getresponse()
+		return response.status, response.read()
+
+	try:
+		assert request("GET", "/stats", token = "guess")[0] == 401
+		assert request("POST", "/decrypt", "garbage", token = "guess")[0] == 401
+
+		payload = open(CERTIFICATE).read()
+		status, encrypted = request("POST", "/encrypt?recipients=people&name=cert.pem", payload)
+		assert status == 200
+
+		container = CCEContainer.load(StringIO.StringIO(encrypted), KEY)
+		assert [(filename, handle.read()) for _, filename, handle in container.export()] == [("cert.pem", payload)]
+
+		status, message = request("POST", "/decrypt", encrypted)
+		assert status == 200
+		assert "filename=\"/cert.pem\"" in message
+
+		assert request("POST", "/encrypt?recipients=unknown", payload)[0] == 404
+		assert request("POST", "/decrypt", "garbage")[0] == 400
+
+		# Invalid parameters are rejected before the response starts.
+		assert request("POST", "/encrypt?recipients=people&compress=20", payload)[0] == 400
+		assert request("POST", "/encrypt?recipients=people&format=zip", payload)[0] == 400
+
+		connection = httplib.HTTPConnection(*instance.server_address)
+		connection.putrequest("POST", "/decrypt")
+		connection.putheader("Authorization", "Bearer secret")
+		connection.putheader("Content-Length", "many")
+		connection.endheaders()
+		assert connection.getresponse().status == 400
+
+		status, metrics = request("GET", "/stats")
+		assert json.loads(metrics)["endpoints"]["/encrypt"]["requests"] == 4
+		assert json.loads(metrics)["endpoints"]["/decrypt"]["errors"] == 2
+	finally:
+		instance.shutdown()
+		instance.server_close()
+
+def test_loopback():
+	assert server.is_loopback("127.0.0.1")
+	assert server.is_loopback("localhost")
+	assert not server.is_loopback("0.0.0.0")
+	assert not server.is_loopback("")
+
+	# The command line refuses other addresses and TCP ports without a token before it loads anything.
+	for arguments in [["--host", "0.0.0.0", "--token-file", CERTIFICATE], []]:
+		process = subprocess.Popen(
+			[sys.executable, "-m", "opencce", "-q", "serve", "-k", "missing.pem"] + arguments,
+			stderr = subprocess.PIPE
+		)
+		process.communicate()
+		assert process.returncode == 1
+
+def test_unix_server():
+	directory = tempfile.mkdtemp()
+
+	try:
+		path = os.path.join(directory, "opencce.sock")
+
+		# Files that are not sockets are never removed.
+		with open(path, "w") as handle:
+			handle.write("data")
+
+		try:
+			server.UnixHTTPServer(path, server.Service())
+			assert False
+		except socket.error:
+			pass
+
+		assert open(path).read() == "data"
+
+		# A socket left behind is replaced.
+		os.remove(path)
+		server.UnixHTTPServer(path, server.Service()).server_close()
+		assert os.path.exists(path)
+		server.UnixHTTPServer(path, server.Service()).server_close()
+
+		# Only the owner can connect, whatever the umask.
+		umask = os.umask(0)
+		try:
+			server.UnixHTTPServer(path, server.Service()).server_close()
+		finally:
+			os.umask(umask)
+		assert os.stat(path).st_mode & 0777 == 0600
+	finally:
+		shutil.rmtree(directory)
+
+def test_background():
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+
+	pipe = background.Pipe(size = 2)
+	result = c.encrypt_async(pipe, output_format = pkcs7.FORMAT_DER)
+	encrypted = "".join(pipe)
+	result.get()
+
+	pipe = background.Pipe(size = 2)
+	result = CCEContainer.load_async(pipe, KEY)
+	for offset in range(0, len(encrypted), 1000):
+		pipe.write(encrypted[offset:offset + 1000])
+	pipe.close()
+
+	path, filename, handle = list(result.get().export())[0]
+	assert handle.read() == open(CERTIFICATE).read()
+
+	# The container can not be passed to other processes.
+	import multiprocessing
+	pool = multiprocessing.Pool(1)
+
+	try:
+		c.encrypt_async(StringIO.StringIO(), executor = pool)
+		assert False
+	except ValueError:
+		pass
+	finally:
+		pool.terminate()
+
+	# A reader that stops early makes the writer fail instead of waiting forever.
+	pipe = background.Pipe(size = 1)
+	result = c.encrypt_async(pipe)
+	for chunk in pipe:
+		break
+
+	try:
+		result.get()
+		assert False
+	except IOError:
+		pass
+
+	# A decryption that fails makes the caller fail to write.
+	pipe = background.Pipe(size = 1)
+	result = CCEContainer.load_async(pipe, KEY)
+	try:
+		pipe.write("\x30\x80\x02\x01\x00")
+		while True:
+			pipe.write("x" * 1000)
+	except IOError:
+		pass
+
+	try:
+		result.get()
+		assert False
+	except IOError:
+		pass
+
+	# Neither side waits longer than the timeout.
+	pipe = background.Pipe(size = 1, timeout = 0.01)
+	pipe.write("data")
+	for function in [lambda: pipe.write("data"), lambda: pipe.read(), lambda: background.Pipe(timeout = 0).read()]:
+		try:
+			function()
+			assert False
+		except IOError:
+			pass
+
+def test_lazy_imports():
+	# Importing the command line interface must not load the modules that take long to import.
+	heavy = ("M2Crypto", "lxml", "magic", "email", "BaseHTTPServer", "multiprocessing", "uuid")
+	loaded = subprocess.check_output([
+		sys.executable, "-c", "import sys, opencce.cli; print(' '.join(sorted(sys.modules)))"
+	]).split()
+
+	assert not [name for name in loaded if name.split(".")[0] in heavy]
+
+	# They are still loaded when they are needed.
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+	assert "MIME-Version" in c.encrypt()
+
+def test_rekey():
+	# A second recipient with its own key.
+	import M2Crypto
+	rsa = M2Crypto.RSA.gen_key(1024, 65537, callback = lambda *args: None)
+	key = M2Crypto.EVP.PKey()
+	key.assign_rsa(rsa)
+	name = M2Crypto.X509.X509_Name()
+	name.CN = "REKEY"
+	validity = M2Crypto.ASN1.ASN1_UTCTIME()
+	validity.set_time(0)
+	certificate = M2Crypto.X509.X509()
+	certificate.set_version(2)
+	certificate.set_not_before(validity)
+	certificate.set_not_after(validity)
+	certificate.set_serial_number(2)
+	certificate.set_subject(name)
+	certificate.set_issuer(name)
+	certificate.set_pubkey(key)
+	certificate.sign(key, "sha256")
+
+	payload = os.urandom(200000)
+	c = CCEContainer()
+	c.add_stream(StringIO.StringIO(payload), "payload.bin")
+	c.add_recipient_certificate(CERTIFICATE)
+	encrypted = c.encrypt(output_format = pkcs7.FORMAT_DER)
+
+	decryptor = Decryptor()
+	decryptor.add_key(KEY)
+	added = StringIO.StringIO()
+	decryptor.rekey(StringIO.StringIO(encrypted), added, add = [certificate], output_format = pkcs7.FORMAT_DER)
+
+	# The encrypted content is not touched.
+	content = lambda data: "".join(pkcs7.EnvelopedDataReader(StringIO.StringIO(data)).iter_content())
+	assert content(added.getvalue()) == content(encrypted)
+	assert len(pkcs7.EnvelopedDataReader(StringIO.StringIO(added.getvalue())).recipient_infos) == 2
+
+	# Remove the original recipient with the new key and refresh the certificate listing.
+	decryptor = Decryptor()
+	decryptor.add_key(rsa)
+	removed = StringIO.StringIO()
+	decryptor.rekey(
+		StringIO.StringIO(added.getvalue()), removed, add = [certificate],
+		remove = [x509.load_certificate(open(CERTIFICATE).read())], refresh = True
+	)
+	assert len(pkcs7.EnvelopedDataReader(pkcs7.open_reader(StringIO.StringIO(removed.getvalue()))).recipient_infos) == 1
+
+	container = decryptor.decrypt(StringIO.StringIO(removed.getvalue()))
+	assert list(container.export())[0][2].read() == payload
+	assert [cer.get_subject().CN for cer in container.recipients] == ["REKEY"]
+
+	try:
+		CCEContainer.load(StringIO.StringIO(removed.getvalue()), KEY)
+		assert False
+	except IOError:
+		pass
+
+def test_fan_out():
+	directory = tempfile.mkdtemp()
+
+	try:
+		c = CCEContainer()
+		c.add(CERTIFICATE)
+
+		groups = []
+		for index in range(3):
+			recipients = x509.CertificateStore()
+			recipients.add_from_file(CERTIFICATE)
+			groups.append((os.path.join(directory, "{0}.cce".format(index)), recipients))
+
+		for compression_level in (None, 6):
+			results = list(batch.encrypt_fan_out(c, groups, processes = 2, compression_level = compression_level))
+			assert sorted(result.job for result in results) == [output for output, _ in groups]
+			assert not [result.error for result in results if result.error]
+
+			for output, _ in groups:
+				with open(output, "rb") as handle:
+					container = CCEContainer.load(handle, KEY)
+				path, filename, handle = list(container.export())[0]
+				assert handle.read() == open(CERTIFICATE).read()
+				assert len(container.recipients) == 1
+	finally:
+		shutil.rmtree(directory)
+
+def test_parallel_key_wrap():
+	certificate = x509.load_certificate(open(CERTIFICATE).read())
+	output = StringIO.StringIO()
+	envelope = pkcs7.EnvelopedDataWriter(output, [certificate] * 5, "aes_256_cbc", processes = 2)
+	envelope.write("Content-Type: multipart/mixed; boundary=\"x\"\r\n\r\n--x--\r\n")
+	envelope.close()
+
+	# The pool only lives as long as the call.
+	import multiprocessing
+	assert not multiprocessing.active_children()
+	assert len(pkcs7.get_recipient_infos([certificate] * 3, "k" * 32)) == 3
+
+	# Every recipient can unwrap the key, and M2Crypto still opens the envelope.
+	reader = pkcs7.EnvelopedDataReader(StringIO.StringIO(output.getvalue()))
+	assert len(reader.recipient_infos) == 5
+	assert len(CCEContainer.load(StringIO.StringIO(output.getvalue()), KEY)) == 0
+
+def test_memory_mapped_files():
+	directory = tempfile.mkdtemp()
+	minimum = CCEContainer_module.MMAP_MIN_SIZE
+	CCEContainer_module.MMAP_MIN_SIZE = 1024
+
+	try:
+		path = os.path.join(directory, "large.bin")
+		payload = os.urandom(300001)
+		with open(path, "wb") as handle:
+			handle.write(payload)
+
+		c = CCEContainer()
+		c.add(path)
+		c.add_recipient_certificate(CERTIFICATE)
+
+		with list(c)[0].open() as handle:
+			assert isinstance(handle, mmap.mmap)
+
+		container = CCEContainer.load(StringIO.StringIO(c.encrypt()), KEY)
+		assert list(container.export())[0][2].read() == payload
+	finally:
+		CCEContainer_module.MMAP_MIN_SIZE = minimum
+		shutil.rmtree(directory)
+
+def test_backends():
+	assert isinstance(backends.get_backend(), backends.M2CryptoBackend)
+	assert isinstance(backends.get_backend(size = 1), backends.M2CryptoBackend)
+
+	# Backends have to implement the whole interface.
+	try:
+		backends.Backend()
+		assert False
+	except TypeError:
+		pass
+
+	openssl = backends.OpenSSLBackend()
+	if not openssl.is_available():
+		return
+
+	assert isinstance(backends.get_backend(size = backends.STREAMING_THRESHOLD), backends.OpenSSLBackend)
+	assert isinstance(
+		backends.get_backend(size = backends.STREAMING_THRESHOLD, compressed = True), backends.M2CryptoBackend
+	)
+
+	c = CCEContainer()
+	c.add(CERTIFICATE)
+	c.add_recipient_certificate(CERTIFICATE)
+
+	# Containers of either backend are decrypted by both backends.
+	for encryption in (backends.M2CRYPTO, backends.OPENSSL):
+		encrypted = c.encrypt(backend = encryption)
+		assert len(openssl.get_recipient_infos(StringIO.StringIO(encrypted))) == 1
+
+		for decryption in (backends.M2CRYPTO, backends.OPENSSL):
+			container = CCEContainer.load_stream(StringIO.StringIO(encrypted), KEY, backend = decryption)
+			path, filename, handle = list(container.export())[0]
+			assert handle.read() == open(CERTIFICATE).read()
+
+	compressed = c.encrypt(compression_level = 6)
+	container = CCEContainer.load_stream(StringIO.StringIO(compressed), KEY, backend = backends.OPENSSL)
+	assert len(container) == 1
+
+	try:
+		c.encrypt(compression_level = 6, backend = backends.OPENSSL)
+		assert False
+	except ValueError:
+		pass
+
+	try:
+		CCEContainer.load_stream(StringIO.StringIO(compressed[:len(compressed) // 2]), KEY, backend = openssl)
+		assert False
+	except IOError:
+		pass
+
+def test_openssl_output_error():
+	if not backends.OpenSSLBackend().is_available():
+		return
+
+	class FullDisk(object):
+		def __init__(self):
+			self.size = 0
+
+		def write(self, data):
+			self.size += len(data)
+			if self.size > 100000:
+				raise IOError(28, "No space left on device")
+
+	c = CCEContainer()
+	c.add_stream(StringIO.StringIO(os.urandom(8 * 1024 * 1024)), "large.bin")
+	c.add_recipient_certificate(CERTIFICATE)
+
+	result = background.submit(None, c.encrypt_to, FullDisk(), output_format = pkcs7.FORMAT_DER, backend = "openssl")
+
+	try:
+		result.get(timeout = 30)
+		assert False
+	except IOError as error:
+		assert error.errno == 28
+
+def test_spool_budget():
+	c = CCEContainer()
+	for index in range(10):
+		c.add_stream(StringIO.StringIO(os.urandom(100000)), "{0}.bin".format(index))
+	c.add_recipient_certificate(CERTIFICATE)
+
+	container = CCEContainer.load_stream(StringIO.StringIO(c.encrypt()), KEY, spool_size = 250000)
+
+	# All files together stay within the budget, the others were written to disk.
+	in_memory = [
+		cce_file for cce_file in container
+		if isinstance(cce_file.handle, tempfile.SpooledTemporaryFile) and not cce_file.handle._rolled
+	]
+	assert len(container) == 10
+	assert len(in_memory) == 2
+	assert all(len(handle.read()) == 100000 for path, filename, handle in container.export())